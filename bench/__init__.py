@@ -0,0 +1 @@
+"""Инструменты производительности для слоя хранения (db.py)."""
@@ -0,0 +1,107 @@
+"""Холодный старт regular_bot/main.py: импорты и проверка схемы БД до начала polling.
+
+Каждый замер - отдельный процесс python на уже созданной базе актуальной версии.
+Режимы проверки схемы:
+    inspector - прежний create_tables (инспектор по engine.sync_engine + create_all)
+    locked    - миграции без быстрого пути (BEGIN IMMEDIATE + чтение версии)
+    fast      - db.run_migrations(): одно чтение schema_version
+
+    python -m bench.cold_start --runs 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+MODES = ('inspector', 'locked', 'fast')
+
+
+async def _inspector_create_tables() -> None:
+    # Копия create_tables из db.py до перехода на миграции - точка отсчёта "до".
+    # Инспектор работает на уже открытом соединении: у писателя в профиле 'tuned'
+    # одно соединение, и inspect(engine) ждал бы второго до таймаута пула
+    from sqlalchemy import inspect
+    import db
+
+    async with db.engine.begin() as conn:
+        def get_existing_tables(conn):
+            inspector = inspect(conn)
+            return inspector.get_table_names()
+
+        existing_tables = await conn.run_sync(get_existing_tables)
+        if [table for table in db.Base.metadata.tables if table not in existing_tables]:
+            await conn.run_sync(db.Base.metadata.create_all)
+
+
+def child(mode: str) -> None:
+    """Выполняется в дочернем процессе: печатает JSON с длительностями этапов."""
+    started = time.perf_counter()
+    sys.path.insert(0, str(ROOT))
+    import regular_bot.main  # noqa: F401 - все импорты бота, как при запуске main.py
+    import db
+    imported = time.perf_counter()
+
+    async def check_schema() -> None:
+        if mode == 'inspector':
+            await _inspector_create_tables()
+        elif mode == 'locked':
+            await db._apply_migrations()
+        else:
+            await db.run_migrations()
+        await db.dispose_engines()
+
+    asyncio.run(check_schema())
+    finished = time.perf_counter()
+    print(json.dumps({'import_s': imported - started, 'schema_s': finished - imported}))
+
+
+def measure(mode: str, db_file: str, runs: int) -> dict:
+    env = {**os.environ, 'DB_FILE': db_file}
+    wall, schema, imports = [], [], []
+    for _ in range(runs):
+        started = time.perf_counter()
+        out = subprocess.run(
+            [sys.executable, '-m', 'bench.cold_start', '--child', mode],
+            cwd=ROOT, env=env, check=True, capture_output=True, text=True,
+        ).stdout
+        wall.append(time.perf_counter() - started)
+        stats = json.loads(out.strip().splitlines()[-1])
+        imports.append(stats['import_s'])
+        schema.append(stats['schema_s'])
+    return {
+        'wall_ms': statistics.median(wall) * 1000,
+        'import_ms': statistics.median(imports) * 1000,
+        'schema_ms': statistics.median(schema) * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--db', help='существующая база; по умолчанию - свежая временная')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    db_file = args.db or os.path.join(tempfile.mkdtemp(prefix='bench_cold_'), 'bench.db')
+    # Первый запуск создаёт схему, дальше все режимы работают с актуальной базой
+    subprocess.run([sys.executable, '-m', 'bench.cold_start', '--child', 'fast'],
+                   cwd=ROOT, env={**os.environ, 'DB_FILE': db_file}, check=True, capture_output=True)
+    print(f'runs={args.runs} db={db_file} (медианы)')
+    print(f"{'mode':<11}{'wall ms':>10}{'import ms':>11}{'schema ms':>11}")
+    for mode in MODES:
+        stats = measure(mode, db_file, args.runs)
+        print(f"{mode:<11}{stats['wall_ms']:>10.1f}{stats['import_ms']:>11.1f}{stats['schema_ms']:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Микробенчмарк чтения сделок пользователя: ORM -> dict против Core -> Row.
+
+Для каждого размера создаётся временная база с N сделками одного продавца,
+после чего сравниваются get_deals_for_user (ORM-объекты, копируемые в dict)
+и fetch_deals_for_user со всеми колонками и с проекцией для клавиатуры.
+
+    python -m bench.deal_records --sizes 10000 100000 --repeat 3
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import db
+
+USER_ID = 1
+
+
+def seed(db_file: str, deals: int) -> None:
+    rows = (
+        (USER_ID, 2 + n % 1000, 0.001 * n, str(n), 'card', n % 2, 0, None, 0, int(db.DealStatus.DEPOSITED if n % 2 else db.DealStatus.NEW))
+        for n in range(deals)
+    )
+    with sqlite3.connect(db_file) as conn:
+        conn.executemany(
+            "INSERT INTO deals (seller_id, buyer_id, crypto_amount, fiat_amount, payment_details,"
+            " deposited, fiat_confirmed, buyer_wallet, closed, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+
+async def measure(fn, repeat: int) -> tuple[float, float]:
+    """Лучшее время и пик памяти (МиБ) за repeat прогонов."""
+    best = float('inf')
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        started = time.perf_counter()
+        await fn()
+        best = min(best, time.perf_counter() - started)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return best, peak / 2 ** 20
+
+
+async def run_size(deals: int, repeat: int) -> None:
+    db_file = os.path.join(tempfile.mkdtemp(prefix='bench_records_'), 'bench.db')
+    await db.configure_engine(db_file)
+    await db.run_migrations()
+    seed(db_file, deals)
+
+    cases = {
+        'orm -> dict': lambda: db.get_deals_for_user(USER_ID),
+        'core, all columns': lambda: db.fetch_deals_for_user(USER_ID),
+        'core, keyboard columns': lambda: db.fetch_deals_for_user(USER_ID, columns=db.DEAL_KEYBOARD_COLUMNS),
+    }
+    print(f'\n{deals} deals per user')
+    print(f"{'path':<24}{'seconds':>10}{'peak MiB':>10}")
+    for name, fn in cases.items():
+        seconds, peak = await measure(fn, repeat)
+        print(f'{name:<24}{seconds:>10.3f}{peak:>10.1f}')
+    await db.dispose_engines()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    for deals in args.sizes:
+        await run_size(deals, args.repeat)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
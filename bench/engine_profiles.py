@@ -0,0 +1,70 @@
+"""Сравнение профилей движка SQLite на конкурентной нагрузке create/update/read.
+
+Для каждого профиля создаётся свежая временная база, после чего N задач asyncio
+параллельно создают сделки, обновляют их и читают обратно.
+
+    python -m bench.engine_profiles --tasks 32 --iterations 50
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from sqlalchemy.exc import OperationalError
+
+import db
+
+
+async def worker(worker_id: int, iterations: int, stats: dict) -> None:
+    seller_id = 1000 + worker_id
+    for i in range(iterations):
+        try:
+            deal_id = await db.create_deal(seller_id=seller_id)
+            await db.update_deal(deal_id, buyer_id=seller_id + 1, crypto_amount=0.001 * i, payment_details='card')
+            await db.get_deal_by_id(deal_id)
+            await db.get_deals_for_user(seller_id)
+            stats['ops'] += 4
+        except OperationalError as e:
+            stats['errors'] += 1
+            stats['last_error'] = str(e.orig)
+
+
+async def run_profile(profile_name: str, tasks: int, iterations: int) -> dict:
+    db_file = os.path.join(tempfile.mkdtemp(prefix=f'bench_{profile_name}_'), 'bench.db')
+    await db.configure_engine(db_file, profile_name)
+    await db.run_migrations()
+
+    stats = {'ops': 0, 'errors': 0, 'last_error': None}
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(n, iterations, stats) for n in range(tasks)))
+    elapsed = time.perf_counter() - started
+    await db.dispose_engines()
+
+    stats['elapsed'] = elapsed
+    stats['ops_per_sec'] = stats['ops'] / elapsed if elapsed else 0.0
+    return stats
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=32)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--profiles', nargs='+', default=['legacy', 'tuned'], choices=list(db.ENGINE_PROFILES))
+    args = parser.parse_args()
+
+    print(f'tasks={args.tasks} iterations={args.iterations}')
+    print(f"{'profile':<10}{'ops':>8}{'errors':>8}{'seconds':>10}{'ops/sec':>10}")
+    for profile_name in args.profiles:
+        stats = await run_profile(profile_name, args.tasks, args.iterations)
+        print(f"{profile_name:<10}{stats['ops']:>8}{stats['errors']:>8}{stats['elapsed']:>10.2f}{stats['ops_per_sec']:>10.0f}")
+        if stats['last_error']:
+            print(f"    last error: {stats['last_error']}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+"""Пиковая память выгрузки сделок: stream_deals (yield_per) против выборки всей таблицы.
+
+Для каждого размера создаётся база через bench.seed, затем в одном процессе
+замеряется пик tracemalloc (память Python-объектов) и время:
+    naive  - select всех строк deals одним execute().all() и запись CSV
+    stream - regular_bot.export.export_deals (CSV пачками по DEAL_EXPORT_CHUNK)
+
+    python -m bench.export --sizes 100000 1000000
+"""
+import argparse
+import asyncio
+import csv
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from sqlalchemy import select
+
+import db
+from bench.seed import seed
+from regular_bot.export import export_deals
+
+
+async def naive_export(path: str) -> int:
+    async with db.ReadSessionLocal() as s:
+        rows = (await s.execute(select(db.Deal.__table__))).mappings().all()
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(db.Deal.__table__.columns.keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    return len(rows)
+
+
+async def stream_export(path: str) -> int:
+    tmp_path, count = await export_deals('csv', include_archived=False)
+    os.replace(tmp_path, path)
+    return count
+
+
+async def measure(fn, db_file: str) -> dict:
+    await db.configure_engine(db_file)
+    out = os.path.join(os.path.dirname(db_file), 'export.csv')
+    tracemalloc.start()
+    started = time.perf_counter()
+    count = await fn(out)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await db.dispose_engines()
+    os.remove(out)
+    return {'rows': count, 'seconds': elapsed, 'peak_mb': peak / 1024 / 1024}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000])
+    args = parser.parse_args()
+
+    # Кэш сделок не участвует в выгрузке, но выключен, чтобы не влиять на пик
+    db.deal_cache.enabled = False
+    print(f"{'deals':>10}{'mode':>8}{'seconds':>10}{'peak MB':>10}")
+    for size in args.sizes:
+        db_file = os.path.join(tempfile.mkdtemp(prefix='bench_export_'), 'bench.db')
+        seed(db_file, users=1000, deals=size)
+        for mode, fn in (('naive', naive_export), ('stream', stream_export)):
+            stats = asyncio.run(measure(fn, db_file))
+            print(f"{size:>10}{mode:>8}{stats['seconds']:>10.2f}{stats['peak_mb']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""Исходящие сообщения: отправка прямо из обработчика против regular_bot.outbox.
+
+Поддельный бот повторяет лимиты Telegram: общее ведро 30 сообщений/с и ведро
+на чат 1 сообщение/с с запасом 3; при превышении sendMessage бросает
+TelegramRetryAfter, каждая отправка занимает --rtt-ms. Апдейты приходят с
+частотой --rate от --chats пользователей. Каждый апдейт отвечает своему чату
+(NORMAL), уведомляет вторую сторону сделки (CRITICAL) и с вероятностью
+--cosmetic шлёт подсказку (LOW).
+
+    inline - обработчик сам await-ит send_message; ошибка теряет сообщение
+    outbox - обработчик ставит сообщения в очередь и сразу завершается
+
+Замеряются время обработчика, задержка доставки по полосам, число RetryAfter,
+потерянных и склеенных сообщений.
+
+    python -m bench.outbox --updates 300 --rate 30 --chats 40
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from bench.suite import _percentile
+from regular_bot.outbox import (
+    Outbox, TokenBucket, PRIORITY_CRITICAL, PRIORITY_NORMAL, PRIORITY_LOW, MERGE_SEPARATOR,
+)
+
+LANES = {PRIORITY_CRITICAL: 'critical', PRIORITY_NORMAL: 'normal', PRIORITY_LOW: 'low'}
+
+
+class FakeBot:
+    """send_message с лимитами Telegram. Текст - id сообщений через MERGE_SEPARATOR."""
+
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+        self.global_bucket = TokenBucket(30, 30, time.monotonic())
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.delivered: dict[str, float] = {}
+        self.calls = 0
+        self.retry_after = 0
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.rtt / 2)
+        now = time.monotonic()
+        chat = self.chat_buckets.setdefault(chat_id, TokenBucket(1, 3, now))
+        wait = max(self.global_bucket.delay(now), chat.delay(now))
+        if wait > 0:
+            self.retry_after += 1
+            await asyncio.sleep(self.rtt / 2)
+            raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=text), 'Flood control exceeded', max(1, round(wait)))
+        self.global_bucket.take(now)
+        chat.take(now)
+        for message_id in text.split(MERGE_SEPARATOR):
+            self.delivered[message_id] = now
+        await asyncio.sleep(self.rtt / 2)
+        return text
+
+
+def plan(updates: int, chats: int, cosmetic: float, rng: random.Random) -> list[list[tuple[int, int]]]:
+    """Для каждого апдейта - список (chat_id, priority) отправляемых им сообщений."""
+    result = []
+    for _ in range(updates):
+        user, other = rng.sample(range(1, chats + 1), 2)
+        messages = [(user, PRIORITY_NORMAL), (other, PRIORITY_CRITICAL)]
+        if rng.random() < cosmetic:
+            messages.append((user, PRIORITY_LOW))
+        result.append(messages)
+    return result
+
+
+async def run_mode(mode: str, updates: list, rate: float, rtt_ms: float) -> dict:
+    bot = FakeBot(rtt_ms / 1000)
+    outbox = Outbox()
+    if mode == 'outbox':
+        outbox.start(bot)
+    created: dict[str, tuple[int, float]] = {}
+    handler_times: list[float] = []
+    lost = 0
+    counter = 0
+
+    async def handle(messages: list[tuple[int, int]]) -> None:
+        nonlocal lost, counter
+        started = time.monotonic()
+        for chat_id, priority in messages:
+            counter += 1
+            message_id = str(counter)
+            created[message_id] = (priority, time.monotonic())
+            if mode == 'outbox':
+                outbox.send(chat_id, message_id, priority=priority)
+                continue
+            try:
+                await bot.send_message(chat_id, message_id)
+            except TelegramRetryAfter:
+                lost += 1
+        handler_times.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    handlers = []
+    for messages in updates:
+        handlers.append(asyncio.create_task(handle(messages)))
+        await asyncio.sleep(1 / rate)
+    await asyncio.gather(*handlers)
+    if mode == 'outbox':
+        await outbox.stop(timeout=120)
+    elapsed = time.monotonic() - started
+
+    latencies = {lane: [] for lane in LANES}
+    for message_id, (priority, at) in created.items():
+        if message_id in bot.delivered:
+            latencies[priority].append(bot.delivered[message_id] - at)
+    return {
+        'seconds': elapsed,
+        'handler_p99_ms': _percentile(sorted(handler_times), 0.99) * 1000,
+        'delivered': len(bot.delivered),
+        'lost': lost + outbox.stats['failed'],
+        'calls': bot.calls,
+        'retry_after': bot.retry_after,
+        'merged': outbox.stats['merged'],
+        'p50': {LANES[p]: _percentile(sorted(v), 0.50) for p, v in latencies.items() if v},
+        'p99': {LANES[p]: _percentile(sorted(v), 0.99) for p, v in latencies.items() if v},
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=300)
+    parser.add_argument('--rate', type=float, default=30, help='апдейтов в секунду')
+    parser.add_argument('--chats', type=int, default=40)
+    parser.add_argument('--cosmetic', type=float, default=0.5)
+    parser.add_argument('--rtt-ms', type=float, default=40)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    updates = plan(args.updates, args.chats, args.cosmetic, random.Random(args.seed))
+    total = sum(len(messages) for messages in updates)
+    print(f"updates={args.updates} messages={total} rate={args.rate}/s chats={args.chats} rtt={args.rtt_ms}ms")
+    for mode in ('inline', 'outbox'):
+        s = await run_mode(mode, updates, args.rate, args.rtt_ms)
+        print(f"{mode}: {s['seconds']:.1f}s, handler p99 {s['handler_p99_ms']:.0f} ms, delivered {s['delivered']}, "
+              f"lost {s['lost']}, sendMessage calls {s['calls']}, RetryAfter {s['retry_after']}, merged {s['merged']}")
+        for lane in LANES.values():
+            if lane in s['p50']:
+                print(f"    {lane:<9} delivery p50 {s['p50'][lane] * 1000:7.0f} ms  p99 {s['p99'][lane] * 1000:7.0f} ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
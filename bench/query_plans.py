@@ -0,0 +1,145 @@
+"""Проверка EXPLAIN QUERY PLAN для каждого запроса из db.py.
+
+Вызывает все публичные функции db.py на временной базе, перехватывает
+выполненные SQL-выражения и падает (exit code 1), если план хотя бы одного
+из них содержит полный проход по таблице (SCAN).
+
+    python -m bench.query_plans
+"""
+import asyncio
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# База создаётся во временном каталоге до импорта db, чтобы не трогать escrow_bot.db
+_tmp_dir = tempfile.mkdtemp(prefix='query_plans_')
+os.environ['DB_FILE'] = os.path.join(_tmp_dir, 'query_plans.db')
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from sqlalchemy import event
+
+import db
+
+# SCAN без SEARCH означает проход по всей таблице или всему индексу;
+# сканы подзапросов (материализованных страниц из LIMIT строк) и частичных индексов
+# (их размер ограничен условием индекса) не считаются
+FULL_SCAN_RE = re.compile(r'^SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?')
+CHECKED_PREFIXES = ('SELECT', 'UPDATE', 'DELETE')
+
+captured: list[tuple[str, tuple]] = []
+
+
+def _capture(conn, cursor, statement, parameters, context, executemany):
+    captured.append((statement, parameters))
+
+
+async def exercise() -> None:
+    """Вызывает каждую публичную функцию db.py хотя бы один раз."""
+    await db.upsert_user('seller', 1)
+    await db.upsert_user('buyer', 2)
+    await db.upsert_user('seller', 1)
+    await db.upsert_user('Seller2', 1)
+    await db.upsert_user('seller2', 3)
+    await db.set_user_wallet(1, '0x' + 'a' * 40)
+    await db.find_user_by_username('@SELLER2')
+    await db.get_user(1)
+    await db.update_user(2, wallet='0x' + 'b' * 40)
+    await db.upsert_user_state(2, 'NewDeal:buyer_username')
+    await db.get_user_state(2)
+    await db.get_user_wallet_by_user_id(2)
+    await db.save_fsm_states([{'user_id': 2, 'state': 'NewDeal:fiat_amount', 'fsm_data': {'buyer_id': 1}},
+                              {'user_id': 4, 'state': None, 'fsm_data': None}])
+    await db.load_fsm_states()
+    await db.get_fsm_state(2)
+
+    deal_id = await db.create_deal(seller_id=1)
+    await db.update_deal(deal_id, buyer_id=2, crypto_amount=0.01, fiat_amount='1000', payment_details='card')
+    await db.get_deal_by_id(deal_id)
+    await db.get_deals_for_user(1)
+    await db.get_deals_for_user(1, include_archived=True)
+    await db.get_open_deals_for_user(1)
+    await db.get_open_deals_for_user(2)
+    await db.fetch_deals_for_user(1)
+    await db.fetch_deals_for_user(1, columns=db.DEAL_KEYBOARD_COLUMNS, open_only=True)
+    await db.get_deal_id_by_buyer_id(2)
+    for status in (None, *db.DEAL_PAGE_STATUSES):
+        for role in (None, *db.DEAL_PAGE_ROLES):
+            await db.get_deals_page(1, status=status, role=role)
+            await db.get_deals_page(1, cursor=deal_id + 1, status=status, role=role)
+            await db.get_deals_page(1, cursor=deal_id - 1, direction='prev', status=status, role=role)
+            await db.get_deals_page(1, cursor=deal_id + 1, status=status, role=role, include_archived=True)
+    await db.update_deal_buyer_wallet(deal_id, '0x' + 'b' * 40)
+    await db.try_deposit_deal(deal_id, seller_id=1)
+    await db.set_deal_deposited(deal_id)
+    await db.try_confirm_deal(deal_id, seller_id=1)
+    await db.transition_deal(deal_id, {'closed': False}, closed=True)
+    await db.close_deal(deal_id)
+    await db.get_deals_with_deadlines()
+    await db.get_deal_stats()
+    async for _ in db.stream_deals(since=0, until=int(time.time()) + 1, status='closed', include_archived=True):
+        pass
+    await db.get_deal_events(deal_id)
+    await db.replay_deal(deal_id, at=time.time())
+    # Журнал должен восстанавливать строку целиком, включая производные колонки
+    row, replayed = await db.get_deal_by_id(deal_id), await db.replay_deal(deal_id)
+    assert replayed == row, f"replay_deal differs from the row: {replayed} != {row}"
+    await db.archive_deals(older_than=-1)
+    await db.incremental_vacuum()
+
+    deal_id = await db.create_deal(seller_id=1, buyer_id=2)
+    await db.expire_deals([(deal_id, db.DealStatus.ACCEPTED)])
+    await db.delete_deal(deal_id, expected={'deposited': False})
+    await db.delete_deal(deal_id)
+
+
+def full_scans(db_path: str) -> list[tuple[str, str]]:
+    """Возвращает пары (запрос, строка плана) для всех запросов с полным сканом."""
+    violations = []
+    seen = set()
+    with sqlite3.connect(db_path) as conn:
+        tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        partial_indexes = {name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND sql LIKE '% WHERE %'"
+        )}
+        for statement, parameters in captured:
+            sql = ' '.join(statement.split())
+            if not sql.upper().startswith(CHECKED_PREFIXES) or sql in seen:
+                continue
+            seen.add(sql)
+            for row in conn.execute(f'EXPLAIN QUERY PLAN {statement}', parameters or ()):
+                detail = row[-1]
+                match = FULL_SCAN_RE.match(detail)
+                if match and match.group(1) in tables and match.group(2) not in partial_indexes:
+                    violations.append((sql, detail))
+    return violations
+
+
+async def main() -> int:
+    # Кэши выключены, иначе часть запросов не дойдёт до БД и не попадёт в проверку
+    db.user_cache.enabled = False
+    db.deal_cache.enabled = False
+    await db.run_migrations()
+    engines = [e for e in (db.engine, db.read_engine) if e is not None]
+    for e in engines:
+        event.listen(e.sync_engine, 'before_cursor_execute', _capture)
+    try:
+        await exercise()
+    finally:
+        for e in engines:
+            event.remove(e.sync_engine, 'before_cursor_execute', _capture)
+        await db.dispose_engines()
+
+    violations = full_scans(db.DB_FILE)
+    checked = len({' '.join(s.split()) for s, _ in captured if s.lstrip().upper().startswith(CHECKED_PREFIXES)})
+    for sql, detail in violations:
+        print(f'FULL SCAN: {detail}\n    {sql}')
+    print(f'Проверено запросов: {checked}, с полным сканом: {len(violations)}')
+    return 1 if violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
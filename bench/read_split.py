@@ -0,0 +1,101 @@
+"""Задержка чтения под постоянной нагрузкой записи: общий пул против read/write-split.
+
+Писатели непрерывно создают и обновляют сделки, читатели в это время замеряют
+fetch_deals_for_user (клавиатура) и get_deal_by_id. Кэши выключены.
+Режимы:
+    shared - прежний 'tuned': чтения и записи в одном пуле из 8 соединений
+    split  - read-only пул (mode=ro) для чтений и одно соединение писателя
+
+    python -m bench.read_split --writers 8 --readers 16 --seconds 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import db
+from bench.suite import _percentile
+
+MODES = {
+    'shared': {'DB_POOL_SIZE': '8', 'DB_READ_POOL_SIZE': '0'},
+    'split': {},
+}
+
+
+async def writer(worker_id: int, stop: asyncio.Event, stats: dict) -> None:
+    seller_id = 1000 + worker_id
+    while not stop.is_set():
+        deal_id = await db.create_deal(seller_id=seller_id, buyer_id=seller_id + 1)
+        await db.update_deal(deal_id, crypto_amount=0.01, payment_details='card')
+        stats['writes'] += 2
+
+
+async def reader(worker_id: int, stop: asyncio.Event, latencies: list[float]) -> None:
+    user_id = 1000 + worker_id % 8
+    while not stop.is_set():
+        started = time.perf_counter()
+        await db.fetch_deals_for_user(user_id, columns=db.DEAL_KEYBOARD_COLUMNS, open_only=True)
+        await db.get_deal_by_id(worker_id + 1)
+        latencies.append(time.perf_counter() - started)
+
+
+async def run_mode(mode: str, writers: int, readers: int, seconds: float) -> dict:
+    saved = {name: os.environ.get(name) for name in MODES[mode]}
+    os.environ.update(MODES[mode])
+    try:
+        db_file = os.path.join(tempfile.mkdtemp(prefix=f'bench_{mode}_'), 'bench.db')
+        await db.configure_engine(db_file)
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    await db.run_migrations()
+    for n in range(readers):
+        await db.create_deal(seller_id=1000 + n % 8, buyer_id=2000)
+
+    stop = asyncio.Event()
+    stats = {'writes': 0}
+    latencies: list[float] = []
+    tasks = [asyncio.create_task(writer(n, stop, stats)) for n in range(writers)]
+    tasks += [asyncio.create_task(reader(n, stop, latencies)) for n in range(readers)]
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*tasks)
+    await db.dispose_engines()
+
+    latencies.sort()
+    return {
+        'reads': len(latencies),
+        'writes_per_sec': stats['writes'] / seconds,
+        'p50_ms': _percentile(latencies, 0.50) * 1000,
+        'p95_ms': _percentile(latencies, 0.95) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--readers', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+
+    db.user_cache.enabled = False
+    db.deal_cache.enabled = False
+    print(f'writers={args.writers} readers={args.readers} seconds={args.seconds}')
+    print(f"{'mode':<8}{'reads':>8}{'writes/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for mode in MODES:
+        stats = await run_mode(mode, args.writers, args.readers, args.seconds)
+        print(f"{mode:<8}{stats['reads']:>8}{stats['writes_per_sec']:>10.0f}"
+              f"{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+"""Стоимость операций DeadlineScheduler в зависимости от числа ожидающих сроков.
+
+Для каждого размера куча заполняется случайными сроками, после чего замеряются
+schedule (перенос срока существующей сделки), pop_due пачками по 100 и cancel.
+
+    python -m bench.scheduler --sizes 1000 10000 100000 1000000
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from scheduler import DeadlineScheduler
+
+OPS = 20_000
+
+
+def run_size(size: int, rng: random.Random) -> dict:
+    sched = DeadlineScheduler(clock=lambda: 0.0)
+    for deal_id in range(size):
+        sched.schedule(('deal', deal_id), rng.uniform(1, 86400))
+
+    keys = [('deal', rng.randrange(size)) for _ in range(OPS)]
+    started = time.perf_counter()
+    for key in keys:
+        sched.schedule(key, rng.uniform(1, 86400))
+    schedule_us = (time.perf_counter() - started) / OPS * 1e6
+
+    # Все сроки наступили: извлекаем пачками, как цикл планировщика
+    wanted = min(OPS, size // 2)
+    popped = 0
+    started = time.perf_counter()
+    while popped < wanted:
+        batch = sched.pop_due(now=float('inf'), limit=100)
+        if not batch:
+            break
+        popped += len(batch)
+    pop_us = (time.perf_counter() - started) / max(popped, 1) * 1e6
+
+    # Отменяем оставшиеся в куче сроки
+    live = list(sched._entries)[:OPS]
+    started = time.perf_counter()
+    for key in live:
+        sched.cancel(key)
+    cancel_us = (time.perf_counter() - started) / max(len(live), 1) * 1e6
+    return {'schedule_us': schedule_us, 'cancel_us': cancel_us, 'pop_us': pop_us}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'pending':>10}{'schedule us':>13}{'cancel us':>11}{'pop us':>9}")
+    for size in args.sizes:
+        stats = run_size(size, rng)
+        print(f"{size:>10}{stats['schedule_us']:>13.2f}{stats['cancel_us']:>11.2f}{stats['pop_us']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Генерация синтетической escrow_bot.db заданного размера.
+
+Пользователи: username 'user<N>', user_id N. Сделки распределены между
+случайными продавцами и покупателями, большая часть - закрытые (история).
+
+    python -m bench.seed --db /tmp/bench.db --users 1000000 --deals 10000000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import db
+
+CHUNK = 50_000
+# Сделки равномерно распределены по последнему году
+HISTORY_SECONDS = 365 * 86400
+# Доля сделок по статусам: закрытых больше всего, как в реальной истории
+STATUS_WEIGHTS = {
+    db.DealStatus.NEW: 5,
+    db.DealStatus.ACCEPTED: 3,
+    db.DealStatus.DEPOSITED: 2,
+    db.DealStatus.CONFIRMED: 1,
+    db.DealStatus.CLOSED: 89,
+}
+
+
+def _deal_row(rng: random.Random, users: int, now: int) -> tuple:
+    status = rng.choices(list(STATUS_WEIGHTS), weights=list(STATUS_WEIGHTS.values()))[0]
+    seller_id = rng.randint(1, users)
+    buyer_id = rng.randint(1, users)
+    fiat = rng.randint(1_000, 500_000)
+    created_at = now - rng.randint(0, HISTORY_SECONDS)
+    return (
+        seller_id,
+        buyer_id,
+        round(fiat / 6_000_000, 8),
+        str(fiat),
+        'card 0000 0000 0000 0000',
+        status >= db.DealStatus.DEPOSITED,
+        status >= db.DealStatus.CONFIRMED,
+        f'0x{buyer_id:040x}' if status >= db.DealStatus.ACCEPTED else None,
+        status == db.DealStatus.CLOSED,
+        int(status),
+        created_at,
+        min(now, created_at + rng.randint(60, 86400)) if status == db.DealStatus.CLOSED else None,
+    )
+
+
+def seed(db_file: str, users: int, deals: int, seed_value: int = 0) -> None:
+    """Создаёт схему через миграции и заливает данные пачками по CHUNK строк."""
+    asyncio.run(_migrate(db_file))
+    rng = random.Random(seed_value)
+    started = time.perf_counter()
+    now = int(time.time())
+    with sqlite3.connect(db_file) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        for offset in range(0, users, CHUNK):
+            conn.executemany(
+                "INSERT INTO users (user_id, username, username_alias, wallet, state) VALUES (?, ?, ?, ?, NULL)",
+                ((n, f'user{n}', f'user{n}', f'0x{n:040x}') for n in range(offset + 1, min(offset + CHUNK, users) + 1)),
+            )
+        for offset in range(0, deals, CHUNK):
+            conn.executemany(
+                "INSERT INTO deals (seller_id, buyer_id, crypto_amount, fiat_amount, payment_details,"
+                " deposited, fiat_confirmed, buyer_wallet, closed, status, created_at, closed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (_deal_row(rng, users, now) for _ in range(min(CHUNK, deals - offset))),
+            )
+            conn.commit()
+        conn.execute("ANALYZE")
+    print(f'seeded {users} users / {deals} deals into {db_file} in {time.perf_counter() - started:.1f}s')
+
+
+async def _migrate(db_file: str) -> None:
+    await db.configure_engine(db_file)
+    await db.run_migrations()
+    await db.dispose_engines()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--deals', type=int, default=10_000_000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if os.path.exists(args.db):
+        parser.error(f'{args.db} уже существует')
+    seed(args.db, args.users, args.deals, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""Бенчмарк всех публичных функций db.py на синтетической базе.
+
+Для каждой функции измеряются p50/p95/p99 задержки и ops/sec - сначала
+последовательно, затем в N конкурентных задачах asyncio. Результат пишется
+в JSON вместе с хешем коммита, чтобы прогоны можно было сравнивать.
+
+    python -m bench.suite --db /tmp/bench.db --users 1000000 --deals 10000000 \\
+        --ops 2000 --concurrency 32 --out bench_results.json
+
+База создаётся (bench.seed), если её ещё нет. Пишущие функции меняют данные,
+поэтому для сравнения между коммитами используйте одну и ту же свежую базу (--fresh).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import db
+from bench.seed import seed
+
+
+class Context:
+    """Параметры базы и общие данные операций (например, id созданных сделок)."""
+
+    def __init__(self, users: int, deals: int, rng: random.Random):
+        self.users = users
+        self.deals = deals
+        self.rng = rng
+        self.created_deals: list[int] = []
+
+    def user_id(self) -> int:
+        return self.rng.randint(1, self.users)
+
+    def username(self) -> str:
+        return f'user{self.user_id()}'
+
+    def deal_id(self) -> int:
+        return self.rng.randint(1, self.deals)
+
+
+async def _upsert_user(ctx: Context):
+    # username совпадает с сидом (user<N>), иначе alias переезжал бы между пользователями
+    user_id = ctx.user_id()
+    await db.upsert_user(f'user{user_id}', user_id)
+
+
+async def _create_deal(ctx: Context):
+    ctx.created_deals.append(await db.create_deal(seller_id=ctx.user_id(), buyer_id=ctx.user_id()))
+
+
+async def _delete_deal(ctx: Context):
+    deal_id = ctx.created_deals.pop() if ctx.created_deals else ctx.deal_id()
+    await db.delete_deal(deal_id)
+
+
+async def _stream_deals(ctx: Context):
+    # Выгрузка одного случайного дня истории (bench.seed раскладывает сделки по последнему году)
+    since = int(time.time()) - ctx.rng.randint(1, 365) * 86400
+    async for _ in db.stream_deals(since=since, until=since + 86400):
+        pass
+
+
+# Имя функции db.py -> один вызов со случайными аргументами.
+# При добавлении публичной функции в db.py её нужно добавить и сюда.
+OPERATIONS: dict[str, Callable[[Context], Awaitable]] = {
+    'find_user_by_username': lambda ctx: db.find_user_by_username(ctx.username()),
+    'get_user': lambda ctx: db.get_user(ctx.user_id()),
+    'get_user_state': lambda ctx: db.get_user_state(ctx.user_id()),
+    'get_user_wallet_by_user_id': lambda ctx: db.get_user_wallet_by_user_id(ctx.user_id()),
+    'upsert_user': _upsert_user,
+    'set_user_wallet': lambda ctx: db.set_user_wallet(ctx.user_id(), f'0x{ctx.user_id():040x}'),
+    'update_user': lambda ctx: db.update_user(ctx.user_id(), wallet=f'0x{ctx.user_id():040x}'),
+    'upsert_user_state': lambda ctx: db.upsert_user_state(ctx.user_id(), 'NewDeal:buyer_username'),
+    'get_deal_by_id': lambda ctx: db.get_deal_by_id(ctx.deal_id()),
+    'get_deals_for_user': lambda ctx: db.get_deals_for_user(ctx.user_id()),
+    'get_open_deals_for_user': lambda ctx: db.get_open_deals_for_user(ctx.user_id()),
+    'fetch_deals_for_user': lambda ctx: db.fetch_deals_for_user(ctx.user_id(), columns=db.DEAL_KEYBOARD_COLUMNS, open_only=True),
+    'get_deal_id_by_buyer_id': lambda ctx: db.get_deal_id_by_buyer_id(ctx.user_id()),
+    'get_deals_page': lambda ctx: db.get_deals_page(ctx.user_id(), cursor=ctx.deal_id()),
+    'get_deal_events': lambda ctx: db.get_deal_events(ctx.deal_id()),
+    'replay_deal': lambda ctx: db.replay_deal(ctx.deal_id(), at=time.time() - 86400),
+    'get_deals_page_archived': lambda ctx: db.get_deals_page(ctx.user_id(), cursor=ctx.deal_id(), include_archived=True),
+    'create_deal': _create_deal,
+    'update_deal': lambda ctx: db.update_deal(ctx.deal_id(), payment_details='card'),
+    'update_deal_buyer_wallet': lambda ctx: db.update_deal_buyer_wallet(ctx.deal_id(), f'0x{ctx.user_id():040x}'),
+    'set_deal_deposited': lambda ctx: db.set_deal_deposited(ctx.deal_id()),
+    'try_deposit_deal': lambda ctx: db.try_deposit_deal(ctx.deal_id()),
+    'try_confirm_deal': lambda ctx: db.try_confirm_deal(ctx.deal_id()),
+    'transition_deal': lambda ctx: db.transition_deal(ctx.deal_id(), {'closed': False}, closed=True),
+    'close_deal': lambda ctx: db.close_deal(ctx.deal_id()),
+    'delete_deal': _delete_deal,
+    'get_deals_with_deadlines': lambda ctx: db.get_deals_with_deadlines(),
+    'expire_deals': lambda ctx: db.expire_deals([(ctx.deal_id(), db.DealStatus.NEW)]),
+    'get_deal_stats': lambda ctx: db.get_deal_stats(),
+    'stream_deals': _stream_deals,
+    'load_fsm_states': lambda ctx: db.load_fsm_states(),
+    'get_fsm_state': lambda ctx: db.get_fsm_state(ctx.user_id()),
+    'save_fsm_states': lambda ctx: db.save_fsm_states(
+        [{'user_id': ctx.user_id(), 'state': 'NewDeal:fiat_amount', 'fsm_data': {'crypto_amount': 0.01}}]),
+    'archive_deals': lambda ctx: db.archive_deals(batch_size=10),
+    'incremental_vacuum': lambda ctx: db.incremental_vacuum(),
+}
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _summary(latencies: list[float], elapsed: float) -> dict:
+    latencies.sort()
+    return {
+        'calls': len(latencies),
+        'p50_ms': _percentile(latencies, 0.50) * 1000,
+        'p95_ms': _percentile(latencies, 0.95) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'mean_ms': statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        'ops_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+async def run_operation(op: Callable[[Context], Awaitable], ctx: Context, calls: int, concurrency: int) -> dict:
+    latencies: list[float] = []
+
+    async def worker(count: int) -> None:
+        for _ in range(count):
+            started = time.perf_counter()
+            await op(ctx)
+            latencies.append(time.perf_counter() - started)
+
+    per_task, extra = divmod(calls, concurrency)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(per_task + (n < extra)) for n in range(concurrency)))
+    return _summary(latencies, time.perf_counter() - started)
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=Path(__file__).parent.parent, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+async def run_suite(args) -> dict:
+    await db.configure_engine(args.db, args.profile)
+    await db.run_migrations()
+    db.user_cache.enabled = args.cache
+    db.deal_cache.enabled = args.cache
+    db.keyboard_cache.enabled = args.cache
+
+    ctx = Context(args.users, args.deals, random.Random(args.seed))
+    selected = args.only or list(OPERATIONS)
+    results = {}
+    for name in selected:
+        op = OPERATIONS[name]
+        results[name] = {
+            'single': await run_operation(op, ctx, args.ops, 1),
+            f'concurrent_{args.concurrency}': await run_operation(op, ctx, args.ops, args.concurrency),
+        }
+        single = results[name]['single']
+        print(f"{name:<28} p50 {single['p50_ms']:8.3f} ms  p99 {single['p99_ms']:8.3f} ms  {single['ops_per_sec']:9.0f} ops/s")
+    await db.dispose_engines()
+
+    return {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'params': {
+            'users': args.users,
+            'deals': args.deals,
+            'ops': args.ops,
+            'concurrency': args.concurrency,
+            'profile': args.profile,
+            'cache': args.cache,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='bench_escrow_bot.db')
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--deals', type=int, default=10_000_000)
+    parser.add_argument('--ops', type=int, default=2000, help='вызовов каждой функции в каждом режиме')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--profile', default=db.DB_PROFILE, choices=list(db.ENGINE_PROFILES))
+    parser.add_argument('--cache', action='store_true', help='не выключать кэши пользователей, сделок и клавиатур')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fresh', action='store_true', help='пересоздать базу перед прогоном')
+    parser.add_argument('--only', nargs='+', choices=list(OPERATIONS))
+    parser.add_argument('--out', default='bench_results.json')
+    args = parser.parse_args()
+
+    if args.fresh and os.path.exists(args.db):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+    if not os.path.exists(args.db):
+        template = f'{args.db}.{args.users}x{args.deals}.seed'
+        if not os.path.exists(template):
+            seed(template, args.users, args.deals, args.seed)
+        # Эталонная копия переживает прогоны: --fresh не требует повторной генерации
+        shutil.copyfile(template, args.db)
+
+    report = asyncio.run(run_suite(args))
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'results written to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""Polling против webhook на локальном поддельном Bot API.
+
+Поддельный Bot API (aiohttp) отдаёт апдейты через getUpdates или сам POST-ит их
+в вебхук бота с секретом, а sendMessage фиксирует момент ответа. Обработчик
+отвечает на каждое сообщение после --handler-ms. Замеряется задержка
+"апдейт создан -> ответ получен", пропускная способность и максимум одновременно
+работающих обработчиков (не должен превышать --concurrency). Для webhook также
+проверяется, что запрос с неверным секретом получает 401 и не обрабатывается.
+
+    python -m bench.webhook --updates 2000 --concurrency 16 --handler-ms 20
+    python -m bench.webhook --updates 1000 --rate 100 --rtt-ms 80   # задержка без очереди
+"""
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from aiogram import Bot, Dispatcher, Router
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message
+from aiohttp import ClientSession, web
+
+from bench.suite import _percentile
+from regular_bot.webhook import build_webhook_app
+
+TOKEN = '123456:TEST'
+API_PORT = 18081
+WEBHOOK_PORT = 18082
+WEBHOOK_PATH = '/webhook'
+SECRET = 'bench-secret'
+
+
+class FakeBotAPI:
+    """Минимальный Bot API: getMe, getUpdates (long polling), setWebhook/deleteWebhook, sendMessage."""
+
+    def __init__(self, rtt: float = 0):
+        # Имитация сети до api.telegram.org: каждый ответ задерживается на rtt
+        self.rtt = rtt
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.created: dict[int, float] = {}
+        self.answered: dict[int, float] = {}
+        self.done = asyncio.Event()
+        self.expected = 0
+        self.update_id = 0
+
+    def make_update(self) -> dict:
+        self.update_id += 1
+        chat_id = 1000 + self.update_id
+        self.created[chat_id] = time.perf_counter()
+        return {
+            'update_id': self.update_id,
+            'message': {
+                'message_id': self.update_id, 'date': int(time.time()), 'text': 'ping',
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'},
+            },
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        payload = dict(await request.post())
+        if method == 'getupdates':
+            updates = []
+            try:
+                updates.append(await asyncio.wait_for(self.queue.get(), float(payload.get('timeout', 0)) or 0.01))
+            except asyncio.TimeoutError:
+                pass
+            await asyncio.sleep(self.rtt)
+            while not self.queue.empty() and len(updates) < 100:
+                updates.append(self.queue.get_nowait())
+            return web.json_response({'ok': True, 'result': updates})
+        if method == 'sendmessage':
+            chat_id = int(payload['chat_id'])
+            # Сообщение доставлено через половину RTT, ответ бот получит ещё через половину
+            await asyncio.sleep(self.rtt / 2)
+            self.answered[chat_id] = time.perf_counter()
+            if len(self.answered) >= self.expected:
+                self.done.set()
+            await asyncio.sleep(self.rtt / 2)
+            return web.json_response({'ok': True, 'result': {
+                'message_id': 1, 'date': int(time.time()), 'text': payload.get('text', ''),
+                'chat': {'id': chat_id, 'type': 'private'},
+            }})
+        if method == 'getme':
+            return web.json_response({'ok': True, 'result': {'id': 123456, 'is_bot': True, 'first_name': 'bench'}})
+        # setWebhook, deleteWebhook и прочее - просто успех
+        return web.json_response({'ok': True, 'result': True})
+
+
+def build_dispatcher(handler_ms: float, stats: dict) -> Dispatcher:
+    router = Router()
+
+    @router.message()
+    async def pong(message: Message) -> None:
+        stats['running'] += 1
+        stats['max_running'] = max(stats['max_running'], stats['running'])
+        try:
+            await asyncio.sleep(handler_ms / 1000)
+            await message.answer('pong')
+        finally:
+            stats['running'] -= 1
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    return dp
+
+
+async def produce(updates: int, rate: float, emit) -> None:
+    """Создаёт updates апдейтов: все сразу (rate=0) или равномерно rate штук в секунду."""
+    for _ in range(updates):
+        await emit()
+        if rate:
+            await asyncio.sleep(1 / rate)
+
+
+async def run_mode(mode: str, updates: int, concurrency: int, handler_ms: float, rate: float = 0,
+                   rtt_ms: float = 0) -> dict:
+    api = FakeBotAPI(rtt=rtt_ms / 1000)
+    api.expected = updates
+    api_app = web.Application()
+    api_app.router.add_post('/bot{token}/{method}', api.handle)
+    api_runner = web.AppRunner(api_app)
+    await api_runner.setup()
+    await web.TCPSite(api_runner, '127.0.0.1', API_PORT).start()
+
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(f'http://127.0.0.1:{API_PORT}')))
+    stats = {'running': 0, 'max_running': 0, 'rejected': 0}
+    dp = build_dispatcher(handler_ms, stats)
+
+    started = time.perf_counter()
+    if mode == 'polling':
+        async def emit():
+            api.queue.put_nowait(api.make_update())
+
+        task = asyncio.create_task(dp.start_polling(
+            bot, polling_timeout=10, handle_signals=False, close_bot_session=False, tasks_concurrency_limit=concurrency,
+        ))
+        await produce(updates, rate, emit)
+        # Если polling упадёт, ответов не будет: ждём и его, чтобы увидеть исключение
+        await asyncio.wait([task, asyncio.create_task(api.done.wait())], return_when=asyncio.FIRST_COMPLETED)
+        elapsed = time.perf_counter() - started
+        while stats['running']:
+            await asyncio.sleep(0.01)
+        if not task.done():
+            await dp.stop_polling()
+        await task
+    else:
+        runner = web.AppRunner(build_webhook_app(dp, bot, WEBHOOK_PATH, SECRET, concurrency))
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', WEBHOOK_PORT).start()
+        url = f'http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}'
+        async with ClientSession() as http:
+            forged = api.make_update()
+            async with http.post(url, json=forged, headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'}) as r:
+                stats['rejected'] = r.status == 401
+            # Отклонённый апдейт не должен дойти до обработчика и в замеры не входит
+            del api.created[forged['message']['chat']['id']]
+
+            # Как Telegram: не больше concurrency открытых соединений (max_connections)
+            connections = asyncio.Semaphore(concurrency)
+            posts = []
+
+            async def post(update: dict) -> None:
+                async with connections:
+                    async with http.post(url, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': SECRET}) as r:
+                        assert r.status == 200, r.status
+
+            async def emit():
+                posts.append(asyncio.create_task(post(api.make_update())))
+
+            started = time.perf_counter()
+            await produce(updates, rate, emit)
+            await asyncio.gather(*posts)
+            await api.done.wait()
+        elapsed = time.perf_counter() - started
+        # Последние sendMessage ещё ждут ответа поддельного API
+        while stats['running']:
+            await asyncio.sleep(0.01)
+        await runner.cleanup()
+
+    await bot.session.close()
+    await api_runner.cleanup()
+    latencies = sorted(api.answered[chat_id] - created for chat_id, created in api.created.items()
+                       if chat_id in api.answered)
+    return {
+        'answered': len(latencies),
+        'per_sec': len(latencies) / elapsed,
+        'p50_ms': _percentile(latencies, 0.50) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'max_running': stats['max_running'],
+        'rejected': stats['rejected'],
+        'forged_answered': len(api.answered) - len(latencies),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--handler-ms', type=float, default=20)
+    parser.add_argument('--rate', type=float, default=0, help='апдейтов в секунду; 0 - все сразу')
+    parser.add_argument('--rtt-ms', type=float, default=0, help='задержка сети до Bot API')
+    args = parser.parse_args()
+
+    print(f'updates={args.updates} concurrency={args.concurrency} handler={args.handler_ms}ms '
+          f'rate={args.rate or "burst"} rtt={args.rtt_ms}ms')
+    print(f"{'mode':<9}{'answered':>9}{'upd/s':>8}{'p50 ms':>9}{'p99 ms':>9}{'max run':>9}")
+    for mode in ('polling', 'webhook'):
+        s = await run_mode(mode, args.updates, args.concurrency, args.handler_ms, args.rate, args.rtt_ms)
+        print(f"{mode:<9}{s['answered']:>9}{s['per_sec']:>8.0f}{s['p50_ms']:>9.1f}{s['p99_ms']:>9.1f}{s['max_running']:>9}")
+        if mode == 'webhook':
+            print(f"wrong secret -> 401: {s['rejected']}, processed anyway: {s['forged_answered']}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
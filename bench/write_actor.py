@@ -0,0 +1,69 @@
+"""Пропускная способность записи: коммит на каждый вызов против группового коммита.
+
+N задач asyncio параллельно выполняют upsert_user и update_deal; в режиме
+'actor' те же вызовы идут через db.WriteActor.
+
+    python -m bench.write_actor --tasks 64 --iterations 20
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import db
+
+
+async def worker(worker_id: int, iterations: int, deal_id: int) -> None:
+    for i in range(iterations):
+        await db.submit_write(db.upsert_user, f'user_{worker_id}_{i}', worker_id * 1000 + i)
+        await db.submit_write(db.update_deal, deal_id, crypto_amount=0.001 * i)
+
+
+async def run_mode(mode: str, profile_name: str, tasks: int, iterations: int, max_delay: float) -> dict:
+    db_file = os.path.join(tempfile.mkdtemp(prefix=f'bench_{mode}_'), 'bench.db')
+    await db.configure_engine(db_file, profile_name)
+    await db.run_migrations()
+    deal_ids = [await db.create_deal(seller_id=n) for n in range(tasks)]
+
+    db.write_actor = db.WriteActor(max_delay=max_delay, max_batch=200)
+    if mode == 'actor':
+        db.write_actor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(n, iterations, deal_ids[n]) for n in range(tasks)))
+    elapsed = time.perf_counter() - started
+    await db.write_actor.stop()
+    await db.dispose_engines()
+
+    ops = tasks * iterations * 2
+    return {
+        'ops': ops,
+        'elapsed': elapsed,
+        'ops_per_sec': ops / elapsed,
+        'batches': db.write_actor.batches if mode == 'actor' else ops,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=64)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--profile', default='tuned', choices=list(db.ENGINE_PROFILES))
+    parser.add_argument('--max-delay', type=float, default=0.005)
+    args = parser.parse_args()
+
+    # Кэши не влияют на запись, но upsert_user с попаданием в кэш пропускает БД
+    db.user_cache.enabled = False
+    print(f'tasks={args.tasks} iterations={args.iterations} profile={args.profile}')
+    print(f"{'mode':<10}{'ops':>8}{'commits':>9}{'seconds':>10}{'ops/sec':>10}")
+    for mode in ('per-call', 'actor'):
+        stats = await run_mode(mode, args.profile, args.tasks, args.iterations, args.max_delay)
+        print(f"{mode:<10}{stats['ops']:>8}{stats['batches']:>9}{stats['elapsed']:>10.2f}{stats['ops_per_sec']:>10.0f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
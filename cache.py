@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+import time
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Ограниченный по размеру in-process кэш с LRU-вытеснением и TTL.
+
+    Не потокобезопасен: рассчитан на один event loop. При enabled=False
+    все чтения - промахи, а записи игнорируются (удобно для тестов).
+
+    Поколения ключей защищают от устаревшей записи: читатель запоминает stamp()
+    до чтения из БД, писатель вызывает bump(key), и changed_since(key, stamp)
+    говорит, что прочитанное значение класть в кэш уже нельзя. Счётчик поколений
+    общий для всех кэшей, так что один stamp годится для любого из них.
+    """
+
+    _clock = 0
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None, enabled: bool = True):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = enabled
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> номер последнего bump; забытые ключи считаются изменёнными в _floor
+        self._versions: dict[Hashable, int] = {}
+        self._floor = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if not self.enabled:
+            self.misses += 1
+            return default
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at and expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if not self.enabled:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else 0.0
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def expire(self) -> int:
+        """Удаляет просроченные записи с начала LRU-очереди; возвращает их число.
+
+        get() не продлевает срок, поэтому запись, к которой обращались, может
+        оказаться просроченной и ближе к концу - её удалит следующий get().
+        """
+        if not self.ttl:
+            return 0
+        now = time.monotonic()
+        removed = 0
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at >= now:
+                break
+            del self._data[key]
+            removed += 1
+        return removed
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Значение без учёта в счётчиках и без продвижения в LRU (даже если TTL истёк)."""
+        item = self._data.get(key, _MISSING)
+        return default if item is _MISSING else item[1]
+
+    def pop(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    @classmethod
+    def stamp(cls) -> int:
+        """Текущее поколение; запоминается перед чтением значения из источника."""
+        return cls._clock
+
+    def bump(self, key: Hashable) -> None:
+        """Отмечает изменение key: значения, прочитанные до этого, в кэш не попадут."""
+        LRUCache._clock += 1
+        self._versions[key] = LRUCache._clock
+        if len(self._versions) > 2 * self.maxsize:
+            # Без истории все ключи считаются изменёнными сейчас - только лишние промахи
+            self._versions.clear()
+            self._floor = LRUCache._clock
+
+    def changed_since(self, key: Hashable, stamp: int) -> bool:
+        return self._versions.get(key, self._floor) > stamp
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
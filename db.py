@@ -1,25 +1,218 @@
-from typing import Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, Sequence
+from enum import IntEnum
+from contextlib import asynccontextmanager
+from os import getenv
+import asyncio
 import logging
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import Column, Integer, String, Boolean, Float, Text, or_, select, inspect
+import re
+import time
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
+from sqlalchemy.orm import declarative_base, sessionmaker, Session
+from sqlalchemy.engine import Row
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import Column, Integer, String, Boolean, Float, Text, JSON, Index, or_, select, insert, update, delete, event, case, literal, text, union_all
 
-DB_FILE = 'escrow_bot.db'
-engine = create_async_engine(f"sqlite+aiosqlite:///{DB_FILE}")
+from cache import LRUCache
+
+DB_FILE = getenv('DB_FILE', 'escrow_bot.db')
+
+# Профили движка SQLite. 'legacy' - прежнее поведение (rollback journal, без busy_timeout),
+# 'tuned' - WAL: читатели не блокируют писателя, а писатели ждут блокировку вместо "database is locked".
+ENGINE_PROFILES: dict[str, dict] = {
+    'legacy': {
+        'pragmas': {},
+    },
+    'tuned': {
+        'pragmas': {
+            # Действует только для нового файла (до первой таблицы); старый файл
+            # переводится одноразовым VACUUM, см. enable_incremental_vacuum()
+            'auto_vacuum': 'INCREMENTAL',
+            'journal_mode': 'WAL',
+            # В режиме WAL NORMAL безопасен для целостности и не делает fsync на каждый коммит
+            'synchronous': 'NORMAL',
+            'mmap_size': 256 * 1024 * 1024,
+            # Отрицательное значение - размер в КиБ (64 МиБ на соединение)
+            'cache_size': -64000,
+            'busy_timeout': 5000,
+            'temp_store': 'MEMORY',
+        },
+        # WAL допускает много читателей и одного писателя: запись идёт через
+        # единственное соединение (очередь в пуле вместо ожидания блокировки SQLite),
+        # а функции чтения берут соединения из отдельного read-only пула
+        'pool_size': 1,
+        'max_overflow': 0,
+        'read_pool_size': 8,
+    },
+}
+DB_PROFILE = getenv('DB_PROFILE', 'tuned')
+
+
+def get_engine_profile(name: str = DB_PROFILE) -> dict:
+    """Возвращает профиль с учётом переопределений из окружения (DB_BUSY_TIMEOUT, DB_POOL_SIZE, ...).
+
+    DB_READ_POOL_SIZE=0 отключает отдельный движок для чтения.
+    """
+    if name not in ENGINE_PROFILES:
+        raise ValueError(f"Неизвестный профиль БД: {name}")
+    base = ENGINE_PROFILES[name]
+    profile = {**base, 'pragmas': dict(base['pragmas'])}
+    for pragma in profile['pragmas']:
+        override = getenv(f'DB_{pragma.upper()}')
+        if override is not None:
+            profile['pragmas'][pragma] = override
+    for option in ('pool_size', 'max_overflow', 'read_pool_size'):
+        override = getenv(f'DB_{option.upper()}')
+        if override is not None:
+            profile[option] = int(override)
+    return profile
+
+
+# PRAGMA, которые меняют файл или режим журнала: на read-only соединении не выполняются
+_WRITE_ONLY_PRAGMAS = ('auto_vacuum', 'journal_mode', 'synchronous')
+
+
+def _set_pragmas_on_connect(new_engine: AsyncEngine, pragmas: dict) -> None:
+    @event.listens_for(new_engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+
+def _pool_timeout(pragmas: dict) -> dict:
+    if 'busy_timeout' in pragmas:
+        # Ожидание соединения из пула не должно быть короче ожидания блокировки
+        return {'pool_timeout': max(30, int(pragmas['busy_timeout']) / 1000)}
+    return {}
+
+
+def make_engine(db_file: str = DB_FILE, profile_name: str = DB_PROFILE) -> AsyncEngine:
+    """Создаёт движок для файла БД с PRAGMA из профиля на каждом новом соединении."""
+    profile = get_engine_profile(profile_name)
+    pragmas = profile['pragmas']
+    pool_options = {k: profile[k] for k in ('pool_size', 'max_overflow') if k in profile}
+    pool_options.update(_pool_timeout(pragmas))
+
+    new_engine = create_async_engine(f"sqlite+aiosqlite:///{db_file}", **pool_options)
+    if pragmas:
+        _set_pragmas_on_connect(new_engine, pragmas)
+    return new_engine
+
+
+def make_read_engine(db_file: str = DB_FILE, profile_name: str = DB_PROFILE) -> Optional[AsyncEngine]:
+    """Движок только для чтения (URI mode=ro) со своим пулом; None, если профиль его не задаёт.
+
+    Под WAL читатели работают со снимком последнего коммита и не ждут писателя.
+    Файл должен существовать: движок используется после run_migrations().
+    """
+    profile = get_engine_profile(profile_name)
+    if not profile.get('read_pool_size'):
+        return None
+    pragmas = {k: v for k, v in profile['pragmas'].items() if k not in _WRITE_ONLY_PRAGMAS}
+    pragmas['query_only'] = 1
+    new_engine = create_async_engine(
+        f"sqlite+aiosqlite:///file:{db_file}?mode=ro&uri=true",
+        pool_size=profile['read_pool_size'],
+        max_overflow=0,
+        **_pool_timeout(pragmas),
+    )
+    _set_pragmas_on_connect(new_engine, pragmas)
+    return new_engine
+
+
+engine = make_engine()
 AsyncSessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+# Без отдельного движка чтения (профиль 'legacy') сессии чтения идут через основной
+read_engine = make_read_engine()
+ReadSessionLocal = sessionmaker(bind=read_engine or engine, class_=AsyncSession, expire_on_commit=False)
 Base = declarative_base()
 
 
+async def configure_engine(db_file: str = DB_FILE, profile_name: str = DB_PROFILE) -> AsyncEngine:
+    """Пересоздаёт глобальный движок (например, для бенчмарков или другого файла БД)."""
+    global engine, read_engine, DB_FILE
+    await dispose_engines()
+    DB_FILE = db_file
+    engine = make_engine(db_file, profile_name)
+    read_engine = make_read_engine(db_file, profile_name)
+    AsyncSessionLocal.configure(bind=engine)
+    ReadSessionLocal.configure(bind=read_engine or engine)
+    return engine
+
+
+async def dispose_engines() -> None:
+    """Закрывает соединения обоих пулов (писателя и чтения)."""
+    await engine.dispose()
+    if read_engine is not None:
+        await read_engine.dispose()
+
+
+# Условие частичного индекса ix_users_fsm; запросы должны содержать его дословно
+FSM_STATE_CONDITION = "state IS NOT NULL OR fsm_data IS NOT NULL"
+
+
+# Модели описывают только маппинг; схемой файла БД владеют MIGRATIONS ниже.
+# Любое изменение колонок/индексов здесь должно сопровождаться новой миграцией.
 class User(Base):
     __tablename__ = 'users'
-    username = Column(String, primary_key=True)
-    user_id = Column(Integer, nullable=False)
+    __table_args__ = (
+        Index('ux_users_username_alias', 'username_alias', unique=True),
+        # Загрузка FSM при старте: только пользователи посреди мастера
+        Index('ix_users_fsm', 'user_id', sqlite_where=text(FSM_STATE_CONDITION)),
+    )
+    # Telegram user_id - постоянный идентификатор, username может меняться
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    username = Column(String, nullable=True)
+    # username_alias(username); NULL, если username сейчас занят другим пользователем
+    username_alias = Column(String, nullable=True)
     wallet = Column(String, nullable=True)
+    # Состояние и данные aiogram FSM; пишутся только regular_bot.storage.SQLiteStorage
     state = Column(String, nullable=True)
+    fsm_data = Column(JSON(none_as_null=True), nullable=True)
+
+
+def username_alias(username: str) -> str:
+    """Ключ поиска по username: без '@' и без учёта регистра, как в Telegram.
+
+    Username в Telegram только из ASCII, поэтому casefold() совпадает с lower() в SQLite.
+    """
+    return username.lstrip('@').casefold()
+
+
+class DealStatus(IntEnum):
+    """Жизненный цикл сделки. Значения упорядочены: всё, что меньше CLOSED, - открытые сделки."""
+    NEW = 0          # создана, покупатель ещё не указал кошелёк
+    ACCEPTED = 1     # покупатель указал кошелёк, ждём депозит
+    DEPOSITED = 2    # продавец внёс депозит, ждём подтверждение фиата
+    CONFIRMED = 3    # фиат подтверждён, крипта отправляется
+    CLOSED = 4       # терминальный статус
+
+
+# Условие частичных индексов по открытым сделкам; запросы должны содержать его дословно
+OPEN_DEAL_CONDITION = f"status < {int(DealStatus.CLOSED)}"
 
 
 class Deal(Base):
     __tablename__ = 'deals'
+    __table_args__ = (
+        # deal_id - это rowid, он неявно хранится в каждом индексе,
+        # поэтому ORDER BY deal_id по этим индексам не требует сортировки
+        Index('ix_deals_seller_id', 'seller_id'),
+        Index('ix_deals_buyer_id', 'buyer_id'),
+        # Частичные индексы только по незакрытым сделкам: их размер не растёт с историей
+        Index('ix_deals_open_seller_id', 'seller_id', sqlite_where=text(OPEN_DEAL_CONDITION)),
+        Index('ix_deals_open_buyer_id', 'buyer_id', sqlite_where=text(OPEN_DEAL_CONDITION)),
+        # Очередь архиватора: закрытые сделки по времени закрытия
+        Index('ix_deals_closed_at', 'closed_at', sqlite_where=text('closed_at IS NOT NULL')),
+        # Восстановление планировщика сроков: только открытые сделки
+        Index('ix_deals_open_status_at', 'status', 'status_at', sqlite_where=text(OPEN_DEAL_CONDITION)),
+        # Выгрузка за период (stream_deals): диапазон в порядке (created_at, deal_id) без сортировки
+        Index('ix_deals_created_at', 'created_at'),
+        # Номера сделок не переиспользуются: удалённые и архивные остаются в deals_archive
+        {'sqlite_autoincrement': True},
+    )
     deal_id = Column(Integer, primary_key=True, autoincrement=True)
     seller_id = Column(Integer)
     buyer_id = Column(Integer)
@@ -30,183 +223,1464 @@ class Deal(Base):
     fiat_confirmed = Column(Boolean, default=False)
     buyer_wallet = Column(String)
     closed = Column(Boolean, default=False)
+    # Производный от флагов выше статус, поддерживается функциями обновления сделок
+    status = Column(Integer, nullable=False, default=DealStatus.NEW, server_default='0')
+    # Unix-время; у сделок, созданных до миграции 4, created_at пустой
+    created_at = Column(Integer, default=lambda: int(time.time()))
+    closed_at = Column(Integer)
+    # Время последней смены status: от него считаются сроки accept-by/deposit-by/confirm-by
+    status_at = Column(Integer, default=lambda: int(time.time()))
+
+
+class DealArchive(Base):
+    """Холодная копия закрытых (после DEAL_ARCHIVE_AFTER) и удалённых сделок."""
+    __tablename__ = 'deals_archive'
+    __table_args__ = (
+        Index('ix_deals_archive_seller_id', 'seller_id'),
+        Index('ix_deals_archive_buyer_id', 'buyer_id'),
+        Index('ix_deals_archive_created_at', 'created_at'),
+    )
+    deal_id = Column(Integer, primary_key=True, autoincrement=False)
+    seller_id = Column(Integer)
+    buyer_id = Column(Integer)
+    crypto_amount = Column(Float)
+    fiat_amount = Column(String)
+    payment_details = Column(Text)
+    deposited = Column(Boolean)
+    fiat_confirmed = Column(Boolean)
+    buyer_wallet = Column(String)
+    closed = Column(Boolean)
+    status = Column(Integer, nullable=False)
+    created_at = Column(Integer)
+    closed_at = Column(Integer)
+    status_at = Column(Integer)
+    deleted = Column(Boolean, nullable=False, default=False)
+    archived_at = Column(Integer, nullable=False)
+
+
+class DealEvent(Base):
+    """Append-only журнал изменений сделки; пишется функциями db.py, не обновляется и не удаляется."""
+    __tablename__ = 'deal_events'
+    __table_args__ = (
+        # История одной сделки - один диапазон индекса в порядке времени
+        Index('ix_deal_events_deal_id_ts', 'deal_id', 'ts'),
+    )
+    event_id = Column(Integer, primary_key=True)
+    deal_id = Column(Integer, nullable=False)
+    # Unix-время в секундах с дробной частью
+    ts = Column(Float, nullable=False)
+    kind = Column(String, nullable=False)
+    # Изменённые поля сделки (для 'created' и 'snapshot' - все поля)
+    data = Column(JSON, nullable=False)
+
+
+# Комиссия сервиса от фиатной суммы сделки
+DEAL_COMMISSION_RATE = 0.03
+DEAL_STATS_TOTAL = 'total'
+
+
+class DealStats(Base):
+    """Агрегаты для /stats, поддерживаются функциями изменения сделок в их же транзакции.
+
+    Строка на день (UTC, 'YYYY-MM-DD') и строка DEAL_STATS_TOTAL за всё время: созданные
+    сделки считаются в день создания, закрытые и их объёмы - в день закрытия,
+    отменённые (удалённые до закрытия) - в день удаления.
+    """
+    __tablename__ = 'deal_stats'
+    day = Column(String, primary_key=True)
+    created = Column(Integer, nullable=False, default=0)
+    closed = Column(Integer, nullable=False, default=0)
+    cancelled = Column(Integer, nullable=False, default=0)
+    crypto_volume = Column(Float, nullable=False, default=0)
+    fiat_volume = Column(Float, nullable=False, default=0)
+    commission = Column(Float, nullable=False, default=0)
+
+
+DEAL_STATS_COUNTERS = ('created', 'closed', 'cancelled', 'crypto_volume', 'fiat_volume', 'commission')
+
+_FIAT_NUMBER_RE = re.compile(r'\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?')
+
+
+def fiat_value(fiat_amount) -> float:
+    """Число из fiat_amount (строка из сообщения пользователя): ведущее число, запятая - разделитель дроби.
+
+    Совпадает с CAST(REPLACE(fiat_amount, ',', '.') AS REAL) в SQLite: '1 000' -> 1, 'abc' -> 0.
+    """
+    if fiat_amount is None:
+        return 0.0
+    match = _FIAT_NUMBER_RE.match(str(fiat_amount).replace(',', '.'))
+    return float(match.group(0)) if match else 0.0
+
+
+def stats_day(ts: float) -> str:
+    return time.strftime('%Y-%m-%d', time.gmtime(ts))
+
+
+def _json_bool(column: str) -> str:
+    # json_object() иначе запишет BOOLEAN-колонку как 0/1
+    return f"CASE WHEN {column} IS NULL THEN NULL WHEN {column} THEN json('true') ELSE json('false') END"
+
+
+# Снимок строки deals/deals_archive в том же виде, что и data событий (для миграции 5)
+_SNAPSHOT_JSON = "json_object(" + ", ".join(
+    f"'{name}', {_json_bool(name) if name in ('deposited', 'fiat_confirmed', 'closed') else name}"
+    for name in ('deal_id', 'seller_id', 'buyer_id', 'crypto_amount', 'fiat_amount', 'payment_details',
+                 'deposited', 'fiat_confirmed', 'buyer_wallet', 'closed', 'status', 'created_at', 'closed_at')
+) + ")"
+
+
+# Вклад каждой существующей сделки в deal_stats (для миграции 8): день и приращения счётчиков
+_FIAT_SQL = "CAST(REPLACE(fiat_amount, ',', '.') AS REAL)"
+_DEAL_STATS_BACKFILL = f"""
+    SELECT date(created_at, 'unixepoch') AS day, 1 AS created, 0 AS closed, 0 AS cancelled,
+           0.0 AS crypto_volume, 0.0 AS fiat_volume
+    FROM (SELECT created_at FROM deals UNION ALL SELECT created_at FROM deals_archive)
+    UNION ALL
+    SELECT date(closed_at, 'unixepoch'), 0, 1, 0, COALESCE(crypto_amount, 0), COALESCE({_FIAT_SQL}, 0)
+    FROM (SELECT closed_at, crypto_amount, fiat_amount FROM deals WHERE status = 4
+          UNION ALL
+          SELECT closed_at, crypto_amount, fiat_amount FROM deals_archive WHERE status = 4)
+    UNION ALL
+    SELECT date(archived_at, 'unixepoch'), 0, 0, 1, 0.0, 0.0
+    FROM deals_archive WHERE deleted AND status < 4
+"""
+
 
+# Версионированные миграции: (версия, описание, список SQL-выражений).
+# Только вперёд: уже выпущенные миграции не редактируются, изменения добавляются новой версией.
+# Миграция 1 повторяет схему, которую раньше создавал create_all, поэтому
+# существующий escrow_bot.db подхватывается без потери данных.
+MIGRATIONS: list[tuple[int, str, list[str]]] = [
+    (1, 'base tables', [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            username VARCHAR NOT NULL,
+            user_id INTEGER NOT NULL,
+            wallet VARCHAR,
+            state VARCHAR,
+            PRIMARY KEY (username)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS deals (
+            deal_id INTEGER NOT NULL,
+            seller_id INTEGER,
+            buyer_id INTEGER,
+            crypto_amount FLOAT,
+            fiat_amount VARCHAR,
+            payment_details TEXT,
+            deposited BOOLEAN,
+            fiat_confirmed BOOLEAN,
+            buyer_wallet VARCHAR,
+            closed BOOLEAN,
+            PRIMARY KEY (deal_id)
+        )
+        """,
+    ]),
+    (2, 'lookup indexes', [
+        "CREATE INDEX IF NOT EXISTS ix_deals_seller_id ON deals (seller_id)",
+        "CREATE INDEX IF NOT EXISTS ix_deals_buyer_id ON deals (buyer_id)",
+        "CREATE INDEX IF NOT EXISTS ix_users_user_id_wallet ON users (user_id, wallet)",
+    ]),
+    (3, 'deal status with partial indexes on open deals', [
+        "ALTER TABLE deals ADD COLUMN status INTEGER NOT NULL DEFAULT 0",
+        """
+        UPDATE deals SET status = CASE
+            WHEN closed THEN 4
+            WHEN fiat_confirmed THEN 3
+            WHEN deposited THEN 2
+            WHEN buyer_wallet IS NOT NULL THEN 1
+            ELSE 0
+        END
+        """,
+        f"CREATE INDEX IF NOT EXISTS ix_deals_open_seller_id ON deals (seller_id) WHERE {OPEN_DEAL_CONDITION}",
+        f"CREATE INDEX IF NOT EXISTS ix_deals_open_buyer_id ON deals (buyer_id) WHERE {OPEN_DEAL_CONDITION}",
+    ]),
+    (4, 'deal timestamps, AUTOINCREMENT deal ids and deals_archive', [
+        # Перестройка таблицы: без AUTOINCREMENT SQLite выдаёт новой сделке max(deal_id) + 1,
+        # и после переноса последней сделки в архив её номер достался бы следующей
+        """
+        CREATE TABLE deals_new (
+            deal_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            seller_id INTEGER,
+            buyer_id INTEGER,
+            crypto_amount FLOAT,
+            fiat_amount VARCHAR,
+            payment_details TEXT,
+            deposited BOOLEAN,
+            fiat_confirmed BOOLEAN,
+            buyer_wallet VARCHAR,
+            closed BOOLEAN,
+            status INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER,
+            closed_at INTEGER
+        )
+        """,
+        # Время закрытия старых сделок неизвестно - отсчёт возраста начинается с миграции
+        """
+        INSERT INTO deals_new (deal_id, seller_id, buyer_id, crypto_amount, fiat_amount, payment_details,
+                               deposited, fiat_confirmed, buyer_wallet, closed, status, closed_at)
+        SELECT deal_id, seller_id, buyer_id, crypto_amount, fiat_amount, payment_details,
+               deposited, fiat_confirmed, buyer_wallet, closed, status,
+               CASE WHEN closed THEN CAST(strftime('%s', 'now') AS INTEGER) END
+        FROM deals
+        """,
+        "DROP TABLE deals",
+        "ALTER TABLE deals_new RENAME TO deals",
+        "CREATE INDEX ix_deals_seller_id ON deals (seller_id)",
+        "CREATE INDEX ix_deals_buyer_id ON deals (buyer_id)",
+        f"CREATE INDEX ix_deals_open_seller_id ON deals (seller_id) WHERE {OPEN_DEAL_CONDITION}",
+        f"CREATE INDEX ix_deals_open_buyer_id ON deals (buyer_id) WHERE {OPEN_DEAL_CONDITION}",
+        "CREATE INDEX ix_deals_closed_at ON deals (closed_at) WHERE closed_at IS NOT NULL",
+        """
+        CREATE TABLE IF NOT EXISTS deals_archive (
+            deal_id INTEGER NOT NULL,
+            seller_id INTEGER,
+            buyer_id INTEGER,
+            crypto_amount FLOAT,
+            fiat_amount VARCHAR,
+            payment_details TEXT,
+            deposited BOOLEAN,
+            fiat_confirmed BOOLEAN,
+            buyer_wallet VARCHAR,
+            closed BOOLEAN,
+            status INTEGER NOT NULL,
+            created_at INTEGER,
+            closed_at INTEGER,
+            deleted BOOLEAN NOT NULL DEFAULT 0,
+            archived_at INTEGER NOT NULL,
+            PRIMARY KEY (deal_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_deals_archive_seller_id ON deals_archive (seller_id)",
+        "CREATE INDEX IF NOT EXISTS ix_deals_archive_buyer_id ON deals_archive (buyer_id)",
+    ]),
+    (5, 'deal event log', [
+        """
+        CREATE TABLE IF NOT EXISTS deal_events (
+            event_id INTEGER NOT NULL,
+            deal_id INTEGER NOT NULL,
+            ts FLOAT NOT NULL,
+            kind VARCHAR NOT NULL,
+            data JSON NOT NULL,
+            PRIMARY KEY (event_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_deal_events_deal_id_ts ON deal_events (deal_id, ts)",
+        # Существующие сделки получают стартовый снимок, иначе их нечем воспроизводить
+        f"""
+        INSERT INTO deal_events (deal_id, ts, kind, data)
+        SELECT deal_id, CAST(strftime('%s', 'now') AS FLOAT), 'snapshot', {_SNAPSHOT_JSON}
+        FROM deals
+        """,
+        f"""
+        INSERT INTO deal_events (deal_id, ts, kind, data)
+        SELECT deal_id, archived_at, CASE WHEN deleted THEN 'deleted' ELSE 'snapshot' END, {_SNAPSHOT_JSON}
+        FROM deals_archive
+        """,
+    ]),
+    (6, 'users keyed by user_id with username alias', [
+        """
+        CREATE TABLE users_new (
+            user_id INTEGER NOT NULL,
+            username VARCHAR,
+            username_alias VARCHAR,
+            wallet VARCHAR,
+            state VARCHAR,
+            PRIMARY KEY (user_id)
+        )
+        """,
+        # После смены username у пользователя было несколько строк: берём последнюю
+        # и последний известный кошелёк
+        """
+        INSERT INTO users_new (user_id, username, wallet, state)
+        SELECT u.user_id, u.username,
+               COALESCE(u.wallet, (SELECT w.wallet FROM users w
+                                   WHERE w.user_id = u.user_id AND w.wallet IS NOT NULL
+                                   ORDER BY w.rowid DESC LIMIT 1)),
+               u.state
+        FROM users u
+        WHERE u.rowid = (SELECT MAX(m.rowid) FROM users m WHERE m.user_id = u.user_id)
+        """,
+        "CREATE UNIQUE INDEX ux_users_username_alias ON users_new (username_alias)",
+        # Если username перешёл к другому пользователю, alias получает меньший user_id,
+        # у второго он остаётся NULL до его следующего /start
+        "UPDATE OR IGNORE users_new SET username_alias = lower(username)",
+        "DROP TABLE users",
+        "ALTER TABLE users_new RENAME TO users",
+    ]),
+    (7, 'deal status timestamps for deadlines', [
+        "ALTER TABLE deals ADD COLUMN status_at INTEGER",
+        "ALTER TABLE deals_archive ADD COLUMN status_at INTEGER",
+        # Для старых сделок момент смены статуса неизвестен: сроки отсчитываются от миграции
+        "UPDATE deals SET status_at = COALESCE(closed_at, CAST(strftime('%s', 'now') AS INTEGER))",
+        f"CREATE INDEX IF NOT EXISTS ix_deals_open_status_at ON deals (status, status_at) WHERE {OPEN_DEAL_CONDITION}",
+    ]),
+    (8, 'deal statistics rollups', [
+        """
+        CREATE TABLE IF NOT EXISTS deal_stats (
+            day VARCHAR NOT NULL,
+            created INTEGER NOT NULL DEFAULT 0,
+            closed INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            crypto_volume FLOAT NOT NULL DEFAULT 0,
+            fiat_volume FLOAT NOT NULL DEFAULT 0,
+            commission FLOAT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day)
+        )
+        """,
+        # Сделки без даты (созданные до миграции 4) попадают только в итоговую строку
+        f"""
+        INSERT INTO deal_stats (day, created, closed, cancelled, crypto_volume, fiat_volume, commission)
+        SELECT day, SUM(created), SUM(closed), SUM(cancelled), SUM(crypto_volume), SUM(fiat_volume),
+               SUM(fiat_volume) * {DEAL_COMMISSION_RATE}
+        FROM ({_DEAL_STATS_BACKFILL}) WHERE day IS NOT NULL GROUP BY day
+        """,
+        f"""
+        INSERT INTO deal_stats (day, created, closed, cancelled, crypto_volume, fiat_volume, commission)
+        SELECT '{DEAL_STATS_TOTAL}', COALESCE(SUM(created), 0), COALESCE(SUM(closed), 0), COALESCE(SUM(cancelled), 0),
+               COALESCE(SUM(crypto_volume), 0), COALESCE(SUM(fiat_volume), 0),
+               COALESCE(SUM(fiat_volume), 0) * {DEAL_COMMISSION_RATE}
+        FROM ({_DEAL_STATS_BACKFILL})
+        """,
+    ]),
+    (9, 'created_at indexes for deal export', [
+        "CREATE INDEX IF NOT EXISTS ix_deals_created_at ON deals (created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_deals_archive_created_at ON deals_archive (created_at)",
+    ]),
+    (10, 'persistent FSM data', [
+        "ALTER TABLE users ADD COLUMN fsm_data JSON",
+        f"CREATE INDEX IF NOT EXISTS ix_users_fsm ON users (user_id) WHERE {FSM_STATE_CONDITION}",
+    ]),
+]
 
-# Создаём таблицы асинхронно, если они не существуют
-async def create_tables():
-    try:
-        async with engine.begin() as conn:
-            # Проверяем существование таблиц перед созданием
-            # Обернуть синхронную операцию в run_sync чтобы избежать MissingGreenlet ошибки
-            def get_existing_tables(conn):
-                inspector = inspect(engine.sync_engine)
-                return inspector.get_table_names()
-            
-            existing_tables = await conn.run_sync(get_existing_tables)
-            
-            # Создаем только те таблицы, которых еще нет
-            tables_to_create = [
-                table for table in Base.metadata.tables.keys()
-                if table not in existing_tables
-            ]
-            
-            if tables_to_create:
-                logging.info(f"Создаются таблицы: {tables_to_create}")
-                await conn.run_sync(Base.metadata.create_all)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def get_schema_version() -> int:
+    """Версия схемы файла одним чтением без блокировок; 0 - схема ещё не создавалась."""
+    async with engine.connect() as conn:
+        try:
+            result = await conn.exec_driver_sql("SELECT MAX(version) FROM schema_version")
+        except OperationalError:
+            return 0
+        return result.scalar() or 0
+
+
+async def run_migrations() -> int:
+    """Применяет недостающие миграции и возвращает итоговую версию схемы.
+
+    Быстрый путь: если схема актуальна, выполняется один SELECT без блокировки записи и DDL.
+    """
+    current = await get_schema_version()
+    if current >= SCHEMA_VERSION:
+        return current
+    return await _apply_migrations()
+
+
+async def _apply_migrations() -> int:
+    async with engine.begin() as conn:
+        # BEGIN IMMEDIATE сразу берёт блокировку записи: DDL выполняется атомарно,
+        # а два одновременно стартующих процесса не применят миграции дважды
+        await conn.exec_driver_sql("BEGIN IMMEDIATE")
+        await conn.exec_driver_sql(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description VARCHAR)"
+        )
+        result = await conn.exec_driver_sql("SELECT MAX(version) FROM schema_version")
+        current = result.scalar() or 0
+
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            logging.info(f"Применяется миграция {version}: {description}")
+            for sql in statements:
+                await conn.exec_driver_sql(sql)
+            await conn.exec_driver_sql(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description)
+            )
+            current = version
+
+    return current
+
+@asynccontextmanager
+async def session_scope(session: Optional[AsyncSession] = None) -> AsyncIterator[AsyncSession]:
+    """Единица работы для функций ниже.
+
+    Если передана внешняя сессия (например, из DbSessionMiddleware), используется она,
+    а коммит остаётся за её владельцем. Иначе открывается своя сессия и коммитится в конце.
+    """
+    if session is not None:
+        yield session
+        return
+    async with AsyncSessionLocal() as own_session:
+        yield own_session
+        await own_session.commit()
+
+
+@asynccontextmanager
+async def read_scope(session: Optional[AsyncSession] = None) -> AsyncIterator[AsyncSession]:
+    """Сессия для функций чтения: по умолчанию из read-only пула.
+
+    Внешняя сессия используется, только если в ней уже открыта транзакция (были записи),
+    чтобы чтение видело её незакоммиченные изменения. Ленивая сессия middleware без записей
+    соединение писателя не занимает.
+    """
+    if session is not None and session.in_transaction():
+        yield session
+        return
+    async with ReadSessionLocal() as read_session:
+        yield read_session
+
+
+# In-process кэши поверх БД. Запись сразу убирает ключ из кэша и откладывает
+# новое значение (или удаление) до коммита сессии; при откате ключ просто сбрасывается.
+# Чтение не кладёт в кэш то, что текущая сессия изменила без коммита, поэтому
+# в кэш не попадают данные откатившейся транзакции.
+user_cache = LRUCache(
+    maxsize=int(getenv('USER_CACHE_SIZE', '10000')),
+    ttl=float(getenv('USER_CACHE_TTL', '300')),
+    enabled=getenv('USER_CACHE_ENABLED', '1') != '0',
+)
+deal_cache = LRUCache(
+    maxsize=int(getenv('DEAL_CACHE_SIZE', '10000')),
+    ttl=float(getenv('DEAL_CACHE_TTL', '600')),
+    enabled=getenv('DEAL_CACHE_ENABLED', '1') != '0',
+)
+# Клавиатуры действий: user_id -> {FSM-состояние: разметка}. Зависят только от
+# открытых сделок пользователя, поэтому любая запись сделки сбрасывает запись
+# и продавца, и покупателя (после коммита, как и остальные кэши).
+keyboard_cache = LRUCache(
+    maxsize=int(getenv('KEYBOARD_CACHE_SIZE', '10000')),
+    ttl=float(getenv('KEYBOARD_CACHE_TTL', '600')),
+    enabled=getenv('KEYBOARD_CACHE_ENABLED', '1') != '0',
+)
+
+_DROP = object()
+
+
+def _uncommitted_keys(s) -> dict:
+    """(кэш, ключ) -> значение, которое станет видно после коммита, или _DROP."""
+    return s.info.setdefault('uncommitted_cache_keys', {})
+
+
+def _invalidate(s, cache: LRUCache, *keys) -> None:
+    pending = _uncommitted_keys(s)
+    for key in keys:
+        cache.pop(key)
+        cache.bump(key)
+        pending[(cache, key)] = _DROP
+
+
+def _write_through(s, cache: LRUCache, key, value) -> None:
+    cache.pop(key)
+    cache.bump(key)
+    _uncommitted_keys(s)[(cache, key)] = value
+
+
+def _cache_put(s, cache: LRUCache, keys, value, since: int) -> None:
+    """Кладёт прочитанное значение в кэш. since - cache.stamp(), взятый до чтения:
+    если ключ с тех пор менялся (запись или коммит другой сессии), значение могло устареть."""
+    pending = s.info.get('uncommitted_cache_keys')
+    if pending and any((cache, key) in pending for key in keys):
+        return
+    # Транзакция, начатая раньше, читает снимок БД на момент своего начала
+    since = min(since, s.info.get('cache_stamp', since))
+    if any(cache.changed_since(key, since) for key in keys):
+        return
+    for key in keys:
+        cache.set(key, value)
+
+
+def _invalidate_keyboards(s, *user_ids) -> None:
+    _invalidate(s, keyboard_cache, *{user_id for user_id in user_ids if user_id is not None})
+
+
+def get_cached_keyboard(user_id: int, state: Optional[str]) -> Any:
+    """Клавиатура пользователя для состояния state из keyboard_cache или None."""
+    keyboards = keyboard_cache.get(user_id)
+    return keyboards.get(state) if keyboards else None
+
+
+def cache_keyboard(user_id: int, state: Optional[str], markup: Any, since: int,
+                   session: Optional[AsyncSession] = None) -> None:
+    """Кладёт клавиатуру в кэш. since - keyboard_cache.stamp() до чтения сделок;
+    session - сессия, через которую они читались: если она сама меняла сделки
+    пользователя без коммита, клавиатура не кэшируется."""
+    # get, а не peek: просроченная запись не должна воскреснуть вместе с новой клавиатурой
+    keyboards = {**(keyboard_cache.get(user_id) or {}), state: markup}
+    if session is None:
+        if not keyboard_cache.changed_since(user_id, since):
+            keyboard_cache.set(user_id, keyboards)
+    else:
+        _cache_put(session, keyboard_cache, (user_id,), keyboards, since)
+
+
+@event.listens_for(Session, "after_begin")
+def _remember_cache_stamp(session, transaction, connection) -> None:
+    session.info['cache_stamp'] = LRUCache.stamp()
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_uncommitted_cache_keys(session) -> None:
+    pending = session.info.pop('uncommitted_cache_keys', None)
+    if pending:
+        for (cache, key), value in pending.items():
+            # Читатели, начавшие до коммита, видели старое значение
+            cache.bump(key)
+            if value is _DROP:
+                cache.pop(key)
             else:
-                logging.info("Все таблицы уже существуют")
-    except Exception as e:
-        logging.error(f"Ошибка при создании таблиц: {e}")
-        raise
-
-# Все функции теперь async
-
-async def set_user_wallet(username: str, wallet: str) -> None:
-    async with AsyncSessionLocal() as session:
-        async with session.begin():
-            u = await session.get(User, username)
-            if u:
-                u.wallet = wallet
-                await session.commit()
-
-async def upsert_user(username: str, user_id: int) -> None:
-    async with AsyncSessionLocal() as session:
-        user = await session.get(User, username)
+                cache.set(key, value)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _drop_uncommitted_cache_keys(session, previous_transaction) -> None:
+    pending = session.info.pop('uncommitted_cache_keys', None)
+    if pending:
+        for cache, key in pending:
+            cache.pop(key)
+            cache.bump(key)
+
+
+# --- Журнал событий сделок ---
+# События копятся в session.info и вставляются одним executemany перед коммитом
+# той же транзакции, что и сами изменения: откат отменяет и события.
+
+def _record_deal_event(s, deal_id: int, kind: str, data: dict) -> None:
+    s.info.setdefault('pending_deal_events', []).append(
+        {'deal_id': deal_id, 'ts': time.time(), 'kind': kind, 'data': data}
+    )
+
+
+# Подписчики получают список событий после коммита транзакции, в которой они записаны.
+# Вызываются синхронно в event loop, поэтому должны быть быстрыми и не бросать исключений.
+deal_event_subscribers: list[Callable[[list[dict]], None]] = []
+
+
+def _flush_deal_events(session: Session) -> None:
+    pending = session.info.pop('pending_deal_events', None)
+    if pending:
+        session.execute(insert(DealEvent.__table__), pending)
+        session.info.setdefault('flushed_deal_events', []).extend(pending)
+
+
+@event.listens_for(Session, "before_commit")
+def _write_pending_deal_events(session) -> None:
+    _flush_deal_events(session)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_deal_events(session) -> None:
+    events = session.info.pop('flushed_deal_events', None)
+    if events:
+        for subscriber in deal_event_subscribers:
+            try:
+                subscriber(events)
+            except Exception:
+                logging.exception("Подписчик событий сделок завершился с ошибкой")
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _drop_pending_deal_events(session, previous_transaction) -> None:
+    session.info.pop('pending_deal_events', None)
+    session.info.pop('flushed_deal_events', None)
+
+
+# --- Агрегаты deal_stats ---
+# Приращения копятся в session.info и применяются одним upsert на день перед коммитом,
+# так что горячая строка дня пишется один раз за транзакцию, а откат отменяет и агрегаты.
+
+def _record_deal_stats(s, ts: float, **deltas) -> None:
+    pending = s.info.setdefault('pending_deal_stats', {})
+    for day in (stats_day(ts), DEAL_STATS_TOTAL):
+        row = pending.setdefault(day, dict.fromkeys(DEAL_STATS_COUNTERS, 0))
+        for name, value in deltas.items():
+            row[name] += value
+
+
+def _record_closed_deal(s, deal: dict) -> None:
+    fiat = fiat_value(deal['fiat_amount'])
+    _record_deal_stats(
+        s, deal['closed_at'] or time.time(),
+        closed=1, crypto_volume=deal['crypto_amount'] or 0, fiat_volume=fiat, commission=fiat * DEAL_COMMISSION_RATE,
+    )
+
+
+@event.listens_for(Session, "before_commit")
+def _write_pending_deal_stats(session) -> None:
+    pending = session.info.pop('pending_deal_stats', None)
+    if not pending:
+        return
+    stmt = sqlite_insert(DealStats.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DealStats.day],
+        set_={name: DealStats.__table__.c[name] + stmt.excluded[name] for name in DEAL_STATS_COUNTERS},
+    )
+    session.execute(stmt, [{'day': day, **row} for day, row in pending.items()])
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _drop_pending_deal_stats(session, previous_transaction) -> None:
+    session.info.pop('pending_deal_stats', None)
+
+
+def _deal_event_kind(values: dict) -> str:
+    """Имя события по записываемым полям: самое значимое изменение из переданных."""
+    if values.get('closed') is True:
+        return 'closed'
+    if values.get('fiat_confirmed') is True:
+        return 'confirmed'
+    if values.get('deposited') is True:
+        return 'deposited'
+    if values.get('buyer_wallet') is not None:
+        return 'wallet_set'
+    if values.get('buyer_id') is not None:
+        return 'buyer_set'
+    return 'updated'
+
+
+def _user_as_dict(u: User) -> dict:
+    return {"user_id": u.user_id, "username": u.username, "wallet": u.wallet, "state": u.state}
+
+
+def _cache_user(s, user: dict, since: int) -> None:
+    keys = [('user_id', user['user_id'])]
+    if user['username']:
+        keys.append(('alias', username_alias(user['username'])))
+    _cache_put(s, user_cache, keys, user, since)
+
+
+def _invalidate_user(s, user_id: int, *usernames) -> None:
+    """Сбрасывает пользователя по user_id и по alias текущего и переданных username."""
+    keys = [('user_id', user_id)]
+    cached = user_cache.peek(('user_id', user_id))
+    if cached and cached['username']:
+        keys.append(('alias', username_alias(cached['username'])))
+    keys.extend(('alias', username_alias(name)) for name in usernames if name)
+    _invalidate(s, user_cache, *keys)
+
+
+# Все функции теперь async; каждая принимает необязательную session, чтобы
+# запросы одного апдейта шли через одно соединение и один коммит
+
+async def set_user_wallet(user_id: int, wallet: str, session: Optional[AsyncSession] = None) -> None:
+    await update_user(user_id, wallet=wallet, session=session)
+
+async def upsert_user(username: str, user_id: int, session: Optional[AsyncSession] = None) -> None:
+    """Создаёт пользователя или обновляет его username и alias (вызывается на каждый /start)."""
+    cached = user_cache.get(('user_id', user_id))
+    if cached and cached['username'] == username:
+        # Частый случай повторного /start: строка уже актуальна, в БД не ходим
+        return
+    alias = username_alias(username)
+    since = user_cache.stamp()
+    async with session_scope(session) as s:
+        user = await s.get(User, user_id)
+        if user and user.username == username and user.username_alias == alias:
+            _cache_user(s, _user_as_dict(user), since)
+            return
+        # Username мог освободиться у другого пользователя: alias уникален, снимаем его там
+        previous = (await s.execute(
+            update(User)
+            .where(User.username_alias == alias, User.user_id != user_id)
+            .values(username_alias=None)
+            .returning(User.user_id)
+        )).scalars().all()
+        for other_id in previous:
+            _invalidate_user(s, other_id, username)
         if user:
-            user.user_id = user_id
+            _invalidate_user(s, user_id, user.username, username)
+            user.username = username
+            user.username_alias = alias
         else:
-            session.add(User(username=username, user_id=user_id))
-        await session.commit()
+            _invalidate_user(s, user_id, username)
+            s.add(User(user_id=user_id, username=username, username_alias=alias))
 
-async def find_user_by_username(username: str):
-    async with AsyncSessionLocal() as session:
-        u = await session.get(User, username)
+async def get_user(user_id: int, session: Optional[AsyncSession] = None) -> Optional[dict]:
+    """Пользователь по Telegram user_id (поиск по первичному ключу)."""
+    cached = user_cache.get(('user_id', user_id))
+    if cached:
+        return dict(cached)
+    since = user_cache.stamp()
+    async with read_scope(session) as s:
+        u = await s.get(User, user_id)
         if not u:
             return None
-        return {"username": u.username, "user_id": u.user_id, "wallet": u.wallet, "state": u.state}
+        user = _user_as_dict(u)
+        _cache_user(s, user, since)
+        return dict(user)
 
-async def create_deal(seller_id: int, buyer_id: int = None, crypto_amount: float = None, fiat_amount: str = None, payment_details: str = None) -> int:
-    async with AsyncSessionLocal() as session:
+async def find_user_by_username(username: str, session: Optional[AsyncSession] = None):
+    """Пользователь по username без учёта регистра и '@' (уникальный индекс по alias)."""
+    alias = username_alias(username)
+    cached = user_cache.get(('alias', alias))
+    if cached:
+        return dict(cached)
+    since = user_cache.stamp()
+    async with read_scope(session) as s:
+        result = await s.execute(select(User).where(User.username_alias == alias))
+        u = result.scalar_one_or_none()
+        if not u:
+            return None
+        user = _user_as_dict(u)
+        _cache_user(s, user, since)
+        return dict(user)
+
+async def create_deal(seller_id: int, buyer_id: int = None, crypto_amount: float = None, fiat_amount: str = None, payment_details: str = None, session: Optional[AsyncSession] = None) -> int:
+    async with session_scope(session) as s:
         deal = Deal(seller_id=seller_id, buyer_id=buyer_id, crypto_amount=crypto_amount, fiat_amount=fiat_amount, payment_details=payment_details)
-        session.add(deal)
-        await session.commit()
-        await session.refresh(deal)
+        s.add(deal)
+        # flush выдаёт deal_id без отдельного коммита и refresh
+        await s.flush()
+        record = _deal_as_dict(deal)
+        _write_through(s, deal_cache, deal.deal_id, record)
+        _invalidate_keyboards(s, seller_id, buyer_id)
+        _record_deal_event(s, deal.deal_id, 'created', record)
+        _record_deal_stats(s, deal.created_at, created=1)
         return deal.deal_id
 
-async def get_deal_by_id(deal_id: int):
-    async with AsyncSessionLocal() as session:
-        d = await session.get(Deal, deal_id)
+def _deal_as_dict(d: Deal) -> dict:
+    return {
+        "deal_id": d.deal_id,
+        "seller_id": d.seller_id,
+        "buyer_id": d.buyer_id,
+        "crypto_amount": d.crypto_amount,
+        "fiat_amount": d.fiat_amount,
+        "payment_details": d.payment_details,
+        "deposited": d.deposited,
+        "fiat_confirmed": d.fiat_confirmed,
+        "buyer_wallet": d.buyer_wallet,
+        "closed": d.closed,
+        "status": int(d.status),
+        "created_at": d.created_at,
+        "closed_at": d.closed_at,
+        "status_at": d.status_at,
+    }
+
+async def get_deal_by_id(deal_id: int, session: Optional[AsyncSession] = None):
+    cached = deal_cache.get(deal_id)
+    if cached:
+        return dict(cached)
+    since = deal_cache.stamp()
+    async with read_scope(session) as s:
+        d = await s.get(Deal, deal_id)
         if not d:
             return None
-        return {
-            "deal_id": d.deal_id,
-            "seller_id": d.seller_id,
-            "buyer_id": d.buyer_id,
-            "crypto_amount": d.crypto_amount,
-            "fiat_amount": d.fiat_amount,
-            "payment_details": d.payment_details,
-            "deposited": d.deposited,
-            "fiat_confirmed": d.fiat_confirmed,
-            "buyer_wallet": d.buyer_wallet,
-        }
+        deal = _deal_as_dict(d)
+        _cache_put(s, deal_cache, (deal_id,), deal, since)
+        return dict(deal)
+
+async def get_deals_for_user(user_id: int, include_archived: bool = False, session: Optional[AsyncSession] = None):
+    """Все сделки пользователя, включая закрытые (история).
 
-async def get_deals_for_user(user_id: int):
-    async with AsyncSessionLocal() as session:
+    include_archived добавляет сделки из deals_archive (у них есть ключи deleted и archived_at).
+    """
+    async with read_scope(session) as s:
         stmt = select(Deal).where(or_(Deal.seller_id == user_id, Deal.buyer_id == user_id))
-        rows = await session.execute(stmt)
-        rows = rows.scalars().all()
-        result = []
-        for d in rows:
-            result.append({
-                "deal_id": d.deal_id,
-                "seller_id": d.seller_id,
-                "buyer_id": d.buyer_id,
-                "crypto_amount": d.crypto_amount,
-                "fiat_amount": d.fiat_amount,
-                "payment_details": d.payment_details,
-                "deposited": d.deposited,
-                "fiat_confirmed": d.fiat_confirmed,
-                "buyer_wallet": d.buyer_wallet,
-                "closed": d.closed
-            })
+        rows = await s.execute(stmt)
+        result = [_deal_as_dict(d) for d in rows.scalars().all()]
+        if include_archived:
+            archive = DealArchive.__table__
+            archived = await s.execute(
+                select(archive).where(or_(archive.c.seller_id == user_id, archive.c.buyer_id == user_id))
+            )
+            result.extend(dict(row) for row in archived.mappings())
         return result
 
-async def update_deal(deal_id: int, **kwargs):
-    async with AsyncSessionLocal() as session:
-        async with session.begin():
-            d = await session.get(Deal, deal_id)
-            if d:
-                for name, value in kwargs.items():
-                    if name in ['seller_id', 'buyer_id', 'crypto_amount', 'fiat_amount', 'payment_details', 'deposited', 'fiat_confirmed', 'buyer_wallet']:
-                        setattr(d, name, value)
-                await session.commit()
-
-async def update_deal_buyer_wallet(deal_id: int, wallet: str) -> None:
-    async with AsyncSessionLocal() as session:
-        async with session.begin():
-            d = await session.get(Deal, deal_id)
-            if d:
-                d.buyer_wallet = wallet
-                await session.commit()
-
-async def set_deal_deposited(deal_id: int, value: bool = True) -> None:
-    async with AsyncSessionLocal() as session:
-        async with session.begin():
-            d = await session.get(Deal, deal_id)
-            if d:
-                d.deposited = value
-                await session.commit()
-
-async def close_deal(deal_id: int) -> None:
-    async with AsyncSessionLocal() as session:
-        async with session.begin():
-            d = await session.get(Deal, deal_id)
-            if d:
-                d.closed = True
-                await session.commit()
-
-async def delete_deal(deal_id: int) -> None:
-    async with AsyncSessionLocal() as session:
-        async with session.begin():
-            d = await session.get(Deal, deal_id)
-            if d:
-                await session.delete(d)
-                await session.commit()
-
-async def upsert_user_state(username: str, state: str) -> None:
-    async with AsyncSessionLocal() as session:
-        async with session.begin():
-            u = await session.get(User, username)
-            if u:
-                u.state = state
-                await session.commit()
-
-async def get_user_state(username: str) -> Optional[str]:
-    async with AsyncSessionLocal() as session:
-        u = await session.get(User, username)
-        if u:
-            return u.state
-        return None
+async def get_open_deals_for_user(user_id: int, session: Optional[AsyncSession] = None):
+    """Только незакрытые сделки пользователя - то, по чему можно совершить действие.
+
+    Две ветки UNION ALL читают частичные индексы ix_deals_open_*; OR по двум
+    колонкам SQLite с частичными индексами не сочетает. Сделка, где пользователь
+    и продавец, и покупатель, попадает только в первую ветку.
+    """
+    is_open = Deal.status < DealStatus.CLOSED
+    as_seller = select(Deal).where(Deal.seller_id == user_id, is_open)
+    as_buyer = select(Deal).where(Deal.buyer_id == user_id, Deal.seller_id != user_id, is_open)
+    async with read_scope(session) as s:
+        rows = await s.execute(select(Deal).from_statement(union_all(as_seller, as_buyer)))
+        return [_deal_as_dict(d) for d in rows.scalars().all()]
+
+# Колонки, которых достаточно для построения клавиатуры действий
+DEAL_KEYBOARD_COLUMNS = ('deal_id', 'seller_id', 'buyer_id', 'deposited', 'closed', 'buyer_wallet')
+
+
+async def fetch_deals_for_user(
+    user_id: int,
+    columns: Optional[Sequence[str]] = None,
+    open_only: bool = False,
+    session: Optional[AsyncSession] = None,
+) -> list[Row]:
+    """Быстрый путь только для чтения: Core select без ORM-объектов и промежуточных dict.
+
+    Возвращает sqlalchemy Row - компактные кортежи (__slots__) с доступом по имени
+    атрибута (row.deal_id). columns ограничивает выборку нужными колонками.
+    open_only читает только незакрытые сделки по частичным индексам.
+    """
+    table = Deal.__table__
+    selected = [table.c[name] for name in columns] if columns else list(table.c)
+    if open_only:
+        is_open = table.c.status < DealStatus.CLOSED
+        stmt = union_all(
+            select(*selected).where(table.c.seller_id == user_id, is_open),
+            select(*selected).where(table.c.buyer_id == user_id, table.c.seller_id != user_id, is_open),
+        )
+    else:
+        stmt = select(*selected).where(or_(table.c.seller_id == user_id, table.c.buyer_id == user_id))
+    async with read_scope(session) as s:
+        result = await s.execute(stmt)
+        return result.all()
+
+
+# Колонки для постраничного списка сделок (история, /my_deals, debug-меню)
+DEAL_PAGE_COLUMNS = ('deal_id', 'seller_id', 'buyer_id', 'crypto_amount', 'fiat_amount', 'deposited', 'status')
+DEAL_PAGE_ROLES = ('seller', 'buyer')
+DEAL_PAGE_STATUSES = ('open', 'closed')
+
+
+async def get_deals_page(
+    user_id: int,
+    cursor: Optional[int] = None,
+    direction: str = 'next',
+    limit: int = 10,
+    status: Optional[str] = None,
+    role: Optional[str] = None,
+    columns: Sequence[str] = DEAL_PAGE_COLUMNS,
+    include_archived: bool = False,
+    session: Optional[AsyncSession] = None,
+) -> dict:
+    """Keyset-пагинация сделок пользователя от новых к старым.
+
+    cursor - deal_id граничной сделки текущей страницы: для direction='next'
+    это последняя (самая старая) сделка, для 'prev' - первая. Страница читается
+    диапазоном по индексу (seller_id, deal_id) / (buyer_id, deal_id) без OFFSET,
+    поэтому стоимость не зависит от глубины листания.
+
+    status: None | 'open' | 'closed'; role: None | 'seller' | 'buyer'.
+    include_archived подмешивает deals_archive теми же ветками (открытых сделок там нет),
+    строки тогда получают дополнительную колонку deleted.
+    Возвращает {'rows': [Row, ...], 'has_next': bool, 'has_prev': bool}.
+    """
+    if direction not in ('next', 'prev'):
+        raise ValueError(f"Неизвестное направление: {direction}")
+    if role is not None and role not in DEAL_PAGE_ROLES:
+        raise ValueError(f"Неизвестная роль: {role}")
+    if status is not None and status not in DEAL_PAGE_STATUSES:
+        raise ValueError(f"Неизвестный фильтр статуса: {status}")
+
+    forward = direction == 'next'
+    tables = [Deal.__table__]
+    if include_archived and status != 'open':
+        tables.append(DealArchive.__table__)
+
+    # Каждая ветка сама ограничена limit + 1 строками, лишняя строка - признак следующей страницы
+    branches = []
+    for table in tables:
+        filters = []
+        if cursor is not None:
+            filters.append(table.c.deal_id < cursor if forward else table.c.deal_id > cursor)
+        if status == 'open':
+            filters.append(table.c.status < DealStatus.CLOSED)
+        elif status == 'closed':
+            filters.append(table.c.status == DealStatus.CLOSED)
+        order = table.c.deal_id.desc() if forward else table.c.deal_id.asc()
+        selected = [table.c[name] for name in columns]
+        if include_archived:
+            selected.append(table.c.deleted if table is DealArchive.__table__ else literal(False).label('deleted'))
+        if role in (None, 'seller'):
+            branches.append(select(*selected).where(table.c.seller_id == user_id, *filters).order_by(order).limit(limit + 1))
+        if role in (None, 'buyer'):
+            buyer_filters = [] if role == 'buyer' else [table.c.seller_id != user_id]
+            branches.append(select(*selected).where(table.c.buyer_id == user_id, *buyer_filters, *filters).order_by(order).limit(limit + 1))
+
+    if len(branches) == 1:
+        stmt = branches[0]
+    else:
+        merged = union_all(*(select(branch.subquery()) for branch in branches)).subquery()
+        merged_order = merged.c.deal_id.desc() if forward else merged.c.deal_id.asc()
+        stmt = select(merged).order_by(merged_order).limit(limit + 1)
+
+    async with read_scope(session) as s:
+        rows = (await s.execute(stmt)).all()
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if forward:
+        return {'rows': rows, 'has_next': more, 'has_prev': cursor is not None}
+    rows.reverse()
+    return {'rows': rows, 'has_next': cursor is not None, 'has_prev': more}
+
+
+DEAL_EXPORT_CHUNK = int(getenv('DEAL_EXPORT_CHUNK', '1000'))
+
+
+async def stream_deals(
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    status: Optional[str] = None,
+    include_archived: bool = False,
+    chunk_size: int = DEAL_EXPORT_CHUNK,
+) -> AsyncIterator[list[dict]]:
+    """Все сделки пачками по chunk_size строк для выгрузки, без загрузки таблицы в память.
+
+    Строки читаются серверным курсором (yield_per) из отдельной сессии read-only пула:
+    выгрузка может идти долго и не должна держать соединение апдейта.
+    since/until - границы created_at (unix-время, until не включается); с ними строки идут
+    диапазоном по ix_deals_created_at в порядке (created_at, deal_id), без них - в порядке deal_id.
+    status: None | 'open' | 'closed'. include_archived добавляет после deals строки deals_archive
+    (с колонками deleted и archived_at; у строк deals - False и None).
+    """
+    if status is not None and status not in DEAL_PAGE_STATUSES:
+        raise ValueError(f"Неизвестный фильтр статуса: {status}")
+
+    tables = [Deal.__table__]
+    if include_archived and status != 'open':
+        tables.append(DealArchive.__table__)
+
+    async with ReadSessionLocal() as s:
+        for table in tables:
+            filters = []
+            if since is not None:
+                filters.append(table.c.created_at >= since)
+            if until is not None:
+                filters.append(table.c.created_at < until)
+            if status == 'open':
+                filters.append(table.c.status < DealStatus.CLOSED)
+            elif status == 'closed':
+                filters.append(table.c.status == DealStatus.CLOSED)
+            order = [table.c.deal_id]
+            if since is not None or until is not None:
+                # Порядок индекса по created_at: иначе SQLite сортировал бы весь диапазон во временном B-дереве
+                order.insert(0, table.c.created_at)
+            selected = list(Deal.__table__.columns.keys())
+            if include_archived:
+                selected += ['deleted', 'archived_at']
+            missing = {'deleted': False, 'archived_at': None}
+            columns = [table.c[name] if name in table.c else literal(missing[name]).label(name) for name in selected]
+            stmt = select(*columns).where(*filters).order_by(*order).execution_options(yield_per=chunk_size)
+            result = await s.stream(stmt)
+            async for partition in result.mappings().partitions():
+                yield [dict(row) for row in partition]
+
+
+DEAL_UPDATABLE_FIELDS = ('seller_id', 'buyer_id', 'crypto_amount', 'fiat_amount', 'payment_details', 'deposited', 'fiat_confirmed', 'buyer_wallet')
+
+
+DEAL_LIFECYCLE_FIELDS = ('closed', 'fiat_confirmed', 'deposited', 'buyer_wallet')
+
+
+def _deal_status_expr(values: dict):
+    """Выражение нового статуса для UPDATE: записываемые значения берутся из values,
+    остальные - из текущей строки (в SET SQLite видит старые значения колонок)."""
+    def field(name):
+        return literal(values[name]) if name in values else getattr(Deal, name)
+
+    return case(
+        (field('closed').is_(True), int(DealStatus.CLOSED)),
+        (field('fiat_confirmed').is_(True), int(DealStatus.CONFIRMED)),
+        (field('deposited').is_(True), int(DealStatus.DEPOSITED)),
+        (field('buyer_wallet').is_not(None), int(DealStatus.ACCEPTED)),
+        else_=int(DealStatus.NEW),
+    )
+
+
+def _with_status(values: dict) -> dict:
+    if any(name in values for name in DEAL_LIFECYCLE_FIELDS):
+        status = _deal_status_expr(values)
+        values = {
+            **values,
+            'status': status,
+            'status_at': case((status != Deal.status, int(time.time())), else_=Deal.status_at),
+        }
+        if values.get('closed') is True:
+            # _update_deals закрывает только строки без closed_at
+            values['closed_at'] = int(time.time())
+    return values
+
+
+def _deal_condition(name: str, value):
+    """Условие на поле сделки для compare-and-set.
+
+    False означает "не True": старые строки могли сохранить NULL вместо False.
+    """
+    column = getattr(Deal, name)
+    if value is None:
+        return column.is_(None)
+    if value is False:
+        return column.is_not(True)
+    return column == value
+
+
+async def _update_deals(s, conditions: list, values: dict) -> int:
+    """UPDATE с RETURNING: новые строки сразу уходят в deal_cache (после коммита)."""
+    if 'closed' in values and values['closed'] is not True:
+        # Открыть закрытую сделку заново нельзя: closed_at и deal_stats остались бы от закрытия
+        raise ValueError("Сделку можно только закрыть: closed=True")
+    closing = 'closed' in values
+    if closing:
+        # Закрытие - однократный переход: иначе объём сделки попал бы в deal_stats дважды.
+        # closed_at пишется только при первом закрытии, поэтому строка с ним уже учтена
+        conditions = [*conditions, _deal_condition('closed', False), Deal.closed_at.is_(None)]
+    if 'seller_id' in values or 'buyer_id' in values:
+        # Прежние участники теряют кнопки сделки; RETURNING вернёт только новых
+        previous = await s.execute(select(Deal.seller_id, Deal.buyer_id).where(*conditions))
+        for seller_id, buyer_id in previous:
+            _invalidate_keyboards(s, seller_id, buyer_id)
+    stmt_values = _with_status(values)
+    stmt = (
+        update(Deal)
+        .where(*conditions)
+        .values(**stmt_values)
+        .returning(*Deal.__table__.columns)
+    )
+    rows = (await s.execute(stmt)).mappings().all()
+    kind = _deal_event_kind(values)
+    # Производные колонки (status, status_at, closed_at) попадают в событие уже вычисленными
+    derived = [name for name in ('status', 'status_at', 'closed_at') if name in stmt_values]
+    for row in rows:
+        _write_through(s, deal_cache, row['deal_id'], dict(row))
+        _invalidate_keyboards(s, row['seller_id'], row['buyer_id'])
+        _record_deal_event(s, row['deal_id'], kind, {**values, **{name: row[name] for name in derived}})
+        if closing:
+            _record_closed_deal(s, row)
+    return len(rows)
+
+async def update_deal(deal_id: int, session: Optional[AsyncSession] = None, **kwargs) -> int:
+    """Один UPDATE по deal_id. Возвращает число изменённых строк (0 - сделки нет)."""
+    values = {name: value for name, value in kwargs.items() if name in DEAL_UPDATABLE_FIELDS}
+    if not values:
+        return 0
+    async with session_scope(session) as s:
+        return await _update_deals(s, [Deal.deal_id == deal_id], values)
+
+async def transition_deal(deal_id: int, expected: dict, session: Optional[AsyncSession] = None, **values) -> bool:
+    """Compare-and-set: меняет поля сделки, только если текущие значения совпадают с expected.
+
+    Проверка и запись выполняются одним UPDATE, поэтому из двух конкурентных
+    переходов применится ровно один, второй получит False.
+    """
+    conditions = [_deal_condition(name, value) for name, value in expected.items()]
+    async with session_scope(session) as s:
+        return await _update_deals(s, [Deal.deal_id == deal_id, *conditions], values) == 1
+
+async def try_deposit_deal(deal_id: int, seller_id: Optional[int] = None, session: Optional[AsyncSession] = None) -> bool:
+    """Отмечает депозит, если он ещё не внесён и сделка не закрыта."""
+    expected = {'deposited': False, 'closed': False}
+    if seller_id is not None:
+        expected['seller_id'] = seller_id
+    return await transition_deal(deal_id, expected, session=session, deposited=True)
+
+async def try_confirm_deal(deal_id: int, seller_id: Optional[int] = None, session: Optional[AsyncSession] = None) -> bool:
+    """Подтверждает получение фиата, если депозит внесён и подтверждения ещё не было."""
+    expected = {'deposited': True, 'fiat_confirmed': False, 'closed': False}
+    if seller_id is not None:
+        expected['seller_id'] = seller_id
+    return await transition_deal(deal_id, expected, session=session, fiat_confirmed=True)
+
+async def update_deal_buyer_wallet(deal_id: int, wallet: str, session: Optional[AsyncSession] = None) -> int:
+    return await update_deal(deal_id, session=session, buyer_wallet=wallet)
+
+async def set_deal_deposited(deal_id: int, value: bool = True, session: Optional[AsyncSession] = None) -> int:
+    return await update_deal(deal_id, session=session, deposited=value)
+
+async def close_deal(deal_id: int, session: Optional[AsyncSession] = None) -> int:
+    # closed не входит в DEAL_UPDATABLE_FIELDS: закрыть сделку можно только здесь или через transition_deal
+    async with session_scope(session) as s:
+        return await _update_deals(s, [Deal.deal_id == deal_id], {'closed': True})
+
+def _archive_from_select(conditions: list, deleted: bool, archived_at: int):
+    """INSERT INTO deals_archive SELECT ... FROM deals WHERE conditions."""
+    columns = [column.name for column in Deal.__table__.columns]
+    source = select(
+        *Deal.__table__.columns, literal(deleted).label('deleted'), literal(archived_at).label('archived_at')
+    ).where(*conditions)
+    return insert(DealArchive.__table__).from_select([*columns, 'deleted', 'archived_at'], source)
+
 
-async def update_user(username: str, **kwargs) -> None:
-    async with AsyncSessionLocal() as session:
-        async with session.begin():
-            u = await session.get(User, username)
-            if u:
-                for name, value in kwargs.items():
-                    if name in ['user_id', 'wallet', 'state']:
-                        setattr(u, name, value)
-
-async def get_deal_id_by_buyer_id(buyer_id: int):
-    async with AsyncSessionLocal() as session:
+async def delete_deal(deal_id: int, expected: Optional[dict] = None, session: Optional[AsyncSession] = None) -> int:
+    """Удаляет сделку по deal_id; expected задаёт дополнительные условия (например, {'deposited': False}).
+
+    Строка не теряется: в той же транзакции она копируется в deals_archive с deleted=1.
+    Запись в архив первой берёт блокировку записи, так что условие не может
+    измениться между INSERT и DELETE.
+    """
+    conditions = [Deal.deal_id == deal_id, *(_deal_condition(name, value) for name, value in (expected or {}).items())]
+    async with session_scope(session) as s:
+        archive = _archive_from_select(conditions, deleted=True, archived_at=int(time.time()))
+        archived = (await s.execute(
+            archive.returning(DealArchive.status, DealArchive.seller_id, DealArchive.buyer_id)
+        )).one_or_none()
+        if archived is None:
+            return 0
+        result = await s.execute(delete(Deal).where(*conditions))
+        _invalidate(s, deal_cache, deal_id)
+        _invalidate_keyboards(s, archived.seller_id, archived.buyer_id)
+        _record_deal_event(s, deal_id, 'deleted', {'deleted': True})
+        if archived.status < DealStatus.CLOSED:
+            _record_deal_stats(s, time.time(), cancelled=1)
+        return result.rowcount
+
+async def get_deal_events(deal_id: int, until: Optional[float] = None, session: Optional[AsyncSession] = None) -> list[dict]:
+    """События сделки в порядке записи; until (unix-время) отсекает более поздние."""
+    async with read_scope(session) as s:
+        # Ещё не записанные события этой же сессии тоже должны попасть в выборку
+        await s.run_sync(_flush_deal_events)
+        stmt = select(DealEvent.__table__).where(DealEvent.deal_id == deal_id)
+        if until is not None:
+            stmt = stmt.where(DealEvent.ts <= until)
+        stmt = stmt.order_by(DealEvent.ts, DealEvent.event_id)
+        return [dict(row) for row in (await s.execute(stmt)).mappings()]
+
+
+def fold_deal_events(events: Sequence[dict]) -> Optional[dict]:
+    """Состояние сделки после применения событий по порядку; None, если событий нет."""
+    state = None
+    for e in events:
+        if e['kind'] in ('created', 'snapshot'):
+            state = dict(e['data'])
+        elif state is None:
+            state = {'deal_id': e['deal_id'], **e['data']}
+        else:
+            state.update(e['data'])
+    return state
+
+
+async def replay_deal(deal_id: int, at: Optional[float] = None, session: Optional[AsyncSession] = None) -> Optional[dict]:
+    """Состояние сделки на момент at (unix-время, по умолчанию - текущее) по журналу событий.
+
+    Один диапазонный запрос по ix_deal_events_deal_id_ts; работает и для архивных/удалённых сделок.
+    """
+    return fold_deal_events(await get_deal_events(deal_id, until=at, session=session))
+
+
+async def get_deal_stats(days: int = 30, session: Optional[AsyncSession] = None) -> dict:
+    """Агрегаты из deal_stats: {'days': {'YYYY-MM-DD': {...}} за последние days дней, 'total': {...}}.
+
+    Читает не больше days + 1 строк по первичному ключу, независимо от длины истории.
+    Дни без сделок в 'days' отсутствуют.
+    """
+    now = time.time()
+    since, today = stats_day(now - (days - 1) * 86400), stats_day(now)
+    stmt = select(DealStats.__table__).where(
+        or_(DealStats.day == DEAL_STATS_TOTAL, DealStats.day.between(since, today))
+    )
+    async with read_scope(session) as s:
+        rows = {row['day']: dict(row) for row in (await s.execute(stmt)).mappings()}
+    empty = {'day': DEAL_STATS_TOTAL, **dict.fromkeys(DEAL_STATS_COUNTERS, 0)}
+    return {'days': {day: row for day, row in sorted(rows.items()) if day != DEAL_STATS_TOTAL},
+            'total': rows.get(DEAL_STATS_TOTAL, empty)}
+
+
+async def upsert_user_state(user_id: int, state: Optional[str], session: Optional[AsyncSession] = None) -> None:
+    await update_user(user_id, state=state, session=session)
+
+async def get_user_state(user_id: int, session: Optional[AsyncSession] = None) -> Optional[str]:
+    user = await get_user(user_id, session=session)
+    if user:
+        return user['state']
+    return None
+
+async def update_user(user_id: int, session: Optional[AsyncSession] = None, **kwargs) -> None:
+    values = {name: value for name, value in kwargs.items() if name in ('wallet', 'state')}
+    if not values:
+        return
+    async with session_scope(session) as s:
+        result = await s.execute(update(User).where(User.user_id == user_id).values(**values))
+        if result.rowcount:
+            _invalidate_user(s, user_id)
+
+# --- Хранилище aiogram FSM (regular_bot.storage) ---
+
+async def load_fsm_states(session: Optional[AsyncSession] = None) -> list[Row]:
+    """(user_id, state, fsm_data) всех пользователей с непустым FSM - по частичному индексу ix_users_fsm."""
+    stmt = select(User.user_id, User.state, User.fsm_data).where(text(FSM_STATE_CONDITION))
+    async with read_scope(session) as s:
+        return (await s.execute(stmt)).all()
+
+
+async def get_fsm_state(user_id: int, session: Optional[AsyncSession] = None) -> Optional[Row]:
+    """(state, fsm_data) пользователя; None, если строки нет."""
+    stmt = select(User.state, User.fsm_data).where(User.user_id == user_id)
+    async with read_scope(session) as s:
+        return (await s.execute(stmt)).one_or_none()
+
+
+async def save_fsm_states(rows: Sequence[dict], session: Optional[AsyncSession] = None) -> None:
+    """Пачка {'user_id', 'state', 'fsm_data'} одним executemany-upsert.
+
+    Строка пользователя создаётся, если её ещё нет (FSM может начаться до /start).
+    """
+    if not rows:
+        return
+    stmt = sqlite_insert(User.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.user_id],
+        set_={'state': stmt.excluded.state, 'fsm_data': stmt.excluded.fsm_data},
+    )
+    async with session_scope(session) as s:
+        await s.execute(stmt, list(rows))
+        for row in rows:
+            _invalidate_user(s, row['user_id'])
+
+
+# Статусы, у которых идёт срок: NEW - accept-by, ACCEPTED - deposit-by, DEPOSITED - confirm-by
+DEADLINE_STATUSES = (DealStatus.NEW, DealStatus.ACCEPTED, DealStatus.DEPOSITED)
+
+
+async def get_deals_with_deadlines(session: Optional[AsyncSession] = None) -> list[Row]:
+    """(deal_id, seller_id, buyer_id, status, status_at) открытых сделок со сроком.
+
+    Читается по частичному индексу ix_deals_open_status_at: стоимость зависит
+    только от числа открытых сделок.
+    """
+    stmt = (
+        select(Deal.deal_id, Deal.seller_id, Deal.buyer_id, Deal.status, Deal.status_at)
+        .where(Deal.status < DealStatus.CLOSED, Deal.status <= max(DEADLINE_STATUSES))
+    )
+    async with read_scope(session) as s:
+        return (await s.execute(stmt)).all()
+
+
+async def expire_deals(items: Sequence[tuple[int, int]], session: Optional[AsyncSession] = None) -> list[int]:
+    """Отменяет просроченные сделки пачкой: (deal_id, ожидаемый status) в одной транзакции.
+
+    Сделка, успевшая сменить статус, не трогается. Возвращает id отменённых сделок.
+    """
+    expired = []
+    async with session_scope(session) as s:
+        for deal_id, status in items:
+            if await delete_deal(deal_id, expected={'status': status}, session=s):
+                expired.append(deal_id)
+    return expired
+
+
+async def get_deal_id_by_buyer_id(buyer_id: int, session: Optional[AsyncSession] = None):
+    async with read_scope(session) as s:
         stmt = select(Deal.deal_id).where(Deal.buyer_id == buyer_id).order_by(Deal.deal_id.desc()).limit(1)
-        result = await session.execute(stmt)
+        result = await s.execute(stmt)
         deal_id = result.scalar_one_or_none()
         return deal_id
     
-async def get_user_wallet_by_user_id(user_id: int) -> Optional[str]:
-    async with AsyncSessionLocal() as session:
-        stmt = select(User).where(User.user_id == user_id)
-        result = await session.execute(stmt)
-        user = result.scalar_one_or_none()
-        return user.wallet if user else None
+async def get_user_wallet_by_user_id(user_id: int, session: Optional[AsyncSession] = None) -> Optional[str]:
+    user = await get_user(user_id, session=session)
+    if user:
+        return user['wallet']
+    return None
+
+
+# Групповой коммит: вместо отдельной транзакции (и fsync) на каждый вызов
+# записи из разных хендлеров копятся max_delay секунд или до max_batch штук
+# и применяются одной транзакцией. Если пачка падает, операции повторяются
+# по одной, так что ошибка одной не откатывает остальные.
+class WriteActor:
+    """Write-behind актор: submit() возвращает результат только после коммита пачки."""
+
+    def __init__(self, max_delay: float = 0.005, max_batch: int = 100):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.operations = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Дописывает уже поставленные в очередь операции и останавливает актор."""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Ставит fn(*args, session=..., **kwargs) в очередь и ждёт её durable-результат."""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((fn, args, kwargs, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._apply(batch)
+            if stopping:
+                return
+
+    async def _apply(self, batch: list) -> None:
+        try:
+            results = await self._commit_batch(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                self._resolve(batch, [(None, e)])
+                return
+            # Пачка откатилась целиком; повторяем операции по одной, чтобы ошибка
+            # досталась только виновнику, а остальные всё же записались
+            logging.warning(f"Групповой коммит не удался ({e}), операции применяются по одной")
+            for item in batch:
+                await self._apply([item])
+            return
+        self.batches += 1
+        self.operations += len(batch)
+        self._resolve(batch, [(result, None) for result in results])
+
+    async def _commit_batch(self, batch: list) -> list:
+        async with AsyncSessionLocal() as s:
+            # BEGIN IMMEDIATE сразу берёт блокировку записи: транзакция не упрётся
+            # в SQLITE_BUSY при переходе от чтения к записи посреди пачки
+            await s.execute(text("BEGIN IMMEDIATE"))
+            results = [await fn(*args, session=s, **kwargs) for fn, args, kwargs, _ in batch]
+            await s.commit()
+            return results
+
+    @staticmethod
+    def _resolve(batch: list, outcomes: list) -> None:
+        for (*_, future), (result, error) in zip(batch, outcomes):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+DB_WRITE_BATCHING = getenv('DB_WRITE_BATCHING', '0') == '1'
+write_actor = WriteActor(
+    max_delay=float(getenv('DB_WRITE_BATCH_DELAY', '0.005')),
+    max_batch=int(getenv('DB_WRITE_BATCH_SIZE', '100')),
+)
+
+
+async def submit_write(fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+    """Запись через групповой коммит, если актор запущен, иначе обычный вызов со своим коммитом."""
+    if write_actor.running:
+        return await write_actor.submit(fn, *args, **kwargs)
+    return await fn(*args, **kwargs)
+
+
+# --- Архив закрытых сделок ---
+
+DEAL_ARCHIVE_AFTER = float(getenv('DEAL_ARCHIVE_AFTER_DAYS', '30')) * 86400
+DEAL_ARCHIVE_INTERVAL = float(getenv('DEAL_ARCHIVE_INTERVAL', '3600'))
+DEAL_ARCHIVE_BATCH = int(getenv('DEAL_ARCHIVE_BATCH', '500'))
+DEAL_ARCHIVE_VACUUM_PAGES = int(getenv('DEAL_ARCHIVE_VACUUM_PAGES', '1000'))
+# Одноразовый полный VACUUM при старте архиватора для файлов, созданных без auto_vacuum
+DEAL_ARCHIVE_VACUUM_CONVERT = getenv('DEAL_ARCHIVE_VACUUM_CONVERT', '0') == '1'
+
+
+async def archive_deals(older_than: float = DEAL_ARCHIVE_AFTER, batch_size: int = DEAL_ARCHIVE_BATCH) -> int:
+    """Переносит одну пачку закрытых раньше older_than секунд назад сделок в deals_archive.
+
+    Отбор идёт по частичному индексу ix_deals_closed_at (closed проверяется отдельно:
+    открытая сделка не должна пропасть у сторон, даже если closed_at остался), перенос (INSERT ... SELECT + DELETE)
+    выполняется одной короткой транзакцией. Возвращает число перенесённых сделок.
+    """
+    now = int(time.time())
+    cutoff = now - older_than
+    async with AsyncSessionLocal() as s:
+        await s.execute(text("BEGIN IMMEDIATE"))
+        ids = (await s.execute(
+            select(Deal.deal_id)
+            .where(Deal.closed_at.is_not(None), Deal.closed_at < cutoff, Deal.closed.is_(True))
+            .order_by(Deal.closed_at)
+            .limit(batch_size)
+        )).scalars().all()
+        if not ids:
+            await s.rollback()
+            return 0
+        await s.execute(_archive_from_select([Deal.deal_id.in_(ids)], deleted=False, archived_at=now))
+        await s.execute(delete(Deal).where(Deal.deal_id.in_(ids)))
+        for deal_id in ids:
+            _invalidate(s, deal_cache, deal_id)
+        await s.commit()
+        return len(ids)
+
+
+async def enable_incremental_vacuum() -> bool:
+    """Одноразово переводит существующий файл в auto_vacuum=INCREMENTAL (полный VACUUM).
+
+    Новые файлы получают режим из профиля 'tuned'; для старых режим применяется только
+    после VACUUM, который переписывает весь файл и блокирует БД, поэтому вызывается явно.
+    """
+    # VACUUM нельзя выполнить внутри транзакции
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+        if (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar() == 2:
+            return False
+        await conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        await conn.exec_driver_sql("VACUUM")
+        return True
+
+
+async def incremental_vacuum(pages: int = DEAL_ARCHIVE_VACUUM_PAGES) -> int:
+    """Возвращает ОС до pages свободных страниц; без auto_vacuum=INCREMENTAL ничего не делает.
+
+    Возвращает число освобождённых страниц.
+    """
+    async with engine.connect() as conn:
+        if (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar() != 2:
+            return 0
+        before = (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+        if not before:
+            return 0
+        # Через execute() sqlite3 освобождает одну страницу за вызов: прагма
+        # возвращает строки, а курсор не дочитывается. executescript выполняет её целиком.
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        after = (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+        return before - after
+
+
+async def run_deal_archiver(
+    older_than: float = DEAL_ARCHIVE_AFTER,
+    interval: float = DEAL_ARCHIVE_INTERVAL,
+    batch_size: int = DEAL_ARCHIVE_BATCH,
+    vacuum_pages: int = DEAL_ARCHIVE_VACUUM_PAGES,
+) -> None:
+    """Фоновая задача: раз в interval секунд переносит старые сделки пачками и сжимает файл.
+
+    Между пачками уступает event loop, чтобы не задерживать обработку апдейтов.
+    """
+    if DEAL_ARCHIVE_VACUUM_CONVERT and await enable_incremental_vacuum():
+        logging.info("Файл БД переведён в auto_vacuum=INCREMENTAL")
+    while True:
+        try:
+            moved = 0
+            while True:
+                batch = await archive_deals(older_than, batch_size)
+                moved += batch
+                if batch < batch_size:
+                    break
+                await asyncio.sleep(0)
+            freed = await incremental_vacuum(vacuum_pages) if moved else 0
+            if moved:
+                logging.info(f"Архив: перенесено сделок {moved}, освобождено страниц {freed}")
+        except Exception:
+            logging.exception("Архиватор сделок завершился с ошибкой")
+        await asyncio.sleep(interval)
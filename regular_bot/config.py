@@ -16,4 +16,43 @@ INNER_BOT = getenv("INNER_BOT")
 BOT_WALLET_ADDRESS = getenv("BOT_WALLET_ADDRESS")
 ADMIN_IDS = list(map(int, getenv("ADMIN_IDS", "").split(","))) if getenv("ADMIN_IDS") else []
 
-__all__ = ["TOKEN", "NETWORK", "OUTER_BOT", "OUTER_BOT_USERNAME", "WALLET_BOT", "INNER_BOT", "ADMIN_IDS"]
\ No newline at end of file
+# Сроки сделок в секундах: accept-by и deposit-by отменяют сделку,
+# confirm-by (депозит уже внесён) только напоминает продавцу
+DEAL_ACCEPT_TIMEOUT = int(getenv("DEAL_ACCEPT_TIMEOUT", str(24 * 3600)))
+DEAL_DEPOSIT_TIMEOUT = int(getenv("DEAL_DEPOSIT_TIMEOUT", str(24 * 3600)))
+DEAL_CONFIRM_TIMEOUT = int(getenv("DEAL_CONFIRM_TIMEOUT", str(48 * 3600)))
+# Брошенный мастер /new_deal и ожидание кнопки от wallet-бота сбрасываются по таймауту
+DEAL_DRAFT_TIMEOUT = int(getenv("DEAL_DRAFT_TIMEOUT", str(30 * 60)))
+STALE_STATE_TIMEOUT = int(getenv("STALE_STATE_TIMEOUT", str(10 * 60)))
+
+# FSM в БД (regular_bot.storage): сколько записей держать в памяти
+# и как часто дописывать изменения в users (секунды)
+FSM_CACHE_SIZE = int(getenv("FSM_CACHE_SIZE", "10000"))
+FSM_FLUSH_INTERVAL = float(getenv("FSM_FLUSH_INTERVAL", "1.0"))
+# Сколько сообщений wallet-бота с кнопками держать в памяти в ожидании нажатия
+WALLET_INTERACTIONS_MAX = int(getenv("WALLET_INTERACTIONS_MAX", "1000"))
+
+# Получение апдейтов: "polling" (getUpdates) или "webhook" (локальный aiohttp-сервер за WEBHOOK_URL)
+BOT_MODE = getenv("BOT_MODE", "polling")
+WEBHOOK_URL = getenv("WEBHOOK_URL")
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(getenv("WEBHOOK_PORT", "8080"))
+# Telegram присылает его в X-Telegram-Bot-Api-Secret-Token; без него вебхук не запускается
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET")
+# Сколько апдейтов обрабатывается одновременно (в обоих режимах)
+UPDATES_CONCURRENCY = int(getenv("UPDATES_CONCURRENCY", "32"))
+
+# Исходящие сообщения (regular_bot.outbox): лимиты Telegram - около 30 сообщений/с
+# на бота и 1 сообщение/с в один чат с короткими всплесками
+OUTBOX_GLOBAL_RATE = float(getenv("OUTBOX_GLOBAL_RATE", "30"))
+OUTBOX_CHAT_RATE = float(getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = float(getenv("OUTBOX_CHAT_BURST", "3"))
+OUTBOX_MAX_RETRIES = int(getenv("OUTBOX_MAX_RETRIES", "5"))
+
+__all__ = ["TOKEN", "NETWORK", "OUTER_BOT", "OUTER_BOT_USERNAME", "WALLET_BOT", "INNER_BOT", "ADMIN_IDS",
+           "DEAL_ACCEPT_TIMEOUT", "DEAL_DEPOSIT_TIMEOUT", "DEAL_CONFIRM_TIMEOUT", "DEAL_DRAFT_TIMEOUT",
+           "STALE_STATE_TIMEOUT", "FSM_CACHE_SIZE", "FSM_FLUSH_INTERVAL",
+           "WALLET_INTERACTIONS_MAX", "BOT_MODE", "WEBHOOK_URL", "WEBHOOK_PATH", "WEBHOOK_HOST", "WEBHOOK_PORT",
+           "WEBHOOK_SECRET", "UPDATES_CONCURRENCY", "OUTBOX_GLOBAL_RATE", "OUTBOX_CHAT_RATE", "OUTBOX_CHAT_BURST",
+           "OUTBOX_MAX_RETRIES"]
\ No newline at end of file
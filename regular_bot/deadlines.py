@@ -0,0 +1,157 @@
+import logging
+import time
+from typing import Any, Hashable, Optional
+
+from aiogram import Bot
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+from db import DealStatus, DEADLINE_STATUSES, deal_event_subscribers, expire_deals, get_deals_with_deadlines
+from scheduler import DeadlineScheduler
+from regular_bot.config import (
+    DEAL_ACCEPT_TIMEOUT,
+    DEAL_DEPOSIT_TIMEOUT,
+    DEAL_CONFIRM_TIMEOUT,
+    DEAL_DRAFT_TIMEOUT,
+    STALE_STATE_TIMEOUT,
+)
+from regular_bot.outbox import outbox, PRIORITY_CRITICAL
+from regular_bot.storage import SQLiteStorage
+
+logger = logging.getLogger(__name__)
+
+DEADLINE_BATCH_SIZE = 100
+
+# Статус -> срок в секундах от status_at. Для NEW и ACCEPTED сделка отменяется,
+# для DEPOSITED продавцу уходит напоминание и срок переносится ещё на тот же интервал
+DEAL_TIMEOUTS = {
+    DealStatus.NEW: DEAL_ACCEPT_TIMEOUT,
+    DealStatus.ACCEPTED: DEAL_DEPOSIT_TIMEOUT,
+    DealStatus.DEPOSITED: DEAL_CONFIRM_TIMEOUT,
+}
+EXPIRED_TEXT = {
+    DealStatus.NEW: "Сделка #{deal_id} отменена: покупатель не принял её вовремя.",
+    DealStatus.ACCEPTED: "Сделка #{deal_id} отменена: депозит не внесён вовремя.",
+}
+CONFIRM_REMINDER_TEXT = "Сделка #{deal_id} ждёт подтверждения получения фиата: /confirm {deal_id}"
+
+# Аргументы track_state (prefixes, timeout, notice) для состояний со сроком
+DRAFT_STATE_RESET = (('NewDeal:',), DEAL_DRAFT_TIMEOUT,
+                     "Черновик сделки сброшен: мастер /new_deal не был завершён вовремя.")
+BTC_STATE_RESET = (("waiting_btc_button",), STALE_STATE_TIMEOUT, None)
+STATE_RESETS = (DRAFT_STATE_RESET, BTC_STATE_RESET)
+
+
+class DealDeadlines:
+    """Сроки сделок и сброс устаревших состояний FSM на одном DeadlineScheduler.
+
+    Сроки сделок восстанавливаются из БД при старте и дальше следуют за журналом
+    событий (deal_event_subscribers): переход статуса переносит срок, закрытие
+    и удаление снимают его. Наступившие сроки обрабатываются пачками:
+    отмена - одной транзакцией, затем уведомления.
+    """
+
+    def __init__(self):
+        self.scheduler = DeadlineScheduler()
+        self.bot: Optional[Bot] = None
+        self.storage: Optional[BaseStorage] = None
+
+    async def start(self, bot: Bot, storage: BaseStorage) -> int:
+        """Загружает открытые сделки со сроком и запускает цикл. Возвращает число сроков."""
+        self.bot = bot
+        self.storage = storage
+        if self._on_deal_events not in deal_event_subscribers:
+            deal_event_subscribers.append(self._on_deal_events)
+        for row in await get_deals_with_deadlines():
+            self.track_deal(row.deal_id, row.status, row.status_at or time.time(), row.seller_id, row.buyer_id)
+        if isinstance(storage, SQLiteStorage):
+            # Состояния пережили перезапуск, а их сроки - нет: отсчёт начинается заново
+            for user_id, current in await storage.states():
+                for reset in STATE_RESETS:
+                    if current.startswith(reset[0]):
+                        self.track_state(StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id), *reset)
+        self.scheduler.start(self._fire, DEADLINE_BATCH_SIZE)
+        return len(self.scheduler)
+
+    async def stop(self) -> None:
+        await self.scheduler.stop()
+        if self._on_deal_events in deal_event_subscribers:
+            deal_event_subscribers.remove(self._on_deal_events)
+
+    def track_deal(self, deal_id: int, status: int, status_at: float,
+                   seller_id: Optional[int], buyer_id: Optional[int]) -> None:
+        key = ('deal', deal_id)
+        if status not in DEADLINE_STATUSES:
+            self.scheduler.cancel(key)
+            return
+        payload = {'status': DealStatus(status), 'seller_id': seller_id, 'buyer_id': buyer_id}
+        self.scheduler.schedule(key, status_at + DEAL_TIMEOUTS[status], payload)
+
+    def track_state(self, key: StorageKey, prefixes: tuple[str, ...], timeout: float,
+                    notice: Optional[str] = None) -> None:
+        """Сбросить состояние FSM через timeout секунд, если оно всё ещё начинается с prefixes."""
+        self.scheduler.schedule(('state', key), time.time() + timeout, {'prefixes': prefixes, 'notice': notice})
+
+    def _on_deal_events(self, events: list[dict]) -> None:
+        for e in events:
+            key = ('deal', e['deal_id'])
+            data = e['data']
+            if e['kind'] == 'created':
+                self.track_deal(e['deal_id'], data['status'], e['ts'], data['seller_id'], data['buyer_id'])
+            elif e['kind'] == 'deleted':
+                self.scheduler.cancel(key)
+            elif 'status' in data or 'buyer_id' in data:
+                current = self.scheduler.get(key)
+                payload = current[1] if current else {}
+                buyer_id = data.get('buyer_id', payload.get('buyer_id'))
+                if 'status' in data:
+                    self.track_deal(e['deal_id'], data['status'], e['ts'], payload.get('seller_id'), buyer_id)
+                elif current:
+                    self.scheduler.schedule(key, current[0], {**payload, 'buyer_id': buyer_id})
+
+    async def _fire(self, batch: list[tuple[Hashable, Any]]) -> None:
+        expiring = {}
+        reminders = []
+        for key, payload in batch:
+            if key[0] == 'state':
+                await self._reset_state(key[1], payload)
+            elif payload['status'] == DealStatus.DEPOSITED:
+                reminders.append((key[1], payload))
+            else:
+                expiring[key[1]] = payload
+
+        if expiring:
+            expired = await expire_deals([(deal_id, p['status']) for deal_id, p in expiring.items()])
+            logger.info(f"Expired deals: {expired}")
+            for deal_id in expired:
+                payload = expiring[deal_id]
+                text = EXPIRED_TEXT[payload['status']].format(deal_id=deal_id)
+                for chat_id in {payload['seller_id'], payload['buyer_id']} - {None}:
+                    await self._notify(chat_id, text)
+
+        for deal_id, payload in reminders:
+            await self._notify(payload['seller_id'], CONFIRM_REMINDER_TEXT.format(deal_id=deal_id))
+            self.scheduler.schedule(('deal', deal_id), time.time() + DEAL_CONFIRM_TIMEOUT, payload)
+
+    async def _reset_state(self, key: StorageKey, payload: dict) -> None:
+        current = await self.storage.get_state(key)
+        if not current or not current.startswith(payload['prefixes']):
+            return
+        data = await self.storage.get_data(key)
+        if data.get('interaction_id'):
+            # Сброшенный поток /btc больше не нажмёт кнопку: сообщение wallet-бота не нужно.
+            # Импорт здесь: regular_bot.wallet сам импортирует этот модуль
+            from regular_bot.wallet import take_interaction
+            take_interaction(data['interaction_id'])
+        await self.storage.set_state(key, None)
+        await self.storage.set_data(key, {})
+        if payload['notice']:
+            await self._notify(key.chat_id, payload['notice'])
+
+    async def _notify(self, chat_id: Optional[int], text: str) -> None:
+        if chat_id is None:
+            return
+        # Пачка отмен не ждёт Telegram; ошибки отправки (например, бот заблокирован) логирует outbox
+        outbox.send(chat_id, text, priority=PRIORITY_CRITICAL)
+
+
+deadlines = DealDeadlines()
@@ -0,0 +1,59 @@
+import csv
+import gzip
+import json
+import os
+import tempfile
+from datetime import datetime, timezone
+from typing import Optional
+
+from db import Deal, stream_deals
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+# Лимит Telegram на документ от бота
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+
+
+def parse_export_date(value: str) -> int:
+    """'YYYY-MM-DD' (UTC) -> unix-время начала дня."""
+    return int(datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+
+
+async def export_deals(
+    fmt: str = 'csv',
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    status: Optional[str] = None,
+    include_archived: bool = True,
+    compress: bool = False,
+) -> tuple[str, int]:
+    """Пишет сделки во временный файл пачками из stream_deals. Возвращает (путь, число строк).
+
+    В памяти одновременно только одна пачка, поэтому размер выгрузки ограничен диском,
+    а не RAM. Файл удаляет вызывающий.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    suffix = f".{fmt}.gz" if compress else f".{fmt}"
+    fd, path = tempfile.mkstemp(prefix='deals_', suffix=suffix)
+    os.close(fd)
+
+    columns = list(Deal.__table__.columns.keys())
+    if include_archived:
+        columns += ['deleted', 'archived_at']
+    opener = gzip.open if compress else open
+    count = 0
+    try:
+        with opener(path, 'wt', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns) if fmt == 'csv' else None
+            if writer:
+                writer.writeheader()
+            async for chunk in stream_deals(since=since, until=until, status=status, include_archived=include_archived):
+                if writer:
+                    writer.writerows(chunk)
+                else:
+                    f.writelines(json.dumps(row, ensure_ascii=False) + '\n' for row in chunk)
+                count += len(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, count
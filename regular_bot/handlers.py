@@ -9,17 +9,22 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     CallbackQuery,
-    BufferedInputFile
+    BufferedInputFile,
+    FSInputFile,
 )
 import logging
+import os
+import time
 from typing import Optional
 import re
 from telethon import TelegramClient
 from aiogram import F
 import asyncio
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from db import (
     upsert_user,
+    get_user,
     find_user_by_username,
     create_deal,
     get_deal_by_id,
@@ -30,10 +35,16 @@ from db import (
     delete_deal,
     close_deal,
     upsert_user_state,
-    update_deal,
     get_deal_id_by_buyer_id,
-    get_user_wallet_by_user_id
-
+    get_user_wallet_by_user_id,
+    try_deposit_deal,
+    try_confirm_deal,
+    submit_write,
+    DEAL_PAGE_ROLES,
+    DEAL_PAGE_STATUSES,
+    DEAL_STATS_COUNTERS,
+    get_deal_stats,
+    stats_day,
 )
 
 from regular_bot.states import (
@@ -45,10 +56,13 @@ from regular_bot.states import (
     GetWalletAddress,
     DebugStates,
 )
-from regular_bot.keyboards import get_dynamic_keyboard
+from regular_bot.keyboards import get_dynamic_keyboard, build_deals_page
 from regular_bot.config import ADMIN_IDS, INNER_BOT, BOT_WALLET_ADDRESS, WALLET_BOT
 from regular_bot.utils import to_entity
 from regular_bot.wallet import TelethonWalletAPI
+from regular_bot.deadlines import deadlines, DRAFT_STATE_RESET
+from regular_bot.outbox import outbox, PRIORITY_CRITICAL
+from regular_bot.export import EXPORT_FORMATS, EXPORT_MAX_BYTES, export_deals, parse_export_date
 
 logger = logging.getLogger(__name__)
 
@@ -60,6 +74,15 @@ def _is_admin(user_id: Optional[int]) -> bool:
         return False
     
 
+def _format_stats(label: str, rows: list[dict]) -> str:
+    total = {name: sum(row[name] for row in rows) for name in DEAL_STATS_COUNTERS}
+    return (
+        f"{label}: создано {total['created']}, закрыто {total['closed']}, отменено {total['cancelled']}\n"
+        f"Объём: {total['crypto_volume']:.8f} BTC, фиат {total['fiat_volume']:.2f}, "
+        f"комиссия {total['commission']:.2f}"
+    )
+
+
 def setup_handlers(router: Router, wallet_api: TelethonWalletAPI, client: TelegramClient) -> None:
     """Register all message handlers with the router.
     
@@ -70,71 +93,65 @@ def setup_handlers(router: Router, wallet_api: TelethonWalletAPI, client: Telegr
     '''Admin debug UI: /debug shows inline buttons which call callbacks.'''
 
     @router.message(CommandStart())
-    async def cmd_start(message: Message, state: FSMContext) -> None:
+    async def cmd_start(message: Message, state: FSMContext, session: AsyncSession) -> None:
         username_str = message.from_user.username
         if not username_str:
-            await message.answer("Пожалуйста, установите username в настройках Telegram и перезапустите бота с /start.")
+            outbox.send(message.chat.id, "Пожалуйста, установите username в настройках Telegram и перезапустите бота с /start.")
             return
 
-        # Принудительно создаем пользователя, если его нет
-        await upsert_user(username_str, message.from_user.id)
+        # Принудительно создаем пользователя, если его нет (через групповой коммит, если он включён)
+        await submit_write(upsert_user, username_str, message.from_user.id)
         
-        user = await find_user_by_username(username_str)
+        user = await get_user(message.from_user.id, session=session)
         wallet = user.get('wallet')
         
         if not wallet:
-            await message.answer(f"Привет @{username_str}, я Jescrow-bot, пожалуйста, отправь мне адрес твоего кошелька.",
-                                  reply_markup=await get_dynamic_keyboard(message.from_user.id, await state.get_state()))
+            outbox.send(message.chat.id, f"Привет @{username_str}, я Jescrow-bot, пожалуйста, отправь мне адрес твоего кошелька.",
+                        reply_markup=await get_dynamic_keyboard(message.from_user.id, state=await state.get_state(), session=session))
             await state.set_state(GetWalletAddress.waiting_for_address)
         else:
-            await message.answer(f'Привет @{username_str}, хочешь совершить сделку? используй /new_deal')
+            outbox.send(message.chat.id, f'Привет @{username_str}, хочешь совершить сделку? используй /new_deal')
 
     @router.message(GetWalletAddress.waiting_for_address)
-    async def handle_wallet_address(message: Message, state: FSMContext) -> None:
+    async def handle_wallet_address(message: Message, state: FSMContext, session: AsyncSession) -> None:
         address = message.text
         
         if len(address) != 42:
-            await message.answer('Не корректный адресс кошелька')
+            outbox.send(message.chat.id, 'Не корректный адресс кошелька')
         else:
-            await set_user_wallet(message.from_user.username, address)  # Исправлено: используем username вместо id
-            await message.answer(f"адрес кошелька установлен: {address}", reply_markup=await get_dynamic_keyboard(message.from_user.id, await state.get_state()))
+            await submit_write(set_user_wallet, message.from_user.id, address)
+            outbox.send(message.chat.id, f"адрес кошелька установлен: {address}", reply_markup=await get_dynamic_keyboard(message.from_user.id, state=await state.get_state(), session=session))
             await state.clear()
 
     @router.message(Command("new_deal"))
-    async def new_deal_start(message: Message, state: FSMContext) -> None:
-        deal_id = await create_deal(seller_id=message.from_user.id)
-        await state.update_data(deal_id=deal_id)
+    async def new_deal_start(message: Message, state: FSMContext, session: AsyncSession) -> None:
+        # Черновик сделки живёт в данных FSM; строка в deals появится одним INSERT
+        # в process_payment_details, брошенный мастер ничего не оставляет в БД
+        await state.set_data({})
         await state.set_state(NewDeal.buyer_username)
-        await message.answer("Введите username покупателя (с @, например @buyer).", reply_markup=await get_dynamic_keyboard(message.from_user.id, await state.get_state()))
+        deadlines.track_state(state.key, *DRAFT_STATE_RESET)
+        outbox.send(message.chat.id, "Введите username покупателя (с @, например @buyer).", reply_markup=await get_dynamic_keyboard(message.from_user.id, state=await state.get_state(), session=session))
 
     @router.message(NewDeal.buyer_username)
-    async def process_buyer_username(message: Message, state: FSMContext) -> None:
-        data = await state.get_data()
-        deal_id = data.get("deal_id")
-
-
+    async def process_buyer_username(message: Message, state: FSMContext, session: AsyncSession) -> None:
         if message.text == "Отмена":
-            await delete_deal(deal_id=deal_id)
             await state.clear()
-            await message.answer("окей отмена", reply_markup=await get_dynamic_keyboard(message.from_user.id, await state.get_state()))
+            outbox.send(message.chat.id, "окей отмена", reply_markup=await get_dynamic_keyboard(message.from_user.id, state=await state.get_state(), session=session))
             return
 
         if message.text.startswith('/'):
             await state.clear()
-            await message.answer('повторите команду')
+            outbox.send(message.chat.id, 'повторите команду')
 
         if message.text.startswith('@'):
             buyer_username = message.text.strip('@')
-            buyer = await find_user_by_username(buyer_username)
+            buyer = await find_user_by_username(buyer_username, session=session)
 
             if not buyer:
-                await message.answer("Покупатель не зарегистрирован в боте. Попросите его запустить /start.")
+                outbox.send(message.chat.id, "Покупатель не зарегистрирован в боте. Попросите его запустить /start.")
                 return
             
-            buyer_id = buyer['user_id']
-            deal_id = data.get('deal_id')
-            await update_deal(deal_id, buyer_id=buyer_username)
-            await state.update_data(buyer_username=buyer_username, buyer_id=buyer_username)
+            await state.update_data(buyer_username=buyer_username, buyer_id=buyer['user_id'])
             await state.set_state(NewDeal.crypto_amount)
 
             # Используем telethon_req вместо get_courses  
@@ -147,8 +164,8 @@ def setup_handlers(router: Router, wallet_api: TelethonWalletAPI, client: Telegr
                 course = int(course_parts[0] + course_parts[1] + cleaned_third_part)
                 logger.info(f"Course: {course}")
                 await state.update_data(course=course)
-            
-            await message.answer(f"Введите сумму крипты (в рублях) для сделки.\n{course_text}")
+
+            outbox.send(message.chat.id, f"Введите сумму крипты (в рублях) для сделки.\n{course_text}")
         else:
             await state.clear()
 
@@ -168,10 +185,10 @@ def setup_handlers(router: Router, wallet_api: TelethonWalletAPI, client: Telegr
                 [InlineKeyboardButton(text="Продать по курсу", callback_data="fiat:yes")],
                 ]
             )
-            await message.answer(f"продать по курсу {data.get('course')} руб:{raf_crypto_amount}btc?\n или введите новую свою сумму", reply_markup=kb)
+            outbox.send(message.chat.id, f"продать по курсу {data.get('course')} руб:{raf_crypto_amount}btc?\n или введите новую свою сумму", reply_markup=kb)
                 
         except ValueError:  
-            await message.answer("Неверный формат. Введите число.")
+            outbox.send(message.chat.id, "Неверный формат. Введите число.")
 
     @router.callback_query(F.data == "fiat:yes")
     async def confirm_deal(callback: CallbackQuery, state: FSMContext):
@@ -181,26 +198,20 @@ def setup_handlers(router: Router, wallet_api: TelethonWalletAPI, client: Telegr
 
         await state.update_data(fiat_amount=fiat_amount)
         await state.update_data(crypto_amount=crypto_amount)
-        await callback.message.answer("Введите детали оплаты фиата (банковские реквизиты и т.д.).")
+        outbox.send(callback.message.chat.id, "Введите детали оплаты фиата (банковские реквизиты и т.д.).")
         await state.set_state(NewDeal.payment_details)
 
     @router.message(NewDeal.fiat_amount)
     async def process_fiat_amount(message: Message, state: FSMContext) -> None:
         await state.update_data(fiat_amount=message.text)
         await state.set_state(NewDeal.payment_details)
-        await message.answer("Введите детали оплаты фиата (банковские реквизиты и т.д.).")
+        outbox.send(message.chat.id, "Введите детали оплаты фиата (банковские реквизиты и т.д.).")
 
     @router.message(NewDeal.payment_details)
-    async def process_payment_details(message: Message, state: FSMContext) -> None:
+    async def process_payment_details(message: Message, state: FSMContext, session: AsyncSession) -> None:
         data = await state.get_data()
-        deal_id = data['deal_id']
         fiat_amount = data["fiat_amount"]
         crypto_amount = data['crypto_amount']
-        
-        # Обновляем payment_details существующей сделки
-        await update_deal(deal_id, payment_details=message.text, fiat_amount=fiat_amount, crypto_amount=crypto_amount)
-
-        
 
 
         result = await wallet_api.telethon_req(action="/balance", message=message, state=state)
@@ -209,107 +220,198 @@ def setup_handlers(router: Router, wallet_api: TelethonWalletAPI, client: Telegr
             wallet = wallet_text.splitlines()[4:5]
             logger.info(f"bot_addres: {wallet}")
 
+        # Единственная запись мастера - готовая сделка (после запроса к telethon,
+        # чтобы блокировка записи не держалась на время его ожидания)
+        deal_id = await create_deal(
+            seller_id=message.from_user.id,
+            buyer_id=data['buyer_id'],
+            crypto_amount=crypto_amount,
+            fiat_amount=fiat_amount,
+            payment_details=message.text,
+            session=session,
+        )
+        # Коммит до уведомлений: покупатель может сразу нажать /accept, а соединение
+        # писателя не должно ждать ответов Telegram API
+        await session.commit()
 
 
         await state.clear()
-        keyboard = await get_dynamic_keyboard(message.from_user.id, await state.get_state())
+        keyboard = await get_dynamic_keyboard(message.from_user.id, state=await state.get_state(), session=session)
 
-        await message.answer(
+        outbox.send(
+            message.chat.id,
             f"Сделка #{deal_id} создана. Отправьте {data['crypto_amount']} BTC на адрес бота: {wallet}.",
             reply_markup=keyboard
         )
         
         # Уведомляем покупателя
-        buyer_keyboard = await get_dynamic_keyboard(data['buyer_id'], await state.get_state())
-        await message.bot.send_message(
+        buyer_keyboard = await get_dynamic_keyboard(data['buyer_id'], session=session)
+        outbox.send(
             data['buyer_id'],
             f"Новая сделка #{deal_id} от @{message.from_user.username}. Крипта: {data['crypto_amount']} BTC, фиат: {data['fiat_amount'] * 0.03}. Подтвердите с /accept {deal_id}.",
-            reply_markup=buyer_keyboard
+            priority=PRIORITY_CRITICAL,
+            reply_markup=buyer_keyboard,
         )
 
+    @router.message(Command("my_deals"))
+    async def my_deals(message: Message, session: AsyncSession) -> None:
+        """/my_deals [open|closed] [seller|buyer] - история сделок постранично."""
+        status = role = None
+        for arg in message.text.split()[1:]:
+            if arg in DEAL_PAGE_STATUSES:
+                status = arg
+            elif arg in DEAL_PAGE_ROLES:
+                role = arg
+            else:
+                outbox.send(message.chat.id, "Использование: /my_deals [open|closed] [seller|buyer]")
+                return
+        text, kb = await build_deals_page(message.from_user.id, status=status, role=role, session=session)
+        outbox.send(message.chat.id, text, reply_markup=kb)
+
+    @router.message(Command("stats"))
+    async def admin_stats(message: Message, session: AsyncSession) -> None:
+        """/stats - объёмы и комиссия по агрегатам deal_stats (только для админов)."""
+        if not _is_admin(message.from_user.id):
+            outbox.send(message.chat.id, "Доступ запрещен: только для администраторов.")
+            return
+        stats = await get_deal_stats(days=30, session=session)
+        days = list(stats['days'].values())
+        today, week_start = stats_day(time.time()), stats_day(time.time() - 6 * 86400)
+        lines = [
+            _format_stats("Сегодня", [d for d in days if d['day'] == today]),
+            _format_stats("7 дней", [d for d in days if d['day'] >= week_start]),
+            _format_stats("30 дней", days),
+            _format_stats("Всего", [stats['total']]),
+        ]
+        outbox.send(message.chat.id, "\n\n".join(lines))
+
+    @router.message(Command("export"))
+    async def admin_export(message: Message) -> None:
+        """/export [csv|jsonl] [open|closed] [gz] [YYYY-MM-DD [YYYY-MM-DD]] - выгрузка сделок файлом (только для админов).
+
+        Даты - границы created_at (UTC), вторая включается целиком.
+        """
+        if not _is_admin(message.from_user.id):
+            await message.answer("Доступ запрещен: только для администраторов.")
+            return
+        usage = "Использование: /export [csv|jsonl] [open|closed] [gz] [YYYY-MM-DD [YYYY-MM-DD]]"
+        fmt, status, compress, dates = 'csv', None, False, []
+        try:
+            for arg in message.text.split()[1:]:
+                if arg in EXPORT_FORMATS:
+                    fmt = arg
+                elif arg in DEAL_PAGE_STATUSES:
+                    status = arg
+                elif arg == 'gz':
+                    compress = True
+                else:
+                    dates.append(parse_export_date(arg))
+        except ValueError:
+            await message.answer(usage)
+            return
+        if len(dates) > 2:
+            await message.answer(usage)
+            return
+        since = dates[0] if dates else None
+        until = dates[1] + 86400 if len(dates) == 2 else None
+
+        await message.answer("Готовлю выгрузку...")
+        path, count = await export_deals(fmt, since=since, until=until, status=status, compress=compress)
+        try:
+            if os.path.getsize(path) > EXPORT_MAX_BYTES:
+                await message.answer(f"Выгрузка ({count} сделок) больше 50 МБ: сузьте период или добавьте gz.")
+                return
+            await message.answer_document(FSInputFile(path), caption=f"Сделок: {count}")
+        finally:
+            os.remove(path)
+
     @router.message(Command("accept"))
-    async def buyer_accept_start(message: Message, state: FSMContext) -> None:
+    async def buyer_accept_start(message: Message, state: FSMContext, session: AsyncSession) -> None:
         try:
             parts = message.text.split()
             
             # Проверяем наличие deal_id в команде
             if len(parts) < 2:
-                await message.answer("Использование: /accept [номер сделки]")
+                outbox.send(message.chat.id, "Использование: /accept [номер сделки]")
                 return
             
             # Пытаемся извлечь deal_id из команды
             try:
                 input_deal_id = int(parts[1])
             except ValueError:
-                await message.answer("Неверный формат номера сделки. Используйте целое число.")
+                outbox.send(message.chat.id, "Неверный формат номера сделки. Используйте целое число.")
                 return
             
             # Проверяем сделку по buyer_id
-            deal_id = await get_deal_id_by_buyer_id(message.from_user.id)
+            deal_id = await get_deal_id_by_buyer_id(message.from_user.id, session=session)
             
-            deal = await get_deal_by_id(deal_id)
+            deal = await get_deal_by_id(deal_id, session=session)
             if not deal or deal['buyer_id'] != message.from_user.id:
-                await message.answer("Неверный ID сделки.")
+                outbox.send(message.chat.id, "Неверный ID сделки.")
                 logger.info(f'{deal_id, deal, message.from_user.id}')
                 return
 
-            wallet = await get_user_wallet_by_user_id(message.from_user.id)
+            wallet = await get_user_wallet_by_user_id(message.from_user.id, session=session)
 
             if wallet is not None:
                 await state.set_state(BuyerAccept.wallet_address)
                 await state.update_data(deal_id=deal_id)
-                await message.answer("Введите ваш BTC адрес для получения крипты.", reply_markup=ReplyKeyboardRemove())
+                outbox.send(message.chat.id, "Введите ваш BTC адрес для получения крипты.", reply_markup=ReplyKeyboardRemove())
         except Exception as e:
             logger.error(f"Ошибка в buyer_accept_start: {e}")
-            await message.answer("Произошла ошибка при обработке команды /accept.")
+            outbox.send(message.chat.id, "Произошла ошибка при обработке команды /accept.")
 
     @router.message(BuyerAccept.wallet_address)
-    async def process_buyer_wallet(message: Message, state: FSMContext) -> None:
+    async def process_buyer_wallet(message: Message, state: FSMContext, session: AsyncSession) -> None:
         address = message.text.strip()
         
         # Простая валидация BTC адреса (26-35 символов, без пробелов)
         if not (len(address) == 42 and ' ' not in address):
-            await message.answer("Неверный BTC адрес.")
+            outbox.send(message.chat.id, "Неверный BTC адрес.")
             return
         
         data = await state.get_data()
         deal_id = data['deal_id']
-        await update_deal_buyer_wallet(deal_id, address)
+        await update_deal_buyer_wallet(deal_id, address, session=session)
         
         await state.clear()
-        keyboard = await get_dynamic_keyboard(message.from_user.id, await state.get_state())
-        await message.answer("Адрес сохранен. Ждите депозита от продавца.", reply_markup=keyboard)
+        keyboard = await get_dynamic_keyboard(message.from_user.id, state=await state.get_state(), session=session)
+        outbox.send(message.chat.id, "Адрес сохранен. Ждите депозита от продавца.", reply_markup=keyboard)
         
         # Уведомляем продавца
-        deal = await get_deal_by_id(deal_id)
+        deal = await get_deal_by_id(deal_id, session=session)
         seller_id = deal['seller_id']
-        seller_keyboard = await get_dynamic_keyboard(seller_id, await state.get_state())
-        await message.bot.send_message(
+        seller_keyboard = await get_dynamic_keyboard(seller_id, session=session)
+        outbox.send(
             seller_id,
             f"Покупатель принял сделку #{deal_id} и предоставил адрес.",
-            reply_markup=seller_keyboard
+            priority=PRIORITY_CRITICAL,
+            reply_markup=seller_keyboard,
         )
 
     @router.message(Command("deposit"))
-    async def seller_deposit_start(message: Message, state: FSMContext) -> None:
+    async def seller_deposit_start(message: Message, state: FSMContext, session: AsyncSession) -> None:
         try:
             parts = message.text.split()
             deal_id = int(parts[1]) if len(parts) > 1 else None
             
             if deal_id is None:
-                await message.answer("Использование: /deposit <deal_id>")
+                outbox.send(message.chat.id, "Использование: /deposit <deal_id>")
                 return
             
-            deal = await get_deal_by_id(deal_id)
+            deal = await get_deal_by_id(deal_id, session=session)
             if not deal or deal['seller_id'] != message.from_user.id:
-                await message.answer("Неверный ID сделки.")
+                outbox.send(message.chat.id, "Неверный ID сделки.")
                 return
             
-            # Отмечаем депозит как внесённый
-            await set_deal_deposited(deal_id)
+            # Отмечаем депозит как внесённый; повторный /deposit отклоняется самой БД
+            if not await try_deposit_deal(deal_id, seller_id=message.from_user.id, session=session):
+                outbox.send(message.chat.id, "Депозит по этой сделке уже внесён или сделка закрыта.")
+                return
             
-            keyboard = await get_dynamic_keyboard(message.from_user.id, await state.get_state())
-            await message.answer(
+            keyboard = await get_dynamic_keyboard(message.from_user.id, state=await state.get_state(), session=session)
+            outbox.send(
+                message.chat.id,
                 f"Депозит зафиксирован для сделки #{deal_id}.",
                 reply_markup=keyboard
             )
@@ -320,50 +422,58 @@ def setup_handlers(router: Router, wallet_api: TelethonWalletAPI, client: Telegr
             fiat_amount = data.get('fiat_amount')
 
             buyer_id = deal['buyer_id']
-            buyer_keyboard = await get_dynamic_keyboard(buyer_id, await state.get_state())
-            await message.bot.send_message(
+            buyer_keyboard = await get_dynamic_keyboard(buyer_id, session=session)
+            outbox.send(
                 buyer_id,
                 f"Продавец внёс депозит для сделки #{deal_id}. Ожидаем подтверждения.\n отправьте рубли {fiat_amount * 1.03} | комиссия составила {fiat_amount * 0.03} : 3% \n данные о реквизитах:\n {payment_details}",
-                reply_markup=buyer_keyboard
+                priority=PRIORITY_CRITICAL,
+                reply_markup=buyer_keyboard,
             )
             
         except (ValueError, IndexError):
-            await message.answer("Использование: /deposit <deal_id>")
+            outbox.send(message.chat.id, "Использование: /deposit <deal_id>")
         except Exception as e:
-            await message.answer(f"Ошибка: {str(e)}")
+            outbox.send(message.chat.id, f"Ошибка: {str(e)}")
 
     @router.message(Command("confirm"))
-    async def seller_confirm_start(message: Message, state: FSMContext) -> None:
+    async def seller_confirm_start(message: Message, state: FSMContext, session: AsyncSession) -> None:
         try:
             parts = message.text.split()
             deal_id = int(parts[1]) if len(parts) > 1 else None
             if deal_id is None:
-                await message.answer("Использование: /confirm <deal_id>")
+                outbox.send(message.chat.id, "Использование: /confirm <deal_id>")
                 return
-            deal = await get_deal_by_id(deal_id)
+            deal = await get_deal_by_id(deal_id, session=session)
             if not deal or deal['seller_id'] != message.from_user.id or not deal['deposited']:
-                await message.answer("Неверный ID или депозит не подтвержден.")
+                outbox.send(message.chat.id, "Неверный ID или депозит не подтвержден.")
                 return
             await state.set_state(SellerConfirm.confirm)
             await state.update_data(deal_id=deal_id)
-            await message.answer("Подтвердите получение фиата: да/нет", reply_markup=ReplyKeyboardMarkup(
+            outbox.send(message.chat.id, "Подтвердите получение фиата: да/нет", reply_markup=ReplyKeyboardMarkup(
                 keyboard=[[KeyboardButton(text="Да"), KeyboardButton(text="Нет")]],
                 resize_keyboard=True,
             ))
         except:
-            await message.answer("Использование: /confirm <deal_id>")
+            outbox.send(message.chat.id, "Использование: /confirm <deal_id>")
 
     @router.message(SellerConfirm.confirm)
-    async def process_confirm(message: Message, state: FSMContext) -> None:
+    async def process_confirm(message: Message, state: FSMContext, session: AsyncSession) -> None:
         data = await state.get_data()
         deal_id = data['deal_id']
 
         if message.text.lower() == "нет":
-            await delete_deal(deal_id)
+            await delete_deal(deal_id, session=session)
 
         if message.text.lower() == "да":
             try:
-                deal = await get_deal_by_id(deal_id)
+                # Подтверждение фиксируется отдельной транзакцией до отправки крипты:
+                # повторное "да" (или двойное нажатие) не приведёт ко второму переводу
+                if not await try_confirm_deal(deal_id, seller_id=message.from_user.id):
+                    outbox.send(message.chat.id, "Сделка уже подтверждена или недоступна.")
+                    await state.clear()
+                    return
+
+                deal = await get_deal_by_id(deal_id, session=session)
                 amount = deal['fiat_amount']
                 buyer_id = deal['buyer_id']
                 
@@ -371,64 +481,69 @@ def setup_handlers(router: Router, wallet_api: TelethonWalletAPI, client: Telegr
                 await wallet_api.telethon_req(action = "send_crypto", buyer_id=buyer_id, amount=amount, message=message, state=state)
                     
                 
-                keyboard = await get_dynamic_keyboard(message.from_user.id, await state.get_state())
-                await message.answer(
+                keyboard = await get_dynamic_keyboard(message.from_user.id, state=await state.get_state(), session=session)
+                outbox.send(
+                    message.chat.id,
                     f"Команда отправки отправлена. Ожидаем подтверждения от бота кошелька.",
                     reply_markup=keyboard
                 )
                 
-                buyer_keyboard = await get_dynamic_keyboard(buyer_id, await state.get_state())
-                await message.bot.send_message(
+                buyer_keyboard = await get_dynamic_keyboard(buyer_id, session=session)
+                outbox.send(
                     buyer_id,
                     f"Крипта из сделки #{deal_id} в пути на ваш адрес.",
-                    reply_markup=buyer_keyboard
+                    priority=PRIORITY_CRITICAL,
+                    reply_markup=buyer_keyboard,
                 )
                 
                 # Закрываем сделку (сохраняем в БД для истории)
-                await close_deal(deal_id)
+                await close_deal(deal_id, session=session)
                 
             except Exception as e:
-                await message.answer(f"Ошибка отправки: {str(e)}")
+                outbox.send(message.chat.id, f"Ошибка отправки: {str(e)}")
         else:
-            await message.answer("Сделка не подтверждена. Обсудите с покупателем.")
+            outbox.send(message.chat.id, "Сделка не подтверждена. Обсудите с покупателем.")
         
         await state.clear()
-        keyboard = await get_dynamic_keyboard(message.from_user.id, await state.get_state())
-        await message.answer("Готово.", reply_markup=keyboard)
+        keyboard = await get_dynamic_keyboard(message.from_user.id, state=await state.get_state(), session=session)
+        outbox.send(message.chat.id, "Готово.", reply_markup=keyboard)
 
     @router.message(Command("delete"))
-    async def delete_deal_start(message: Message, state: FSMContext) -> None:
+    async def delete_deal_start(message: Message, state: FSMContext, session: AsyncSession) -> None:
         try:
             parts = message.text.split()
             deal_id = int(parts[1]) if len(parts) > 1 else None
             
             if deal_id is None:
-                await message.answer("Использование: /delete <deal_id>")
+                outbox.send(message.chat.id, "Использование: /delete <deal_id>")
                 return
             
-            deal = await get_deal_by_id(deal_id)
+            deal = await get_deal_by_id(deal_id, session=session)
             if not deal or deal['seller_id'] != message.from_user.id:
-                await message.answer("Неверный ID сделки или у вас нет прав на удаление.")
+                outbox.send(message.chat.id, "Неверный ID сделки или у вас нет прав на удаление.")
                 return
             
             # Проверяем, что сделка ещё не имеет депозита
             if deal['deposited']:
-                await message.answer("Невозможно удалить сделку после внесения депозита.")
+                outbox.send(message.chat.id, "Невозможно удалить сделку после внесения депозита.")
                 return
             
-            # Удаляем сделку
-            await delete_deal(deal_id)
+            # Удаляем сделку; условие повторяется в DELETE на случай конкурентного /deposit
+            if not await delete_deal(deal_id, expected={'deposited': False}, session=session):
+                outbox.send(message.chat.id, "Невозможно удалить сделку после внесения депозита.")
+                return
             
-            keyboard = await get_dynamic_keyboard(message.from_user.id, await state.get_state())
-            await message.answer(
+            keyboard = await get_dynamic_keyboard(message.from_user.id, state=await state.get_state(), session=session)
+            outbox.send(
+                message.chat.id,
                 f"Сделка #{deal_id} удалена.",
                 reply_markup=keyboard
             )
             
         except (ValueError, IndexError):
-            await message.answer("Использование: /delete <deal_id>")
+            outbox.send(message.chat.id, "Использование: /delete <deal_id>")
         except Exception as e:
-            await message.answer(f"Ошибка при удалении сделки: {str(e)}")
+            outbox.send(message.chat.id, f"Ошибка при удалении сделки: {str(e)}")
 
     @router.callback_query(StateFilter("waiting_btc_button"))
     async def cb_btc_buttons(callback: CallbackQuery, state: FSMContext) -> None:  
@@ -440,17 +555,17 @@ def setup_handlers(router: Router, wallet_api: TelethonWalletAPI, client: Telegr
             logger.info(f'{button_text}')   
             
             data = await state.get_data()    
-            response = data.get("response")    
-            conv = data.get("conv")   
             
-            if conv and response:  
+            if data.get("interaction_id"):  
                 try:  
-                    await response.click(text=button_text)
-                    asyncio.sleep(0.5)
-                    new_response = await conv.get_response()
+                    new_response = await wallet_api.press_button(data["interaction_id"], button_text)
                     
                     await state.set_state(data.get('prev_state'))
 
+                    if new_response is None:
+                        await callback.answer("Кнопка устарела, запросите курс заново", show_alert=True)
+                        return
+
                     if new_response:  
                         if new_response.media:
                             # Handle another media response if needed  
@@ -460,7 +575,7 @@ def setup_handlers(router: Router, wallet_api: TelethonWalletAPI, client: Telegr
                         else:  
                             # Handle text response  
                             msg = new_response.message  
-                            await callback.message.answer(msg)  
+                            outbox.send(callback.message.chat.id, msg)  
                     
                     await callback.answer()
                     
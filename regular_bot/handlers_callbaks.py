@@ -1,4 +1,5 @@
-from aiogram import Router
+from aiogram import Router, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.types import (
@@ -15,9 +16,11 @@ import logging
 from typing import Optional
 import asyncio
 from telethon import TelegramClient
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from db import (
     upsert_user,
+    get_user,
     find_user_by_username,
     create_deal,
     get_deal_by_id,
@@ -27,7 +30,8 @@ from db import (
     set_user_wallet,
     delete_deal,
     close_deal,
-    upsert_user_state
+    user_cache,
+    deal_cache,
 )
 
 from regular_bot.states import (
@@ -38,12 +42,14 @@ from regular_bot.states import (
     GetWalletAddress,
     DebugStates,
 )
-from regular_bot.keyboards import get_dynamic_keyboard
+from regular_bot.keyboards import get_dynamic_keyboard, build_deals_page, parse_deals_page_callback
 from regular_bot.config import ADMIN_IDS, INNER_BOT, WALLET_BOT
 from regular_bot.utils import to_entity
 
 
-from regular_bot.wallet import TelethonWalletAPI
+from regular_bot.wallet import TelethonWalletAPI, register_interaction
+from regular_bot.deadlines import deadlines, BTC_STATE_RESET
+from regular_bot.outbox import outbox, PRIORITY_LOW
 
 logger = logging.getLogger(__name__)
 
@@ -75,8 +81,26 @@ class CallbackHandlers:
         self.router.callback_query(lambda c: c.data and c.data.startswith("debug:"))(
             self.cb_debug_router
         )
+        self.router.callback_query(F.data.startswith("deals:"))(self.cb_deals_page)
         self.router.callback_query()(self.cb_btc_buttons)
 
+    async def cb_deals_page(self, callback: CallbackQuery, session: AsyncSession) -> None:
+        """Навигация назад/вперёд по списку сделок: перерисовывает сообщение одной страницей."""
+        try:
+            role, status, direction, cursor = parse_deals_page_callback(callback.data)
+            text, kb = await build_deals_page(
+                callback.from_user.id, cursor=cursor, direction=direction, status=status, role=role, session=session
+            )
+        except ValueError:
+            await callback.answer("Некорректный запрос", show_alert=True)
+            return
+        await callback.answer()
+        try:
+            await callback.message.edit_text(text, reply_markup=kb)
+        except TelegramBadRequest as e:
+            # Повторное нажатие на ту же кнопку: "message is not modified"
+            logger.info(f"deals page not updated: {e}")
+
     async def cb_btc_buttons(self, callback: CallbackQuery, state: FSMContext) -> None:  
         """Обрабатывает callback от BTC inline кнопок."""  
         current_state = await state.get_state()  
@@ -88,18 +112,15 @@ class CallbackHandlers:
             
             # Получаем сохранённые данные  
             data = await state.get_data()  
-            response = data.get("response")  
-            conv = data.get("conv") 
             
-            # Здесь можно использовать response для telethon  
-            if conv and response:
+            # Сообщение telethon берём из wallet_interactions по id из FSM
+            if data.get("interaction_id"):
                 try:
-                    # Нажимаем кнопку в Telethon по тексту  
-                    await response.click(text=button_text)
-                    # Получаем новый ответ после нажатия  
-                    new_response = await conv.get_response()
+                    # Нажимаем кнопку в Telethon по тексту и ждём новый ответ
+                    new_response = await self.wallet_api.press_button(data["interaction_id"], button_text)
                     if new_response:
-                        await callback.message.answer(new_response)
+                        # press_button возвращает Message Telethon, отправляем его текст
+                        outbox.send(callback.message.chat.id, new_response.message)
 
                 except Exception as e:
                     logger.error()
@@ -108,7 +129,7 @@ class CallbackHandlers:
     async def cmd_debug_menu(self, message: Message, state: FSMContext) -> None:
         """Display admin debug menu."""
         if not _is_admin(message.from_user.id):
-            await message.answer("Доступ запрещен: только для администраторов.")
+            outbox.send(message.chat.id, "Доступ запрещен: только для администраторов.", priority=PRIORITY_LOW)
             return
 
         kb = InlineKeyboardMarkup(
@@ -121,12 +142,13 @@ class CallbackHandlers:
                 [InlineKeyboardButton(text="Who lets the dogs out?", callback_data="debug:who_lets_the_dogs_out")],
                 [InlineKeyboardButton(text="get User", callback_data="debug:get_user")],
                 [InlineKeyboardButton(text="get last message from telethon", callback_data="debug:get_last_message")],
-                [InlineKeyboardButton(text="/btc", callback_data="debug:lets_btc")]
+                [InlineKeyboardButton(text="/btc", callback_data="debug:lets_btc")],
+                [InlineKeyboardButton(text="Cache stats", callback_data="debug:cache_stats")]
             ]
         )
-        await message.answer("Debug menu:", reply_markup=kb)
+        outbox.send(message.chat.id, "Debug menu:", priority=PRIORITY_LOW, reply_markup=kb)
 
-    async def cb_debug_router(self, callback: CallbackQuery, state: FSMContext) -> None:
+    async def cb_debug_router(self, callback: CallbackQuery, state: FSMContext, session: AsyncSession) -> None:
         """Route debug callback queries to appropriate handlers."""
         user_id = callback.from_user.id
         if not _is_admin(user_id):
@@ -162,10 +184,10 @@ class CallbackHandlers:
                         ) 
 
                         await state.set_state("waiting_btc_button")
+                        deadlines.track_state(state.key, *BTC_STATE_RESET)
                         await state.update_data(
                             button_texts=button_texts,
-                            response=response,
-                            conv=conv)
+                            interaction_id=register_interaction(response))
 
                         await callback.message.answer_photo(  
                             photo=photo,  
@@ -176,63 +198,56 @@ class CallbackHandlers:
                         lines = msg.splitlines()
                         msg = ''.join(lines[0:3])
                         logger.info(f'{msg}')
-                        await callback.message.answer(msg)
+                        outbox.send(callback.message.chat.id, msg, priority=PRIORITY_LOW)
 
 
 
             except Exception as e:
                 logger.error("Error in _on_message", exc_info=e)
 
+        if action == "cache_stats":
+            outbox.send(callback.message.chat.id, f"User cache: {user_cache.stats()}\nDeal cache: {deal_cache.stats()}", priority=PRIORITY_LOW)
+            return
+
         if action == "get_user":
-            user = await find_user_by_username(callback.from_user.username)
-            await callback.message.answer(f"User: {user}")
+            user = await get_user(callback.from_user.id, session=session)
+            outbox.send(callback.message.chat.id, f"User: {user}", priority=PRIORITY_LOW)
             return
 
         if action == "state":
             current = await state.get_state()
             data = await state.get_data()
-            await callback.message.answer(f"Current state: {current}\nData: {data}")
+            outbox.send(callback.message.chat.id, f"Current state: {current}\nData: {data}", priority=PRIORITY_LOW)
             return
 
         if action == "clearstate":
-            # clear admin's FSM state and DB state record if possible
+            # clear admin's FSM state; the storage persists it to users.state
             await state.clear()
-            try:
-                await upsert_user_state(callback.from_user.username, None)
-            except Exception:
-                pass
-            await callback.message.answer("State cleared.")
+            outbox.send(callback.message.chat.id, "State cleared.", priority=PRIORITY_LOW)
             return
 
         if action == "list_deals":
-            deals = await get_deals_for_user(user_id) or []
-            if not deals:
-                await callback.message.answer("Сделки не найдены.")
-                return
-            lines = []
-            for d in deals:
-                lines.append(
-                    f"#{d.get('id', d.get('deal_id','?'))} seller:{d.get('seller_id')} buyer:{d.get('buyer_id')} amount:{d.get('crypto_amount')} deposited:{d.get('deposited')}"
-                )
-            await callback.message.answer("\n".join(lines))
+            # Первая страница; дальше навигация через cb_deals_page
+            text, kb = await build_deals_page(user_id, session=session)
+            outbox.send(callback.message.chat.id, text, priority=PRIORITY_LOW, reply_markup=kb)
             return
 
         if action == "get_deal":
             # ask admin to send deal id as a message; use FSM to await
             await state.set_state(DebugStates.waiting_for_deal_id)
-            await callback.message.answer("Введите ID сделки (число):", reply_markup=ReplyKeyboardRemove())
+            outbox.send(callback.message.chat.id, "Введите ID сделки (число):", priority=PRIORITY_LOW, reply_markup=ReplyKeyboardRemove())
             return
 
         if action == "k-bot_balance":
             if self.wallet_api is None:
-                await callback.message.answer("Wallet API не настроен.")
+                outbox.send(callback.message.chat.id, "Wallet API не настроен.", priority=PRIORITY_LOW)
                 return
             try:
                 resp = await self.wallet_api.send_command("/balance", timeout=10)
                 text = resp[1].get('text', '') if resp else 'No response'
-                await callback.message.answer(f"Response from k-bot:\n{text}")
+                outbox.send(callback.message.chat.id, f"Response from k-bot:\n{text}", priority=PRIORITY_LOW)
             except Exception as e:
-                await callback.message.answer(f"Error: {str(e)}")
+                outbox.send(callback.message.chat.id, f"Error: {str(e)}", priority=PRIORITY_LOW)
             return
 
         if action == "who_lets_the_dogs_out":
@@ -241,7 +256,7 @@ class CallbackHandlers:
 
         if action == "get_last_message":
             if self.wallet_api is None:
-                await callback.message.answer("Wallet API не настроен.")
+                outbox.send(callback.message.chat.id, "Wallet API не настроен.", priority=PRIORITY_LOW)
                 return
             try:
                 #last_msg = await self.wallet_api.get_last_message_from_wallet(timeout=10)
@@ -249,11 +264,11 @@ class CallbackHandlers:
                 last_msg = msgs[0].message
 
                 logging.info(f'answer: {last_msg}')
-                await callback.message.answer(f"Последнее сообщение из WALLET_BOT:\n\n{last_msg}")
+                outbox.send(callback.message.chat.id, f"Последнее сообщение из WALLET_BOT:\n\n{last_msg}", priority=PRIORITY_LOW)
             except asyncio.TimeoutError:
-                await callback.message.answer("Таймаут: telethon_bot не ответил в течение 10 секунд.")
+                outbox.send(callback.message.chat.id, "Таймаут: telethon_bot не ответил в течение 10 секунд.", priority=PRIORITY_LOW)
             except Exception as e:
-                await callback.message.answer(f"Ошибка: {str(e)}")
+                outbox.send(callback.message.chat.id, f"Ошибка: {str(e)}", priority=PRIORITY_LOW)
             return
 
 
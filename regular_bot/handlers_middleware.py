@@ -0,0 +1,40 @@
+from typing import Any, Awaitable, Callable, Dict
+import logging
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from db import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Outer middleware: одна сессия БД (unit of work) на весь апдейт.
+
+    Сессия передаётся хендлерам под ключом `session`, функции db.py принимают её
+    через аргумент `session=...`. Коммит выполняется один раз после хендлера,
+    при исключении изменения откатываются.
+
+    Сессия ленивая: функции чтения до первой записи идут через read-only пул
+    (db.read_scope), а единственное соединение писателя занимается первой записью
+    и держится до коммита. Поэтому долгие внешние вызовы (telethon) в хендлерах
+    стоит делать до записей.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with AsyncSessionLocal() as session:
+            data['session'] = session
+            result = await handler(event, data)
+            await session.commit()
+            return result
+
+
+def setup_middlewares(dp) -> None:
+    """Register outer middlewares on the dispatcher."""
+    dp.update.outer_middleware(DbSessionMiddleware())
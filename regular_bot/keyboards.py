@@ -1,50 +1,115 @@
 from typing import Optional
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
-from db import get_deals_for_user
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import LRUCache
+from db import fetch_deals_for_user, get_deals_page, DEAL_KEYBOARD_COLUMNS, DealStatus, get_cached_keyboard, cache_keyboard, keyboard_cache
 import logging
 
 logger = logging.getLogger(__name__)
 
+DEALS_PAGE_SIZE = 10
 
-async def get_dynamic_keyboard(user_id: int, deal_id: Optional[int] = None, state: Optional[str] = None) -> Optional[ReplyKeyboardMarkup]:
+# Одинаковые наборы кнопок (например, только /new_deal) собираются один раз
+# и разделяются между пользователями; разметку никто не изменяет после создания
+_markups = LRUCache(maxsize=1024)
+
+
+def _reply_markup(texts: tuple[str, ...]) -> ReplyKeyboardMarkup:
+    markup = _markups.get(texts)
+    if markup is None:
+        buttons = [KeyboardButton(text=text) for text in texts]
+        markup = ReplyKeyboardMarkup(keyboard=[buttons[i:i+2] for i in range(0, len(buttons), 2)], resize_keyboard=True)  # По 2 в ряд
+        _markups.set(texts, markup)
+    return markup
+
+
+async def get_dynamic_keyboard(user_id: int, deal_id: Optional[int] = None, state: Optional[str] = None, session: Optional[AsyncSession] = None) -> Optional[ReplyKeyboardMarkup]:
     """Функция для динамической клавиатуры по ролям пользователя.
     
     Args:
         user_id: ID пользователя Telegram
         deal_id: ID сделки (опционально)
         state: Текущее состояние бота
+        session: Сессия БД текущего апдейта (опционально)
         
     Returns:
         ReplyKeyboardMarkup с кнопками действий или None
+
+    Клавиатура по сделкам кэшируется по (user_id, state) в db.keyboard_cache;
+    запись сделки сбрасывает кэш её продавца и покупателя.
     """
 
     if state == 'NewDeal:buyer_username':
-        if deal_id is not None:
-            return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="Отмена")]], resize_keyboard=True)
-        return None
+        # Черновик сделки живёт в FSM (deal_id ещё нет): на шаге ввода покупателя можно только отменить
+        return _reply_markup(("Отмена",))
 
     if state == 'GetWalletAddress:waiting_for_address':
         # Если ожидаем адрес кошелька, не показываем другие кнопки
         return None
 
-    deals = await get_deals_for_user(user_id)
+    cached = get_cached_keyboard(user_id, state)
+    if cached is not None:
+        return cached
 
-    buttons = [KeyboardButton(text="/new_deal")]  # Всегда доступно
+    since = keyboard_cache.stamp()
+    # Только незакрытые сделки: закрытые не дают действий и не должны замедлять клавиатуру
+    deals = await fetch_deals_for_user(user_id, columns=DEAL_KEYBOARD_COLUMNS, open_only=True, session=session)
+
+    buttons = ["/new_deal"]  # Всегда доступно
 
     for deal in deals:
-        if user_id == deal['buyer_id'] and not deal['buyer_wallet']:
-            buttons.append(KeyboardButton(text=f"/accept {deal['deal_id']}"))
-        if user_id == deal['seller_id']:
-            if not deal['deposited']:
-                buttons.append(KeyboardButton(text=f"/deposit {deal['deal_id']}"))
+        if user_id == deal.buyer_id and not deal.buyer_wallet:
+            buttons.append(f"/accept {deal.deal_id}")
+        if user_id == deal.seller_id:
+            if not deal.deposited:
+                buttons.append(f"/deposit {deal.deal_id}")
                 # Добавляем кнопку удаления сделки для создателя, если депозит ещё не внесён
                 # это можно сделать через проверку статуса сделки
-                if not deal['closed']:
-                    buttons.append(KeyboardButton(text=f"/delete {deal['deal_id']}"))
+                if not deal.closed:
+                    buttons.append(f"/delete {deal.deal_id}")
             else:
-                buttons.append(KeyboardButton(text=f"/confirm {deal['deal_id']}"))
+                buttons.append(f"/confirm {deal.deal_id}")
+
+    markup = _reply_markup(tuple(buttons))
+    cache_keyboard(user_id, state, markup, since, session=session)
+    return markup
+
+
+
+def deals_page_callback(direction: str, cursor: int, status: Optional[str] = None, role: Optional[str] = None) -> str:
+    """callback_data навигации по списку сделок (укладывается в лимит Telegram в 64 байта)."""
+    return f"deals:{role or '*'}:{status or '*'}:{direction}:{cursor}"
+
+
+def parse_deals_page_callback(data: str) -> tuple[Optional[str], Optional[str], str, int]:
+    """Обратное к deals_page_callback: (role, status, direction, cursor)."""
+    _, role, status, direction, cursor = data.split(":")
+    return (None if role == '*' else role), (None if status == '*' else status), direction, int(cursor)
+
+
+async def build_deals_page(
+    user_id: int,
+    cursor: Optional[int] = None,
+    direction: str = 'next',
+    status: Optional[str] = None,
+    role: Optional[str] = None,
+    session: Optional[AsyncSession] = None,
+) -> tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Одна страница списка сделок пользователя: текст и inline-кнопки назад/вперёд."""
+    page = await get_deals_page(user_id, cursor=cursor, direction=direction, limit=DEALS_PAGE_SIZE,
+                                status=status, role=role, include_archived=True, session=session)
+    rows = page['rows']
+    if not rows:
+        return "Сделки не найдены.", None
 
-    if len(buttons) > 1:  # Если есть действия помимо /new_deal
-        keyboard = [buttons[i:i+2] for i in range(0, len(buttons), 2)]  # По 2 в ряд
-        return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
-    return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="/new_deal")]], resize_keyboard=True)
+    lines = [
+        f"#{d.deal_id} seller:{d.seller_id} buyer:{d.buyer_id} amount:{d.crypto_amount} "
+        f"fiat:{d.fiat_amount} status:{'deleted' if d.deleted else DealStatus(d.status).name.lower()}"
+        for d in rows
+    ]
+    nav = []
+    if page['has_prev']:
+        nav.append(InlineKeyboardButton(text="« Назад", callback_data=deals_page_callback('prev', rows[0].deal_id, status, role)))
+    if page['has_next']:
+        nav.append(InlineKeyboardButton(text="Вперёд »", callback_data=deals_page_callback('next', rows[-1].deal_id, status, role)))
+    return "\n".join(lines), (InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None)
@@ -9,15 +9,22 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 from aiogram import Bot, Dispatcher, Router
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 from telethon import TelegramClient
 
-from regular_bot.config import TOKEN, OUTER_BOT, OUTER_BOT_USERNAME
+from regular_bot.config import (
+    TOKEN, OUTER_BOT, OUTER_BOT_USERNAME,
+    BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, UPDATES_CONCURRENCY,
+)
 from regular_bot.wallet import TelethonWalletAPI, wallet_response_listener
 from regular_bot.handlers import setup_handlers
 from regular_bot.handlers_callbaks import setup_callbacks
 from regular_bot.handlers_callbaks import CallbackHandlers
-from db import create_tables
+from regular_bot.handlers_middleware import setup_middlewares
+from regular_bot.deadlines import deadlines
+from regular_bot.outbox import outbox
+from regular_bot.storage import SQLiteStorage
+from regular_bot.webhook import run_webhook
+from db import run_migrations, write_actor, DB_WRITE_BATCHING, run_deal_archiver
 import traceback
 
 # Wallet API instance will be created in main() once Bot is available
@@ -30,6 +37,9 @@ client_ready = asyncio.Event()
 # Task for telethon_bot background process
 telethon_task: asyncio.Task | None = None
 
+# Фоновый перенос старых закрытых сделок в deals_archive
+archiver_task: asyncio.Task | None = None
+
 
 async def run_telethon_bot():
     """Run telethon_bot as a background task."""
@@ -60,12 +70,24 @@ async def run_telethon_bot():
 
 
 async def main() -> None:
-    """Initialize bot, dispatcher, and handlers. Start polling."""
-    global wallet_api, telethon_task, client, client_ready
+    """Initialize bot, dispatcher, and handlers. Start polling or webhook server (BOT_MODE)."""
+    global wallet_api, telethon_task, archiver_task, client, client_ready
+
+    if BOT_MODE not in ('polling', 'webhook'):
+        raise RuntimeError(f'Unknown BOT_MODE: {BOT_MODE}')
+    if BOT_MODE == 'webhook' and not (WEBHOOK_URL and WEBHOOK_SECRET):
+        raise RuntimeError('BOT_MODE=webhook requires WEBHOOK_URL and WEBHOOK_SECRET')
     
     bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    storage = MemoryStorage()
+    # FSM переживает перезапуск: состояния мастеров хранятся в users (см. regular_bot/storage.py)
+    storage = SQLiteStorage()
     dp = Dispatcher(storage=storage)
+    # Исходящие сообщения идут через очередь с лимитами Telegram; на остановке
+    # диспетчера она дописывается до закрытия сессии бота
+    outbox.start(bot)
+    dp.shutdown.register(outbox.stop)
+    # Одна сессия БД на апдейт
+    setup_middlewares(dp)
     
     # Create router
     router = Router()
@@ -84,10 +106,18 @@ async def main() -> None:
     # Create wallet API instance AFTER client is ready
     wallet_api = TelethonWalletAPI(bot, router, client)
     
-    # Создаем таблицы базы данных
+    # Применяем миграции схемы базы данных
     try:
-        await create_tables()
-        logging.info('Database tables initialized')
+        version = await run_migrations()
+        logging.info(f'Database schema is at version {version}')
+        if DB_WRITE_BATCHING:
+            write_actor.start()
+            logging.info('Group-commit write actor started')
+        archiver_task = asyncio.create_task(run_deal_archiver())
+        restored = await storage.load()
+        logging.info(f'Restored FSM state for {restored} users')
+        pending = await deadlines.start(bot, dp.storage)
+        logging.info(f'Deal deadline scheduler started with {pending} pending deadlines')
     except Exception as e:
         logging.error(f'Error initializing database tables: {e}')
         logging.error(traceback.format_exc())
@@ -107,9 +137,23 @@ async def main() -> None:
     dp.include_router(router)
     
     try:
-        # Start polling
-        await dp.start_polling(bot)
+        if BOT_MODE == 'webhook':
+            await run_webhook(dp, bot, url=WEBHOOK_URL, path=WEBHOOK_PATH, host=WEBHOOK_HOST, port=WEBHOOK_PORT,
+                              secret=WEBHOOK_SECRET, concurrency=UPDATES_CONCURRENCY)
+        else:
+            # Вебхук, оставшийся от запуска в режиме webhook, блокирует getUpdates
+            await bot.delete_webhook()
+            await dp.start_polling(bot, tasks_concurrency_limit=UPDATES_CONCURRENCY)
     finally:
+        # Дописываем накопленные в акторе записи
+        await write_actor.stop()
+        await deadlines.stop()
+        if archiver_task and not archiver_task.done():
+            archiver_task.cancel()
+            try:
+                await archiver_task
+            except asyncio.CancelledError:
+                logging.info('Deal archiver task cancelled')
         # Cleanup: cancel telethon task if main bot stops
         if telethon_task and not telethon_task.done():
             telethon_task.cancel()
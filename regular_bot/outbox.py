@@ -0,0 +1,352 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.types import Message
+
+from regular_bot.config import (
+    OUTBOX_GLOBAL_RATE,
+    OUTBOX_CHAT_RATE,
+    OUTBOX_CHAT_BURST,
+    OUTBOX_MAX_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+# Полосы приоритета: чат с сообщением из более высокой полосы обслуживается раньше
+PRIORITY_CRITICAL = 0  # ход сделки: уведомления второй стороне, сроки
+PRIORITY_NORMAL = 1    # ответы на команды
+PRIORITY_LOW = 2       # справочное: отладка, подсказки
+PRIORITIES = (PRIORITY_CRITICAL, PRIORITY_NORMAL, PRIORITY_LOW)
+
+# Лимит Telegram на длину текста сообщения
+MESSAGE_MAX_LENGTH = 4096
+MERGE_SEPARATOR = "\n\n"
+# Сколько чатов держать, прежде чем забыть простаивающие (с полным ведром)
+IDLE_CHATS_MAX = 10000
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity про запас."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен (0 - уже есть)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Outgoing:
+    __slots__ = ('text', 'kwargs', 'priority', 'futures', 'attempts')
+
+    def __init__(self, text: str, kwargs: dict, priority: int, futures: list):
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.futures = futures
+        self.attempts = 0
+
+
+class _Chat:
+    __slots__ = ('chat_id', 'queue', 'bucket', 'busy', 'paused_until', 'ticket', 'lane')
+
+    def __init__(self, chat_id: int, bucket: TokenBucket):
+        self.chat_id = chat_id
+        self.queue: deque[_Outgoing] = deque()
+        self.bucket = bucket
+        # Отправка в полёте: сообщения одного чата уходят строго по очереди
+        self.busy = False
+        self.paused_until = 0.0
+        # Актуальная запись чата в _waiting или полосе (0 - чат не запланирован);
+        # записи со старым билетом пропускаются
+        self.ticket = 0
+        self.lane: Optional[int] = None
+
+    def priority(self) -> int:
+        return min(item.priority for item in self.queue)
+
+
+def _mergeable(first: _Outgoing, second: _Outgoing) -> bool:
+    """Второй текст можно дописать к первому: у первого нет клавиатуры, прочие параметры совпадают."""
+    if not (isinstance(first.text, str) and isinstance(second.text, str)):
+        return False
+    if first.kwargs.get('reply_markup') is not None:
+        return False
+    if {k: v for k, v in first.kwargs.items() if k != 'reply_markup'} != \
+            {k: v for k, v in second.kwargs.items() if k != 'reply_markup'}:
+        return False
+    return len(first.text) + len(MERGE_SEPARATOR) + len(second.text) <= MESSAGE_MAX_LENGTH
+
+
+class Outbox:
+    """Очередь исходящих сообщений бота с учётом лимитов Telegram.
+
+    send() только ставит сообщение в очередь и сразу возвращает управление.
+    Один цикл раздаёт отправки: общее ведро токенов (~30 сообщений/с на бота)
+    и ведро на чат (~1 сообщение/с, короткие всплески до OUTBOX_CHAT_BURST).
+    Из готовых к отправке чатов первым обслуживается тот, в чьей очереди есть
+    сообщение самого высокого приоритета; внутри чата порядок сохраняется.
+
+    Пока чат ждёт своего токена, подряд идущие тексты к нему склеиваются в одно
+    сообщение (клавиатура берётся у последнего). RetryAfter ставит чат на паузу
+    на указанное Telegram время и повторяет отправку; сетевые и 5xx ошибки -
+    с экспоненциальной паузой, до OUTBOX_MAX_RETRIES попыток. Прочие ошибки
+    (бот заблокирован, неверный запрос) только логируются.
+    Не потокобезопасен: рассчитан на один event loop.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = OUTBOX_GLOBAL_RATE,
+        chat_rate: float = OUTBOX_CHAT_RATE,
+        chat_burst: float = OUTBOX_CHAT_BURST,
+        max_retries: int = OUTBOX_MAX_RETRIES,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.clock = clock
+        self.bot: Optional[Bot] = None
+        self._global = TokenBucket(global_rate, max(1.0, global_rate), clock())
+        self._chats: dict[int, _Chat] = {}
+        # (ready_at, ticket, chat) - чаты, ждущие токена или конца паузы
+        self._waiting: list[tuple[float, int, _Chat]] = []
+        # Готовые чаты по полосам: (ticket, chat)
+        self._lanes: list[deque] = [deque() for _ in PRIORITIES]
+        self._tickets = itertools.count(1)
+        self._pending = 0
+        self._prune_at = IDLE_CHATS_MAX
+        self._inflight: set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {'sent': 0, 'merged': 0, 'retry_after': 0, 'failed': 0}
+
+    def start(self, bot: Bot) -> None:
+        self.bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Дожидается отправки накопленного (не дольше timeout) и останавливает цикл."""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._drained(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Outbox stopped with {self._pending} messages not sent")
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        for task in list(self._inflight):
+            task.cancel()
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+        for chat in self._chats.values():
+            for item in chat.queue:
+                self._resolve(item, None)
+            chat.queue.clear()
+        self._pending = 0
+
+    async def _drained(self) -> None:
+        while self._pending or self._inflight:
+            await asyncio.sleep(0.05)
+
+    def pending(self) -> int:
+        """Сообщений в очереди (склеенное считается одним)."""
+        return self._pending
+
+    def send(self, chat_id: int, text: str, priority: int = PRIORITY_NORMAL, **kwargs: Any) -> asyncio.Future:
+        """Ставит sendMessage в очередь. kwargs - параметры Bot.send_message (reply_markup и т.д.).
+
+        Возвращает future с отправленным Message (None, если отправить не удалось);
+        ждать его не обязательно.
+        """
+        if not isinstance(text, str):
+            # Иначе ошибка всплыла бы только в цикле отправки, вдали от вызвавшего кода
+            raise TypeError(f"Outbox.send expects str text, got {type(text).__name__}")
+        future = asyncio.get_running_loop().create_future()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(chat_id, TokenBucket(self.chat_rate, self.chat_burst, self.clock()))
+        chat.queue.append(_Outgoing(text, kwargs, priority, [future]))
+        self._pending += 1
+        if not chat.busy and (chat.ticket == 0 or (chat.lane is not None and priority < chat.lane)):
+            # Новый чат в очереди или повышение полосы уже готового чата
+            self._schedule(chat)
+        self._wakeup.set()
+        return future
+
+    def _schedule(self, chat: _Chat) -> None:
+        now = self.clock()
+        chat.ticket = next(self._tickets)
+        ready_at = max(now + chat.bucket.delay(now), chat.paused_until)
+        if ready_at > now:
+            chat.lane = None
+            heapq.heappush(self._waiting, (ready_at, chat.ticket, chat))
+        else:
+            chat.lane = chat.priority()
+            self._lanes[chat.lane].append((chat.ticket, chat))
+
+    def _next_ready(self) -> Optional[_Chat]:
+        for lane in self._lanes:
+            while lane and lane[0][0] != lane[0][1].ticket:
+                lane.popleft()
+            if lane:
+                return lane[0][1]
+        return None
+
+    async def _sleep(self, timeout: Optional[float]) -> None:
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._step()
+            except Exception:
+                # Одно сломанное сообщение не должно останавливать отправку всех остальных
+                logger.exception("Outbox send loop iteration failed")
+                await asyncio.sleep(0.1)
+
+    async def _step(self) -> None:
+        """Одна итерация цикла: продвигает ожидающие чаты и отдаёт одну отправку или спит."""
+        now = self.clock()
+        while self._waiting and self._waiting[0][0] <= now:
+            _, ticket, chat = heapq.heappop(self._waiting)
+            if ticket == chat.ticket:
+                self._schedule(chat)
+        chat = self._next_ready()
+        if chat is None:
+            await self._sleep(self._waiting[0][0] - now if self._waiting else None)
+            return
+        delay = self._global.delay(now)
+        if delay > 0:
+            # За время ожидания может появиться чат из более высокой полосы
+            await self._sleep(delay)
+            return
+        self._lanes[chat.lane].popleft()
+        self._global.take(now)
+        chat.bucket.take(now)
+        chat.busy = True
+        chat.ticket = 0
+        chat.lane = None
+        try:
+            item = self._take(chat)
+        except Exception:
+            self._drop_head(chat)
+            raise
+        task = asyncio.create_task(self._deliver(chat, item))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    def _drop_head(self, chat: _Chat) -> None:
+        """Отказ от первого сообщения чата, на котором сломалась подготовка отправки."""
+        if chat.queue:
+            self._pending -= 1
+            self.stats['failed'] += 1
+            self._resolve(chat.queue.popleft(), None)
+        chat.busy = False
+        if chat.queue:
+            self._schedule(chat)
+
+    def _take(self, chat: _Chat) -> _Outgoing:
+        """Первое сообщение чата вместе со всеми, которые можно к нему дописать.
+
+        Очередь меняется только после склейки: если она упадёт, сообщения останутся на месте.
+        """
+        item = chat.queue[0]
+        count = 1
+        while count < len(chat.queue) and _mergeable(item, chat.queue[count]):
+            following = chat.queue[count]
+            item = _Outgoing(item.text + MERGE_SEPARATOR + following.text, following.kwargs,
+                             min(item.priority, following.priority), item.futures + following.futures)
+            count += 1
+        for _ in range(count):
+            chat.queue.popleft()
+        self._pending -= count
+        self.stats['merged'] += count - 1
+        return item
+
+    async def _deliver(self, chat: _Chat, item: _Outgoing) -> None:
+        try:
+            message = await self.bot.send_message(chat.chat_id, item.text, **item.kwargs)
+        except TelegramRetryAfter as e:
+            self.stats['retry_after'] += 1
+            logger.warning(f"Flood control for chat {chat.chat_id}: retry in {e.retry_after} s")
+            self._retry(chat, item, e.retry_after)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            self._retry(chat, item, 2 ** item.attempts, e)
+        except Exception as e:
+            self.stats['failed'] += 1
+            logger.warning(f"Message to {chat.chat_id} dropped: {e}")
+            self._resolve(item, None)
+        else:
+            self.stats['sent'] += 1
+            self._resolve(item, message)
+        finally:
+            chat.busy = False
+            if chat.queue:
+                self._schedule(chat)
+                self._wakeup.set()
+            elif len(self._chats) > self._prune_at:
+                self._prune()
+
+    def _retry(self, chat: _Chat, item: _Outgoing, delay: float, error: Optional[Exception] = None) -> None:
+        item.attempts += 1
+        if item.attempts > self.max_retries:
+            self.stats['failed'] += 1
+            logger.warning(f"Message to {chat.chat_id} dropped after {item.attempts} attempts: {error or 'flood control'}")
+            self._resolve(item, None)
+            return
+        chat.paused_until = max(chat.paused_until, self.clock() + delay)
+        chat.queue.appendleft(item)
+        self._pending += 1
+
+    @staticmethod
+    def _resolve(item: _Outgoing, message: Optional[Message]) -> None:
+        for future in item.futures:
+            if not future.done():
+                future.set_result(message)
+
+    def _prune(self) -> None:
+        now = self.clock()
+        idle = [chat_id for chat_id, chat in self._chats.items()
+                if not chat.queue and not chat.busy and chat.paused_until <= now and chat.bucket.full(now)]
+        for chat_id in idle:
+            del self._chats[chat_id]
+        # Следующая чистка - когда чатов снова станет заметно больше
+        self._prune_at = max(IDLE_CHATS_MAX, 2 * len(self._chats))
+
+
+outbox = Outbox()
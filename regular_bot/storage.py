@@ -0,0 +1,194 @@
+import asyncio
+import json
+import logging
+from typing import Any, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DEFAULT_DESTINY, StateType, StorageKey
+
+from cache import LRUCache
+from db import get_fsm_state, load_fsm_states, save_fsm_states
+from regular_bot.config import FSM_CACHE_SIZE, FSM_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class _Record:
+    __slots__ = ('state', 'data')
+
+    def __init__(self, state: Optional[str] = None, data: Optional[dict] = None):
+        self.state = state
+        self.data = data or {}
+
+    def __bool__(self) -> bool:
+        return self.state is not None or bool(self.data)
+
+
+def _persistable(user_id: int, data: dict) -> dict:
+    """Данные FSM, которые можно записать в JSON; остальные ключи живут только в памяти процесса."""
+    result = {}
+    for name, value in data.items():
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            logger.debug(f"FSM data {name!r} of user {user_id} is not JSON-serializable, kept in memory only")
+            continue
+        result[name] = value
+    return result
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх users.state/users.fsm_data.
+
+    Личные чаты (chat_id == user_id) сохраняются в строке пользователя, прочие ключи
+    (группы, топики, другие destiny) - только в памяти, как в MemoryStorage.
+
+    Чтения не ходят в БД: при старте load() загружает всех пользователей с непустым
+    FSM (частичный индекс ix_users_fsm). До FSM_CACHE_SIZE записей держится в памяти,
+    для остальных запоминается только user_id, и первое обращение читает одну строку.
+    Пользователь, которого нет в этом множестве, заведомо без состояния.
+
+    Изменения пишутся отложенно: грязные записи собираются и раз в FSM_FLUSH_INTERVAL
+    уходят в БД одним executemany. При падении процесса теряется не больше
+    одного интервала; close() дописывает всё накопленное.
+    """
+
+    def __init__(self, cache_size: int = FSM_CACHE_SIZE, flush_interval: float = FSM_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._hot = LRUCache(maxsize=cache_size)
+        # user_id с непустым FSM в БД или в ожидающих записях
+        self._stored: set[int] = set()
+        # Записи, ещё не попавшие в БД; _flushing - пачка, которая пишется прямо сейчас
+        self._dirty: dict[int, _Record] = {}
+        self._flushing: dict[int, _Record] = {}
+        # Записи с несериализуемыми данными не вытесняются: из БД их не восстановить
+        self._pinned: dict[int, _Record] = {}
+        self._memory: dict[StorageKey, _Record] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def load(self) -> int:
+        """Загружает сохранённые состояния и запускает фоновую запись. Возвращает число пользователей."""
+        rows = await load_fsm_states()
+        for row in rows:
+            self._stored.add(row.user_id)
+            if len(self._hot) < self._hot.maxsize:
+                self._hot.set(row.user_id, _Record(row.state, row.fsm_data))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return len(rows)
+
+    async def states(self) -> list[tuple[int, str]]:
+        """(user_id, state) всех пользователей с состоянием, с учётом ещё не записанных изменений."""
+        result = {row.user_id: row.state for row in await load_fsm_states()}
+        for pending in (self._flushing, self._dirty):
+            for user_id, record in pending.items():
+                result[user_id] = record.state
+        return [(user_id, state) for user_id, state in result.items() if state is not None]
+
+    @staticmethod
+    def _user_id(key: StorageKey) -> Optional[int]:
+        if (key.chat_id == key.user_id and key.thread_id is None
+                and key.business_connection_id is None and key.destiny == DEFAULT_DESTINY):
+            return key.user_id
+        return None
+
+    async def _get(self, key: StorageKey) -> _Record:
+        user_id = self._user_id(key)
+        if user_id is None:
+            return self._memory.get(key) or _Record()
+        for pending in (self._dirty, self._flushing, self._pinned):
+            if user_id in pending:
+                return pending[user_id]
+        record = self._hot.get(user_id)
+        if record is not None:
+            return record
+        if user_id not in self._stored:
+            return _Record()
+        # Сохранённая запись, вытесненная из памяти: одно чтение по первичному ключу
+        row = await get_fsm_state(user_id)
+        record = _Record(row.state, row.fsm_data) if row else _Record()
+        # За время чтения запись могла измениться
+        if user_id in self._dirty or user_id in self._flushing or user_id in self._pinned \
+                or self._hot.peek(user_id) is not None:
+            return await self._get(key)
+        self._hot.set(user_id, record)
+        return record
+
+    async def _put(self, key: StorageKey, state: Optional[str], data: dict) -> None:
+        record = _Record(state, data)
+        user_id = self._user_id(key)
+        if user_id is None:
+            if record:
+                self._memory[key] = record
+            else:
+                self._memory.pop(key, None)
+            return
+        if record:
+            self._stored.add(user_id)
+            self._hot.set(user_id, record)
+        else:
+            self._stored.discard(user_id)
+            self._hot.pop(user_id)
+        self._pinned.pop(user_id, None)
+        self._dirty[user_id] = record
+        self._wakeup.set()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        current = await self._get(key)
+        value = state.state if isinstance(state, State) else state
+        await self._put(key, value, current.data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        current = await self._get(key)
+        await self._put(key, current.state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._get(key)).data.copy()
+
+    async def flush(self) -> int:
+        """Пишет накопленные изменения одной транзакцией. Возвращает число строк."""
+        if not self._dirty:
+            return 0
+        self._flushing, self._dirty = self._dirty, {}
+        rows = []
+        for user_id, record in self._flushing.items():
+            data = _persistable(user_id, record.data)
+            if len(data) < len(record.data):
+                self._pinned[user_id] = record
+            rows.append({'user_id': user_id, 'state': record.state, 'fsm_data': data or None})
+        try:
+            await save_fsm_states(rows)
+        except Exception:
+            # Более новые изменения тех же ключей важнее неудавшейся пачки
+            for user_id, record in self._flushing.items():
+                self._dirty.setdefault(user_id, record)
+            raise
+        finally:
+            self._flushing = {}
+        return len(rows)
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            # Изменения за интервал собираются в одну пачку
+            await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("FSM write-behind flush failed")
+                self._wakeup.set()
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -2,7 +2,7 @@ import asyncio
 import uuid
 import re
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from aiogram import Bot
 from aiogram.types import Message
 from telethon import TelegramClient
@@ -11,14 +11,38 @@ from aiogram import Router
 from aiogram.types import BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 
-from regular_bot.config import WALLET_BOT, INNER_BOT, ADMIN_IDS
+from cache import LRUCache
+from regular_bot.config import WALLET_BOT, INNER_BOT, ADMIN_IDS, STALE_STATE_TIMEOUT, WALLET_INTERACTIONS_MAX
 from regular_bot.utils import to_entity
+from regular_bot.deadlines import deadlines, BTC_STATE_RESET
 
 logger = logging.getLogger(__name__)
 
 # В памяти храним pending responses: request_id -> asyncio.Future
 pending_responses: Dict[str, asyncio.Future] = {}
 
+# Сообщения wallet-бота с inline-кнопками, ждущие нажатия пользователя: interaction_id -> Message Telethon.
+# В FSM хранится только interaction_id; запись живёт не дольше, чем состояние waiting_btc_button,
+# а при переполнении вытесняется самая старая
+wallet_interactions = LRUCache(maxsize=WALLET_INTERACTIONS_MAX, ttl=STALE_STATE_TIMEOUT)
+
+
+def register_interaction(response) -> str:
+    interaction_id = uuid.uuid4().hex[:8]
+    # Просроченные сообщения Telethon не ждут вытеснения по размеру
+    wallet_interactions.expire()
+    wallet_interactions.set(interaction_id, response)
+    return interaction_id
+
+
+def take_interaction(interaction_id: Optional[str]):
+    """Сообщение по interaction_id (однократно); None, если его нет или срок истёк."""
+    if not interaction_id:
+        return None
+    response = wallet_interactions.get(interaction_id)
+    wallet_interactions.pop(interaction_id)
+    return response
+
 
 class TelethonWalletAPI:
     """Adapter that sends text commands to the wallet bot via telethon_bot intermediary.
@@ -66,10 +90,10 @@ class TelethonWalletAPI:
 
                         await state.update_data(
                             button_texts=button_texts,
-                            response=response,
-                            conv=conv,
-                            prev_state=state.get_state())
+                            interaction_id=register_interaction(response),
+                            prev_state=await state.get_state())
                         await state.set_state("waiting_btc_button")
+                        deadlines.track_state(state.key, *BTC_STATE_RESET)
 
                         await message.answer_photo(  
                             photo=photo,  
@@ -104,6 +128,19 @@ class TelethonWalletAPI:
         except Exception as e:
             logger.error(f"Ошибка отправки: {e}")
         
+    async def press_button(self, interaction_id: Optional[str], text: str):
+        """Нажимает кнопку text в сообщении wallet-бота из wallet_interactions и ждёт ответ.
+
+        Диалог, в котором пришло сообщение, к этому моменту уже закрыт, поэтому
+        ответ ждём в новом. None - сообщение не найдено (срок истёк или уже нажато).
+        """
+        response = take_interaction(interaction_id)
+        if response is None:
+            return None
+        async with self.client.conversation(to_entity(WALLET_BOT), timeout=10) as conv:
+            await response.click(text=text)
+            return await conv.get_response()
+
     async def send_command(self, command: str, params: Dict[str, Any] = None, timeout: int = 30) -> str:
         request_id = uuid.uuid4().hex[:8]  # short unique ID
         #requset_id - уникальный идентификатор запроса, формируется с помощью uuid(это случайная строка).uuid4(это версия 4 uuid).hex(преобразование в шестнадцатеричную строку)[:8](берём первые 8 символов)
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """SimpleRequestHandler, который обрабатывает не больше concurrency апдейтов одновременно.
+
+    Telegram получает ответ сразу (handle_in_background), а сами апдейты ждут
+    своей очереди на семафоре - так же, как tasks_concurrency_limit в polling.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, concurrency: int, **kwargs: Any):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._limit = asyncio.Semaphore(concurrency)
+
+    async def _background_feed_update(self, bot: Bot, update: dict[str, Any]) -> None:
+        async with self._limit:
+            await super()._background_feed_update(bot, update)
+
+
+def build_webhook_app(dp: Dispatcher, bot: Bot, path: str, secret: str, concurrency: int) -> web.Application:
+    """aiohttp-приложение с одним маршрутом POST path; запросы без верного секрета получают 401."""
+    app = web.Application()
+    LimitedRequestHandler(dp, bot, concurrency=concurrency, secret_token=secret).register(app, path=path)
+    # startup/shutdown диспетчера (в том числе закрытие FSM-хранилища) - вместе с приложением
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(
+    dp: Dispatcher,
+    bot: Bot,
+    url: str,
+    path: str,
+    host: str,
+    port: int,
+    secret: str,
+    concurrency: int,
+) -> None:
+    """Поднимает локальный aiohttp-сервер, регистрирует вебхук в Bot API и работает до отмены."""
+    app = build_webhook_app(dp, bot, path, secret, concurrency)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        await bot.set_webhook(
+            url=url.rstrip('/') + path,
+            secret_token=secret,
+            # Telegram не откроет больше соединений, чем мы готовы обрабатывать
+            max_connections=max(1, min(concurrency, 100)),
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info(f'Webhook mode: listening on {host}:{port}{path}, concurrency {concurrency}')
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,116 @@
+from typing import Any, Awaitable, Callable, Hashable, Optional
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+
+class DeadlineScheduler:
+    """Один in-process планировщик сроков на двоичной куче вместо задачи asyncio на каждый срок.
+
+    schedule/cancel - O(log n) и O(1): отменённые записи помечаются и выбрасываются
+    при извлечении, а когда их становится больше живых, куча перестраивается.
+    Ключ уникален: повторный schedule с тем же ключом переносит срок.
+    Не потокобезопасен: рассчитан на один event loop.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self._heap: list[list] = []
+        self._entries: dict[Hashable, list] = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def schedule(self, key: Hashable, due: float, payload: Any = None) -> None:
+        old = self._entries.pop(key, None)
+        if old is not None:
+            old[-1] = False
+        entry = [due, next(self._counter), key, payload, True]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            # Новый срок раньше того, до которого спит run()
+            self._wakeup.set()
+        self._maybe_compact()
+
+    def cancel(self, key: Hashable) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[-1] = False
+        self._maybe_compact()
+        return True
+
+    def get(self, key: Hashable) -> Optional[tuple[float, Any]]:
+        entry = self._entries.get(key)
+        return (entry[0], entry[3]) if entry else None
+
+    def next_due(self) -> Optional[float]:
+        while self._heap and not self._heap[0][-1]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: Optional[float] = None, limit: Optional[int] = None) -> list[tuple[Hashable, Any]]:
+        """Извлекает до limit наступивших сроков в порядке времени: [(key, payload), ...]."""
+        now = self.clock() if now is None else now
+        due = []
+        while self._heap and (limit is None or len(due) < limit):
+            entry = self._heap[0]
+            if entry[-1] and entry[0] > now:
+                break
+            heapq.heappop(self._heap)
+            if entry[-1]:
+                del self._entries[entry[2]]
+                due.append((entry[2], entry[3]))
+        return due
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def _maybe_compact(self) -> None:
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._entries):
+            self._heap = [entry for entry in self._heap if entry[-1]]
+            heapq.heapify(self._heap)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, handler: Callable[[list[tuple[Hashable, Any]]], Awaitable[None]], batch_size: int = 100) -> None:
+        """Запускает цикл: наступившие сроки передаются handler пачками до batch_size."""
+        if not self.running:
+            self._task = asyncio.create_task(self._run(handler, batch_size))
+
+    async def stop(self) -> None:
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    async def _run(self, handler, batch_size: int) -> None:
+        while True:
+            self._wakeup.clear()
+            due = self.next_due()
+            now = self.clock()
+            if due is None or due > now:
+                timeout = None if due is None else due - now
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            batch = self.pop_due(now, batch_size)
+            try:
+                await handler(batch)
+            except Exception:
+                logging.exception("Обработчик сроков завершился с ошибкой")
+            # Следующая пачка - после других задач event loop
+            await asyncio.sleep(0)